@@ -63,8 +63,7 @@ void MfccComputer::Compute(BaseFloat signal_raw_log_energy,
   feature->SetZero();  // in case there were NaNs.
   // feature = dct_matrix_ * mel_energies [which now have log]
   feature->AddMatVec(1.0, dct_matrix_, kNoTrans, mel_energies_, 0.0);
- 
-std::cout << "opts_.cepstral_lifter = " << opts_.cepstral_lifter << std::endl;
+
   if (opts_.cepstral_lifter != 0.0)
     feature->MulElements(lifter_coeffs_);
 
@@ -0,0 +1,209 @@
+// feat/online-feature-speed-test.cc
+
+// See ../../COPYING for clarification regarding multiple authors
+//
+// Licensed under the Apache License, Version 2.0 (the "License");
+// you may not use this file except in compliance with the License.
+// You may obtain a copy of the License at
+//
+//  http://www.apache.org/licenses/LICENSE-2.0
+//
+// THIS CODE IS PROVIDED *AS IS* BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+// KIND, EITHER EXPRESS OR IMPLIED, INCLUDING WITHOUT LIMITATION ANY IMPLIED
+// WARRANTIES OR CONDITIONS OF TITLE, FITNESS FOR A PARTICULAR PURPOSE,
+// MERCHANTABLITY OR NON-INFRINGEMENT.
+// See the Apache 2 License for the specific language governing permissions and
+// limitations under the License.
+
+#include "feat/online-feature.h"
+#include "base/timer.h"
+
+namespace kaldi {
+
+static void CsvResult(std::string test, int32 num_frames, BaseFloat measure,
+                      std::string units) {
+  std::cout << test << "," << num_frames << "," << measure << ","
+            << units << "\n";
+}
+
+// Writes 'feats' in the text format read by ExternalFeatureSource.
+static void WriteExternalFeatures(const std::string &filename,
+                                  const MatrixBase<BaseFloat> &feats) {
+  std::ofstream os(filename.c_str());
+  for (int32 i = 0; i < feats.NumRows(); i++) {
+    for (int32 j = 0; j < feats.NumCols(); j++)
+      os << feats(i, j) << " ";
+    os << "\n";
+  }
+}
+
+// Writes 'feats' as a feature block, the binary format that
+// ExternalFeatureSource memory-maps.
+static void WriteFeatureBlock(const std::string &filename,
+                              const MatrixBase<BaseFloat> &feats) {
+  std::ofstream os(filename.c_str(), std::ios::binary);
+  int32 num_frames = feats.NumRows(), dim = feats.NumCols();
+  os.write("VKFB", 4);
+  os.write(reinterpret_cast<const char*>(&num_frames), sizeof(num_frames));
+  os.write(reinterpret_cast<const char*>(&dim), sizeof(dim));
+  for (int32 i = 0; i < num_frames; i++)
+    for (int32 j = 0; j < dim; j++) {
+      float f = feats(i, j);
+      os.write(reinterpret_cast<const char*>(&f), sizeof(f));
+    }
+}
+
+// Ten seconds of 16 kHz audio in chunks of 0.2 seconds, as the recognizer
+// feeds it.
+static void FeedWaveform(OnlineMfcc *mfcc) {
+  Vector<BaseFloat> waveform(160000);
+  waveform.SetRandn();
+  waveform.Scale(1000.0);
+  int32 step = 3200;
+  for (int32 i = 0; i < waveform.Dim(); i += step) {
+    SubVector<BaseFloat> chunk(waveform, i,
+                               std::min(step, waveform.Dim() - i));
+    mfcc->AcceptWaveform(16000.0, chunk);
+  }
+  mfcc->InputFinished();
+}
+
+// Compares the old way of taking external features, where the whole file was
+// parsed again for every frame, with ExternalFeatureSource which parses it
+// once per utterance.
+static void UnitTestExternalFeaturesSpeed() {
+  MfccOptions opts;
+  opts.num_ceps = 40;
+  opts.mel_opts.num_bins = 40;
+  std::string filename = "tmp.external_feats.txt",
+      block_filename = "tmp.external_feats.bin";
+  Matrix<BaseFloat> feats(1000, 40);
+  feats.SetRandn();
+  WriteExternalFeatures(filename, feats);
+  WriteFeatureBlock(block_filename, feats);
+
+  {
+    Timer t;
+    OnlineMfcc mfcc(opts);
+    FeedWaveform(&mfcc);
+    CsvResult("computed-mfcc", mfcc.NumFramesReady(),
+              mfcc.NumFramesReady() / t.Elapsed(), "frames/second");
+  }
+  {
+    // Emulates the per-frame parsing done before ExternalFeatureSource.
+    Timer t;
+    int32 num_frames = 0;
+    for (int32 frame = 0; frame < feats.NumRows(); frame++, num_frames++) {
+      ExternalFeatureSource source;
+      source.Read(filename);
+      Vector<BaseFloat> feat(source.Row(frame));
+    }
+    CsvResult("external-reparse-per-frame", num_frames,
+              num_frames / t.Elapsed(), "frames/second");
+  }
+  {
+    Timer t;
+    ExternalFeatureSource source;
+    source.Read(filename);
+    OnlineMfcc mfcc(opts);
+    mfcc.SetExternalFeatures(&source);
+    FeedWaveform(&mfcc);
+    CsvResult("external-cached", mfcc.NumFramesReady(),
+              mfcc.NumFramesReady() / t.Elapsed(), "frames/second");
+
+    Vector<BaseFloat> feat(mfcc.Dim());
+    for (int32 frame = 0; frame < mfcc.NumFramesReady(); frame++) {
+      mfcc.GetFrame(frame, &feat);
+      KALDI_ASSERT(feat.ApproxEqual(feats.Row(frame)));
+    }
+  }
+  {
+    // Features pushed directly, without the dummy waveform.
+    Timer t;
+    OnlineMfcc mfcc(opts);
+    for (int32 i = 0; i < feats.NumRows(); i += 20)
+      mfcc.AcceptFeatures(feats.RowRange(i, std::min(20, feats.NumRows() - i)));
+    mfcc.InputFinished();
+    CsvResult("external-accepted", mfcc.NumFramesReady(),
+              mfcc.NumFramesReady() / t.Elapsed(), "frames/second");
+
+    KALDI_ASSERT(mfcc.NumFramesReady() == feats.NumRows() &&
+                 mfcc.IsLastFrame(feats.NumRows() - 1));
+    Vector<BaseFloat> feat(mfcc.Dim());
+    for (int32 frame = 0; frame < mfcc.NumFramesReady(); frame++) {
+      mfcc.GetFrame(frame, &feat);
+      KALDI_ASSERT(feat.ApproxEqual(feats.Row(frame)));
+    }
+  }
+  {
+    // Loading the whole utterance: text parsing against mapping the block.
+    Timer t;
+    ExternalFeatureSource source;
+    for (int32 i = 0; i < 10; i++)
+      source.Read(filename);
+    CsvResult("external-read-text", 10 * source.NumFrames(),
+              10 * source.NumFrames() / t.Elapsed(), "frames/second");
+  }
+  {
+    Timer t;
+    ExternalFeatureSource source;
+    for (int32 i = 0; i < 10; i++)
+      source.Read(block_filename);
+    CsvResult("external-read-block", 10 * source.NumFrames(),
+              10 * source.NumFrames() / t.Elapsed(), "frames/second");
+    KALDI_ASSERT(source.NumFrames() == feats.NumRows() &&
+                 source.Dim() == feats.NumCols());
+    for (int32 frame = 0; frame < source.NumFrames(); frame++)
+      KALDI_ASSERT(source.Row(frame).ApproxEqual(feats.Row(frame)));
+  }
+  std::remove(filename.c_str());
+  std::remove(block_filename.c_str());
+}
+
+// Feature extraction with the feature tap writing everything to disk, and
+// the tap files read back.
+static void UnitTestFeatureTap() {
+  MfccOptions opts;
+  std::string prefix = "tmp.feature_tap";
+  Matrix<BaseFloat> feats;
+  {
+    Timer t;
+    OnlineFeatureFileTap tap(prefix);
+    OnlineMfcc mfcc(opts);
+    mfcc.SetFeatureTap(&tap);
+    FeedWaveform(&mfcc);
+    CsvResult("computed-mfcc-with-tap", mfcc.NumFramesReady(),
+              mfcc.NumFramesReady() / t.Elapsed(), "frames/second");
+    feats.Resize(mfcc.NumFramesReady(), mfcc.Dim());
+    for (int32 frame = 0; frame < mfcc.NumFramesReady(); frame++) {
+      SubVector<BaseFloat> row(feats, frame);
+      mfcc.GetFrame(frame, &row);
+    }
+  }
+  {
+    ExternalFeatureSource source;
+    source.Read(prefix + ".feats");
+    KALDI_ASSERT(source.NumFrames() == feats.NumRows() &&
+                 source.Dim() == feats.NumCols());
+    for (int32 frame = 0; frame < source.NumFrames(); frame++)
+      KALDI_ASSERT(source.Row(frame).ApproxEqual(feats.Row(frame)));
+  }
+  {
+    std::ifstream wave_is((prefix + ".wav.f32").c_str(),
+                          std::ios::binary | std::ios::ate);
+    KALDI_ASSERT(static_cast<int64>(wave_is.tellg()) ==
+                 160000 * static_cast<int64>(sizeof(float)));
+  }
+  std::remove((prefix + ".feats").c_str());
+  std::remove((prefix + ".wav.f32").c_str());
+}
+
+}  // end namespace kaldi
+
+int main() {
+  using namespace kaldi;
+  UnitTestExternalFeaturesSpeed();
+  UnitTestFeatureTap();
+  std::cout << "Tests succeeded.\n";
+  return 0;
+}
@@ -19,6 +19,17 @@
 // See the Apache 2 License for the specific language governing permissions and
 // limitations under the License.
 
+#include <cerrno>
+#include <cstring>
+#include <fstream>
+
+#ifndef _MSC_VER
+#include <fcntl.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
+#include <unistd.h>
+#endif
+
 #include "feat/online-feature.h"
 #include "transform/cmvn.h"
 
@@ -67,6 +78,229 @@ int RecyclingVector::Size() const {
   return first_available_index_ + items_.size();
 }
 
+// Layout of the feature block: magic, num-frames, dim, then float32 data.
+static const char kFeatureBlockMagic[4] = { 'V', 'K', 'F', 'B' };
+static const size_t kFeatureBlockHeaderSize = 12;
+
+void ExternalFeatureSource::Clear() {
+#ifndef _MSC_VER
+  if (mapped_ != NULL)
+    munmap(mapped_, mapped_size_);
+#endif
+  mapped_ = NULL;
+  mapped_size_ = 0;
+  feats_.Resize(0, 0);
+  data_ = NULL;
+  num_frames_ = 0;
+  dim_ = 0;
+  stride_ = 0;
+}
+
+void ExternalFeatureSource::MapFeatureBlock(const std::string &filename) {
+  int32 one = 1;
+  if (*reinterpret_cast<char*>(&one) != 1)
+    KALDI_ERR << "Feature blocks are little-endian and can't be read on "
+              << "this machine: " << filename;
+#ifndef _MSC_VER
+  int fd = open(filename.c_str(), O_RDONLY);
+  if (fd == -1)
+    KALDI_ERR << "Failed to open external features " << filename << ": "
+              << strerror(errno);
+  struct stat st;
+  if (fstat(fd, &st) != 0 ||
+      static_cast<size_t>(st.st_size) < kFeatureBlockHeaderSize) {
+    close(fd);
+    KALDI_ERR << "Bad feature block " << filename;
+  }
+  // Private, so a writer can't change the frames under us.  Truncating the
+  // file would still fault on the pages not read yet, writers replace it
+  // with rename() instead (see the class comment).
+  void *addr = mmap(NULL, st.st_size, PROT_READ, MAP_PRIVATE, fd, 0);
+  close(fd);
+  if (addr == MAP_FAILED)
+    KALDI_ERR << "Failed to map external features " << filename << ": "
+              << strerror(errno);
+  // Set these first so the mapping is released by Clear() if we fail below.
+  mapped_ = addr;
+  mapped_size_ = st.st_size;
+  const char *header = static_cast<const char*>(addr);
+  int32 num_frames, dim;
+  memcpy(&num_frames, header + 4, sizeof(int32));
+  memcpy(&dim, header + 8, sizeof(int32));
+  if (num_frames < 0 || dim <= 0 ||
+      mapped_size_ != kFeatureBlockHeaderSize +
+      static_cast<size_t>(num_frames) * dim * sizeof(float))
+    KALDI_ERR << "Bad feature block " << filename << ": " << num_frames
+              << " frames of dimension " << dim << " don't match file size "
+              << mapped_size_;
+  const float *data =
+      reinterpret_cast<const float*>(header + kFeatureBlockHeaderSize);
+  if (sizeof(BaseFloat) == sizeof(float)) {
+    data_ = reinterpret_cast<const BaseFloat*>(data);
+    stride_ = dim;
+  } else {
+    feats_.Resize(num_frames, dim, kUndefined);
+    for (int32 i = 0; i < num_frames; i++)
+      for (int32 j = 0; j < dim; j++)
+        feats_(i, j) = data[static_cast<size_t>(i) * dim + j];
+    data_ = feats_.Data();
+    stride_ = feats_.Stride();
+  }
+#else
+  std::ifstream is(filename.c_str(), std::ios::binary);
+  char header[kFeatureBlockHeaderSize];
+  if (!is.read(header, kFeatureBlockHeaderSize))
+    KALDI_ERR << "Bad feature block " << filename;
+  int32 num_frames, dim;
+  memcpy(&num_frames, header + 4, sizeof(int32));
+  memcpy(&dim, header + 8, sizeof(int32));
+  if (num_frames < 0 || dim <= 0)
+    KALDI_ERR << "Bad feature block " << filename;
+  std::vector<float> data(static_cast<size_t>(num_frames) * dim);
+  if (!data.empty() &&
+      !is.read(reinterpret_cast<char*>(&data[0]),
+               data.size() * sizeof(float)))
+    KALDI_ERR << "Feature block " << filename << " is truncated";
+  feats_.Resize(num_frames, dim, kUndefined);
+  for (int32 i = 0; i < num_frames; i++)
+    for (int32 j = 0; j < dim; j++)
+      feats_(i, j) = data[static_cast<size_t>(i) * dim + j];
+  data_ = feats_.Data();
+  stride_ = feats_.Stride();
+#endif
+  num_frames_ = num_frames;
+  dim_ = dim;
+}
+
+void ExternalFeatureSource::ReadText(std::istream &is,
+                                     const std::string &rxfilename) {
+  std::vector<BaseFloat> data;
+  std::vector<BaseFloat> frame;
+  std::string line;
+  int32 dim = -1;
+  while (std::getline(is, line)) {
+    if (!SplitStringToFloats(line, " \t\r", true, &frame))
+      KALDI_ERR << "Bad line in external features " << rxfilename
+                << ": '" << line << "'";
+    if (frame.empty())
+      continue;
+    if (dim == -1)
+      dim = frame.size();
+    else if (dim != static_cast<int32>(frame.size()))
+      KALDI_ERR << "Inconsistent dimension in external features "
+                << rxfilename << ": expected " << dim << ", got "
+                << frame.size();
+    data.insert(data.end(), frame.begin(), frame.end());
+  }
+  if (dim == -1)
+    return;
+  feats_.Resize(data.size() / dim, dim, kUndefined);
+  feats_.CopyRowsFromVec(SubVector<BaseFloat>(&data[0], data.size()));
+}
+
+void ExternalFeatureSource::Read(const std::string &rxfilename) {
+  Clear();
+  if (ClassifyRxfilename(rxfilename) == kFileInput) {
+    char magic[sizeof(kFeatureBlockMagic)];
+    std::ifstream probe(rxfilename.c_str(), std::ios::binary);
+    if (probe.read(magic, sizeof(magic)) &&
+        memcmp(magic, kFeatureBlockMagic, sizeof(magic)) == 0) {
+      probe.close();
+      MapFeatureBlock(rxfilename);
+      return;
+    }
+  }
+  bool binary;
+  Input ki(rxfilename, &binary);
+  if (binary)
+    feats_.Read(ki.Stream(), true);
+  else
+    ReadText(ki.Stream(), rxfilename);
+  data_ = feats_.Data();
+  num_frames_ = feats_.NumRows();
+  dim_ = feats_.NumCols();
+  stride_ = feats_.Stride();
+}
+
+OnlineFeatureFileTap::OnlineFeatureFileTap(const std::string &prefix):
+    prefix_(prefix), num_frames_(0), dim_(0), done_(false) {
+  wave_os_.open((prefix + ".wav.f32").c_str(), std::ios::binary);
+  feats_os_.open((prefix + ".feats").c_str(), std::ios::binary);
+  if (!wave_os_.is_open() || !feats_os_.is_open())
+    KALDI_ERR << "Failed to open feature tap files " << prefix << ".*";
+  // The header is rewritten with the real sizes at the end.
+  int32 zero = 0;
+  feats_os_.write(kFeatureBlockMagic, sizeof(kFeatureBlockMagic));
+  feats_os_.write(reinterpret_cast<const char*>(&zero), sizeof(zero));
+  feats_os_.write(reinterpret_cast<const char*>(&zero), sizeof(zero));
+  thread_ = std::thread(&OnlineFeatureFileTap::WriteLoop, this);
+}
+
+void OnlineFeatureFileTap::AcceptWaveform(
+    const VectorBase<BaseFloat> &waveform) {
+  Push(false, waveform);
+}
+
+void OnlineFeatureFileTap::AcceptFrame(const VectorBase<BaseFloat> &feature) {
+  Push(true, feature);
+}
+
+void OnlineFeatureFileTap::Push(bool is_frame,
+                                const VectorBase<BaseFloat> &data) {
+  Chunk *chunk = new Chunk;
+  chunk->is_frame = is_frame;
+  chunk->data.assign(data.Data(), data.Data() + data.Dim());
+  {
+    std::lock_guard<std::mutex> lock(mutex_);
+    queue_.push_back(chunk);
+  }
+  cond_.notify_one();
+}
+
+void OnlineFeatureFileTap::WriteLoop() {
+  while (true) {
+    Chunk *chunk;
+    {
+      std::unique_lock<std::mutex> lock(mutex_);
+      cond_.wait(lock, [this] { return done_ || !queue_.empty(); });
+      if (queue_.empty())
+        return;  // done_ and everything is written.
+      chunk = queue_.front();
+      queue_.pop_front();
+    }
+    const char *bytes = reinterpret_cast<const char*>(chunk->data.data());
+    size_t num_bytes = chunk->data.size() * sizeof(float);
+    if (!chunk->is_frame) {
+      wave_os_.write(bytes, num_bytes);
+    } else if (num_frames_ == 0 ||
+               static_cast<size_t>(dim_) == chunk->data.size()) {
+      dim_ = chunk->data.size();
+      feats_os_.write(bytes, num_bytes);
+      num_frames_++;
+    } else {
+      KALDI_WARN << "Feature tap " << prefix_ << ": dropping frame of "
+                 << "dimension " << chunk->data.size() << ", expected "
+                 << dim_;
+    }
+    delete chunk;
+  }
+}
+
+OnlineFeatureFileTap::~OnlineFeatureFileTap() {
+  {
+    std::lock_guard<std::mutex> lock(mutex_);
+    done_ = true;
+  }
+  cond_.notify_one();
+  thread_.join();
+  feats_os_.seekp(sizeof(kFeatureBlockMagic));
+  feats_os_.write(reinterpret_cast<const char*>(&num_frames_),
+                  sizeof(num_frames_));
+  feats_os_.write(reinterpret_cast<const char*>(&dim_), sizeof(dim_));
+  if (!wave_os_.good() || !feats_os_.good())
+    KALDI_WARN << "Failed to write feature tap files " << prefix_ << ".*";
+}
+
 template <class C>
 void OnlineGenericBaseFeature<C>::GetFrame(int32 frame,
                                            VectorBase<BaseFloat> *feat) {
@@ -78,7 +312,8 @@ OnlineGenericBaseFeature<C>::OnlineGenericBaseFeature(
     const typename C::Options &opts):
     computer_(opts), window_function_(computer_.GetFrameOptions()),
     features_(opts.frame_opts.max_feature_vectors),
-    input_finished_(false), waveform_offset_(0),features_temp_(opts.frame_opts.max_feature_vectors) {
+    external_features_(NULL), tap_(NULL), input_finished_(false),
+    features_accepted_(false), waveform_offset_(0),features_temp_(opts.frame_opts.max_feature_vectors) {
   // RE the following assert: search for ONLINE_IVECTOR_LIMIT in
   // online-ivector-feature.cc.
   // Casting to uint32, an unsigned type, means that -1 would be treated
@@ -113,53 +348,40 @@ void OnlineGenericBaseFeature<C>::MaybeCreateResampler(
 
 
 template <class C>
-void OnlineGenericBaseFeature<C>::Store_to_file(){
-  std::ofstream outfile("features.txt");
-  if (!outfile.is_open()) {
-    std::cerr << "Error opening file: features.txt" <<  std::endl;
-    return;
-  }
-  for (int i = 0; i < features_.Size(); ++i) {
-    const Vector<BaseFloat> *feature = features_.At(i);
-    outfile << "Feature " << i << ": ";
-    for (int j = 0; j < feature->Dim(); ++j) {
-      outfile << (*feature)(j) << " ";
-    }
-    outfile << std::endl;
-  }
-
-  outfile.close();
+void OnlineGenericBaseFeature<C>::SetExternalFeatures(
+    const ExternalFeatureSource *source) {
+  if (source != NULL && source->NumFrames() != 0 &&
+      source->Dim() != computer_.Dim())
+    KALDI_ERR << "External features have dimension " << source->Dim()
+              << ", expected " << computer_.Dim();
+  external_features_ = source;
 }
 
 template <class C>
-void OnlineGenericBaseFeature<C>::Get_input_from_external(const std::string &path, Matrix<BaseFloat> &mfcc_matrix){
-  std::ifstream infile(path);
-    std::string line;
-    std::vector<std::vector<kaldi::BaseFloat>> all_feats;
-    while (std::getline(infile, line)) {
-        std::istringstream iss(line);
-        std::vector<kaldi::BaseFloat> vals;
-        kaldi::BaseFloat val;
-        while (iss >> val) {
-            vals.push_back(val);
-        }
-        if (!vals.empty()) {
-            all_feats.push_back(vals);
-        }
-    }
-
-    int32 num_frames = all_feats.size();
-    kaldi::Matrix<kaldi::BaseFloat> mfcc_mat(num_frames, 40);
-    for (int i = 0; i < num_frames; ++i) {
-        for (int j = 0; j < 40; ++j) {
-            mfcc_mat(i, j) = all_feats[i][j];
-        }
-    }
-    mfcc_matrix.CopyFromMat(mfcc_mat);
+void OnlineGenericBaseFeature<C>::AcceptFeatures(
+    const MatrixBase<BaseFloat> &feats) {
+  if (input_finished_)
+    KALDI_ERR << "AcceptFeatures called after InputFinished() was called.";
+  if (waveform_offset_ != 0 || waveform_remainder_.Dim() != 0)
+    KALDI_ERR << "AcceptFeatures called after AcceptWaveform().";
+  if (feats.NumCols() != computer_.Dim())
+    KALDI_ERR << "Features have dimension " << feats.NumCols()
+              << ", expected " << computer_.Dim();
+  features_accepted_ = true;
+  for (int32 frame = 0; frame < feats.NumRows(); frame++) {
+    if (tap_ != NULL)
+      tap_->AcceptFrame(feats.Row(frame));
+    features_.PushBack(new Vector<BaseFloat>(feats.Row(frame)));
+  }
 }
 
 template <class C>
 void OnlineGenericBaseFeature<C>::InputFinished() {
+  if (features_accepted_) {
+    // There is no waveform to flush.
+    input_finished_ = true;
+    return;
+  }
   if (resampler_ != nullptr) {
     // There may be a few samples left once we flush the resampler_ object, telling it
     // that the file has finished.  This should rarely make any difference.
@@ -186,26 +408,21 @@ void OnlineGenericBaseFeature<C>::InputFinished() {
 template <class C>
 void OnlineGenericBaseFeature<C>::AcceptWaveform(
     BaseFloat sampling_rate, const VectorBase<BaseFloat> &original_waveform) {
-      std::ofstream wavefile("original_waveform.txt");
-      if (!wavefile.is_open()) {
-        std::cerr << "Error opening file: original_waveform.txt" << std::endl;
-        return;
-      }
-      for (int i = 0; i < original_waveform.Dim(); ++i) {
-        wavefile << original_waveform(i) << " ";
-      }
-      wavefile << std::endl;
-      wavefile.close();
   if (original_waveform.Dim() == 0)
     return;  // Nothing to do.
   if (input_finished_)
     KALDI_ERR << "AcceptWaveform called after InputFinished() was called.";
+  if (features_accepted_)
+    KALDI_ERR << "AcceptWaveform called after AcceptFeatures().";
 
   Vector<BaseFloat> appended_wave;
   Vector<BaseFloat> resampled_wave;
 
   const VectorBase<BaseFloat> *waveform;
 
+  if (tap_ != NULL)
+    tap_->AcceptWaveform(original_waveform);
+
   MaybeCreateResampler(sampling_rate);
   if (resampler_ == nullptr) {
     waveform = &original_waveform;
@@ -213,8 +430,6 @@ void OnlineGenericBaseFeature<C>::AcceptWaveform(
     resampler_->Resample(original_waveform, false, &resampled_wave);
     waveform = &resampled_wave;
   }
-  std::cout << "waveform_remainder_.Dim(): " << waveform_remainder_.Dim() << std::endl;
-  std::cout << "waveform->Dim(): " << waveform->Dim() << std::endl;
   appended_wave.Resize(waveform_remainder_.Dim() + waveform->Dim());
   if (waveform_remainder_.Dim() != 0)
     appended_wave.Range(0, waveform_remainder_.Dim())
@@ -240,31 +455,26 @@ void OnlineGenericBaseFeature<C>::ComputeFeatures() {
   bool need_raw_log_energy = computer_.NeedRawLogEnergy();
   // std::cout << "need_raw_log_energy: " << need_raw_log_energy << std::endl;
   for (int32 frame = num_frames_old; frame < num_frames_new; frame++) {
-    BaseFloat raw_log_energy = 0.0;
-    ExtractWindow(waveform_offset_, waveform_remainder_, frame,
-                  frame_opts, window_function_, &window,
-                  need_raw_log_energy ? &raw_log_energy : NULL);
-          // std::cout << "Window: ";
-          // for (int i = 0; i < window.Dim(); ++i) {
-          //   std::cout << window(i) << " ";
-          // }
-          // std::cout << std::endl;
     Vector<BaseFloat> *this_feature = new Vector<BaseFloat>(computer_.Dim(),
                                                             kUndefined);
-    // note: this online feature-extraction code does not support VTLN.
-    Matrix<BaseFloat>* mfcc_mat = new Matrix<BaseFloat>(1000, 40, kUndefined);
-    Get_input_from_external("/home/xuwei/vosk-build2/output2.txt", *mfcc_mat);
-    BaseFloat vtln_warp = 1.0;
-    computer_.Compute(raw_log_energy, vtln_warp, &window, this_feature);
-    this_feature->CopyRowFromMat(*mfcc_mat, frame);
-    std::cout << "Feature " << frame << ": ";
-    for (int i = 0; i < this_feature->Dim(); ++i) {
-      std::cout << (*this_feature)(i) << " ";
+    if (external_features_ != NULL &&
+        frame < external_features_->NumFrames()) {
+      // The external features replace the computed ones, so there is no
+      // point in extracting the window and computing them.
+      this_feature->CopyFromVec(external_features_->Row(frame));
+    } else {
+      BaseFloat raw_log_energy = 0.0;
+      ExtractWindow(waveform_offset_, waveform_remainder_, frame,
+                    frame_opts, window_function_, &window,
+                    need_raw_log_energy ? &raw_log_energy : NULL);
+      // note: this online feature-extraction code does not support VTLN.
+      BaseFloat vtln_warp = 1.0;
+      computer_.Compute(raw_log_energy, vtln_warp, &window, this_feature);
     }
-    std::cout << std::endl;
+    if (tap_ != NULL)
+      tap_->AcceptFrame(*this_feature);
     features_.PushBack(this_feature);
   }
-  Store_to_file();
   // OK, we will now discard any portion of the signal that will not be
   // necessary to compute frames in the future.
   int64 first_sample_of_next_frame = FirstSampleOfFrame(num_frames_new,
@@ -23,9 +23,13 @@
 #ifndef KALDI_FEAT_ONLINE_FEATURE_H_
 #define KALDI_FEAT_ONLINE_FEATURE_H_
 
+#include <condition_variable>
+#include <deque>
+#include <fstream>
+#include <mutex>
 #include <string>
+#include <thread>
 #include <vector>
-#include <deque>
 
 #include "matrix/matrix-lib.h"
 #include "util/common-utils.h"
@@ -72,6 +76,115 @@ private:
 };
 
 
+/// This class holds the features of one utterance that were computed outside
+/// of Kaldi (e.g. on an embedded device that only sends features to us).  The
+/// features are read once and then served row by row to
+/// OnlineGenericBaseFeature, which uses these rows instead of the frames it
+/// would compute from the waveform.
+///
+/// Three formats are understood.  The preferred one is the feature block: the
+/// 4-byte magic "VKFB", the number of frames and the dimension as int32,
+/// and then the frames as float32 in row-major order, all little-endian.
+/// Feature blocks are memory-mapped and the rows point directly into the
+/// mapping, so nothing is parsed or copied.  The file must not be truncated or
+/// rewritten in place while it is mapped, a writer creates a new file and
+/// rename()s it over the old one.  A Kaldi binary matrix is read
+/// with Matrix::Read(), and anything else is parsed as text with one frame
+/// per line and the coefficients separated by whitespace.
+class ExternalFeatureSource {
+ public:
+  ExternalFeatureSource(): data_(NULL), num_frames_(0), dim_(0), stride_(0),
+                           mapped_(NULL), mapped_size_(0) { }
+
+  /// Reads the features, discarding any previously read ones.
+  void Read(const std::string &rxfilename);
+
+  int32 NumFrames() const { return num_frames_; }
+
+  int32 Dim() const { return dim_; }
+
+  /// Returns the features for this frame; the data is not copied.
+  const SubVector<BaseFloat> Row(int32 frame) const {
+    KALDI_ASSERT(static_cast<UnsignedMatrixIndexT>(frame) <
+                 static_cast<UnsignedMatrixIndexT>(num_frames_));
+    return SubVector<BaseFloat>(data_ + static_cast<size_t>(frame) * stride_,
+                                dim_);
+  }
+
+  ~ExternalFeatureSource() { Clear(); }
+
+ private:
+  void Clear();
+  void MapFeatureBlock(const std::string &filename);
+  void ReadText(std::istream &is, const std::string &rxfilename);
+
+  // Points either into feats_ or into the memory-mapped feature block.
+  const BaseFloat *data_;
+  int32 num_frames_;
+  int32 dim_;
+  int32 stride_;
+
+  Matrix<BaseFloat> feats_;
+  void *mapped_;
+  size_t mapped_size_;
+  KALDI_DISALLOW_COPY_AND_ASSIGN(ExternalFeatureSource);
+};
+
+
+/// A feature tap receives copies of the waveform and of the features of an
+/// OnlineGenericBaseFeature, for debugging.  It is off unless set with
+/// SetFeatureTap(); the feature extraction does nothing extra without one.
+class OnlineFeatureTap {
+ public:
+  /// Called with every chunk of waveform, before resampling.
+  virtual void AcceptWaveform(const VectorBase<BaseFloat> &waveform) = 0;
+
+  /// Called with every feature frame, in order.
+  virtual void AcceptFrame(const VectorBase<BaseFloat> &feature) = 0;
+
+  virtual ~OnlineFeatureTap() { }
+};
+
+/// Feature tap that writes to files from a background thread, so the caller
+/// never waits for the disk.  The waveform goes to <prefix>.wav.f32 as raw
+/// float32 samples; the features go to <prefix>.feats as a feature block (see
+/// ExternalFeatureSource), so they can be fed back to the recognizer.  The
+/// frame count in the block header is filled in by the destructor.
+class OnlineFeatureFileTap: public OnlineFeatureTap {
+ public:
+  explicit OnlineFeatureFileTap(const std::string &prefix);
+
+  virtual void AcceptWaveform(const VectorBase<BaseFloat> &waveform);
+
+  virtual void AcceptFrame(const VectorBase<BaseFloat> &feature);
+
+  /// Waits until everything is written.
+  virtual ~OnlineFeatureFileTap();
+
+ private:
+  struct Chunk {
+    bool is_frame;
+    std::vector<float> data;
+  };
+
+  void Push(bool is_frame, const VectorBase<BaseFloat> &data);
+  void WriteLoop();
+
+  std::string prefix_;
+  std::ofstream wave_os_;
+  std::ofstream feats_os_;
+  int32 num_frames_;  // Only accessed by the writer thread.
+  int32 dim_;
+
+  std::mutex mutex_;
+  std::condition_variable cond_;
+  std::deque<Chunk*> queue_;
+  bool done_;
+  std::thread thread_;
+  KALDI_DISALLOW_COPY_AND_ASSIGN(OnlineFeatureFileTap);
+};
+
+
 /// This is a templated class for online feature extraction;
 /// it's templated on a class like MfccComputer or PlpComputer
 /// that does the basic feature extraction.
@@ -115,8 +228,23 @@ class OnlineGenericBaseFeature: public OnlineBaseFeature {
   // of features, in the case where snip-edges == false; it also
   // affects the return value of IsLastFrame().
   virtual void InputFinished();
-  virtual void Store_to_file();
-  virtual void Get_input_from_external(const std::string &path, Matrix<BaseFloat> &mfcc_mat);
+
+  // Makes the class take its frames from 'source' instead of computing them,
+  // for as many frames as 'source' provides; the waveform is still needed to
+  // determine how many frames are ready.  The pointer is not owned by this
+  // class and must outlive it (or be reset); NULL restores the normal
+  // behavior.
+  void SetExternalFeatures(const ExternalFeatureSource *source);
+
+  // Appends feature frames computed outside of Kaldi, bypassing the waveform
+  // and the computation entirely; the number of columns must equal Dim().
+  // This can't be mixed with AcceptWaveform() on the same object.
+  void AcceptFeatures(const MatrixBase<BaseFloat> &feats);
+
+  // Sends copies of the waveform and the features to 'tap'.  The pointer is
+  // not owned by this class and must outlive it (or be reset); NULL, the
+  // default, turns the tap off.
+  void SetFeatureTap(OnlineFeatureTap *tap) { tap_ = tap; }
 
  private:
   // This function computes any additional feature frames that it is possible to
@@ -143,9 +271,18 @@ class OnlineGenericBaseFeature: public OnlineBaseFeature {
 
   RecyclingVector features_temp_;
 
+  // Features computed outside of Kaldi, if any; not owned here.
+  const ExternalFeatureSource *external_features_;
+
+  // Debugging tap, if any; not owned here.
+  OnlineFeatureTap *tap_;
+
   // True if the user has called "InputFinished()"
   bool input_finished_;
 
+  // True if frames were given by AcceptFeatures() rather than computed.
+  bool features_accepted_;
+
   // The sampling frequency, extracted from the config.  Should
   // be identical to the waveform supplied.
   BaseFloat sampling_frequency_;
@@ -100,7 +100,6 @@ OnlineNnet2FeaturePipeline::OnlineNnet2FeaturePipeline(
 
   if (info_.feature_type == "mfcc") {
     base_feature_ = new OnlineMfcc(info_.mfcc_opts);
-    std::cout << "base Dim: " << base_feature_->Dim() << std::endl;
   } else if (info_.feature_type == "plp") {
     base_feature_ = new OnlinePlp(info_.plp_opts);
   } else if (info_.feature_type == "fbank") {
@@ -127,7 +126,6 @@ OnlineNnet2FeaturePipeline::OnlineNnet2FeaturePipeline(
     OnlineCmvnState initial_state(info_.global_cmvn_stats);
     cmvn_feature_ = new OnlineCmvn(info_.cmvn_opts, initial_state,
         feature_plus_optional_pitch_);
-        std::cout << "cmvn Dim: " << cmvn_feature_->Dim() << std::endl;
     feature_plus_optional_cmvn_ = cmvn_feature_;
   } else {
     feature_plus_optional_cmvn_ = feature_plus_optional_pitch_;
@@ -146,7 +144,6 @@ OnlineNnet2FeaturePipeline::OnlineNnet2FeaturePipeline(
     final_feature_ = feature_plus_optional_cmvn_;
   }
   dim_ = final_feature_->Dim();
-  std::cout << "final Dim: " << dim_<< std::endl;
 }
 /// ^-^
 
@@ -227,6 +224,40 @@ void OnlineNnet2FeaturePipeline::AcceptWaveform(
     pitch_->AcceptWaveform(sampling_rate, waveform);
 }
 
+void OnlineNnet2FeaturePipeline::SetExternalFeatures(
+    const ExternalFeatureSource *source) {
+  if (info_.feature_type == "mfcc") {
+    static_cast<OnlineMfcc*>(base_feature_)->SetExternalFeatures(source);
+  } else if (info_.feature_type == "plp") {
+    static_cast<OnlinePlp*>(base_feature_)->SetExternalFeatures(source);
+  } else if (info_.feature_type == "fbank") {
+    static_cast<OnlineFbank*>(base_feature_)->SetExternalFeatures(source);
+  }
+}
+
+void OnlineNnet2FeaturePipeline::SetFeatureTap(OnlineFeatureTap *tap) {
+  if (info_.feature_type == "mfcc") {
+    static_cast<OnlineMfcc*>(base_feature_)->SetFeatureTap(tap);
+  } else if (info_.feature_type == "plp") {
+    static_cast<OnlinePlp*>(base_feature_)->SetFeatureTap(tap);
+  } else if (info_.feature_type == "fbank") {
+    static_cast<OnlineFbank*>(base_feature_)->SetFeatureTap(tap);
+  }
+}
+
+void OnlineNnet2FeaturePipeline::AcceptFeatures(
+    const MatrixBase<BaseFloat> &feats) {
+  if (pitch_)
+    KALDI_ERR << "Features can't be accepted directly when pitch is used.";
+  if (info_.feature_type == "mfcc") {
+    static_cast<OnlineMfcc*>(base_feature_)->AcceptFeatures(feats);
+  } else if (info_.feature_type == "plp") {
+    static_cast<OnlinePlp*>(base_feature_)->AcceptFeatures(feats);
+  } else if (info_.feature_type == "fbank") {
+    static_cast<OnlineFbank*>(base_feature_)->AcceptFeatures(feats);
+  }
+}
+
 void OnlineNnet2FeaturePipeline::InputFinished() {
   base_feature_->InputFinished();
   if (pitch_)
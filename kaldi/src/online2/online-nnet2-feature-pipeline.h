@@ -258,6 +258,22 @@ class OnlineNnet2FeaturePipeline: public OnlineFeatureInterface {
 
   BaseFloat FrameShiftInSeconds() const { return info_.FrameShiftInSeconds(); }
 
+  /// Makes the base feature (MFCC/PLP/filterbank) take its frames from
+  /// 'source' instead of computing them from the waveform; see
+  /// OnlineGenericBaseFeature::SetExternalFeatures().  The pointer is not
+  /// owned by this object; NULL restores the normal behavior.
+  void SetExternalFeatures(const ExternalFeatureSource *source);
+
+  /// Sends copies of the waveform and the base features to 'tap', for
+  /// debugging; see OnlineGenericBaseFeature::SetFeatureTap().  The pointer
+  /// is not owned by this object; NULL turns the tap off.
+  void SetFeatureTap(OnlineFeatureTap *tap);
+
+  /// Accepts base features (MFCC/PLP/filterbank) computed outside of Kaldi
+  /// instead of the waveform; see OnlineGenericBaseFeature::AcceptFeatures().
+  /// Not supported with pitch, which needs the waveform.
+  void AcceptFeatures(const MatrixBase<BaseFloat> &feats);
+
   /// If you call InputFinished(), it tells the class you won't be providing any
   /// more waveform.  This will help flush out the last few frames of delta or
   /// LDA features, and finalize the pitch features (making them more
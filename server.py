@@ -1,10 +1,54 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
 import base64
 import os
-from vosk_api.python.example.llmchat import process_audio_and_chat
+import shutil
+import tempfile
+import threading
+from vosk_api.python.example.llmchat import transcribe, AudioFileError, \
+    SAMPLE_RATE, POOL_SIZE, get_recognizer_pool, add_text, reply_to, stream_reply
 
 app = Flask(__name__)
 API_KEY = "MY_SECRET_KEY"  # Optional API key for authentication
+FEATURE_DIM = 40            # Coefficients per frame in raw float32 feature uploads
+STREAM_CHUNK = 16 * 1024    # Bytes read from a streamed upload at a time
+# Requests waiting for one of the POOL_SIZE recognizers, more get 429
+DECODE_QUEUE = int(os.getenv("DECODE_QUEUE", POOL_SIZE * 2))
+decode_slots = threading.BoundedSemaphore(POOL_SIZE + DECODE_QUEUE)
+# Requests in progress, decoding or waiting for the LLM reply, each one holds
+# a thread for the whole time. More get 429
+MAX_REQUESTS = int(os.getenv("MAX_REQUESTS", (POOL_SIZE + DECODE_QUEUE) * 2))
+request_slots = threading.BoundedSemaphore(MAX_REQUESTS)
+# Threads beyond MAX_REQUESTS, they only answer 429 while the others are busy
+SPARE_WORKERS = 4
+
+def device_id():
+    # The conversation history is kept per device. Not by API key, all
+    # devices share the same one
+    return request.headers.get('X-Device-Id') or request.remote_addr
+
+class SlotBody:
+    """Streamed reply which holds the request slot until the server closes
+    it, also when the client goes away before the first chunk."""
+
+    def __init__(self, chunks, slots):
+        self._chunks = chunks
+        self._slots = slots
+        self._released = False
+
+    def __iter__(self):
+        return iter(self._chunks)
+
+    def close(self):
+        if not self._released:
+            self._released = True
+            self._slots.release()
+        if hasattr(self._chunks, 'close'):
+            self._chunks.close()
+
+def busy():
+    response = jsonify({"status": "error", "message": "Server busy, try again later"})
+    response.headers['Retry-After'] = '1'
+    return response, 429
 
 # Upload API
 @app.route('/upload', methods=['POST'])
@@ -26,16 +70,124 @@ def upload():
     except Exception as e:
         return jsonify({"status": "error", "message": "Base64 decode failed"}), 400
 
-    with open(filename, 'wb') as f:
-        f.write(file_bytes)
-    print(f"[*] Received file '{filename}' ({len(file_bytes)} bytes)")
+    if filename == 'reply.txt':
+        with open(filename, 'wb') as f:
+            f.write(file_bytes)
+        print(f"[*] Received file '{filename}' ({len(file_bytes)} bytes)")
+        return jsonify({"status": "success", "message": "File received", "result": result}), 200
 
-    if filename != 'reply.txt':
-        result = process_audio_and_chat()
-        print("result", result)
+    if not request_slots.acquire(blocking=False):
+        return busy()
+    try:
+        if not decode_slots.acquire(blocking=False):
+            return busy()
+        # Each request keeps its features in its own directory
+        tmpdir = tempfile.mkdtemp(prefix='upload-')
+        try:
+            final_text_list = transcribe_upload(filename, file_bytes, tmpdir)
+        except AudioFileError as e:
+            final_text_list = None
+            result = str(e)
+        except ValueError as e:
+            return jsonify({"status": "error", "message": str(e)}), 400
+        finally:
+            decode_slots.release()
+            shutil.rmtree(tmpdir, ignore_errors=True)
 
+        if final_text_list is not None:
+            result = reply_to(final_text_list, device_id())
+    finally:
+        request_slots.release()
+    print("result", result)
     return jsonify({"status": "success", "message": "File received", "result": result}), 200
 
+def transcribe_upload(filename, file_bytes, tmpdir):
+    feats = None
+    feature_file = None
+    if filename.endswith('.bin'):
+        # Raw little-endian float32 frames from the device, they are decoded
+        # directly without a dummy audio file
+        import numpy as np
+        if len(file_bytes) % (4 * FEATURE_DIM) != 0:
+            raise ValueError("Bad feature size")
+        feats = np.frombuffer(file_bytes, dtype="<f4").reshape(-1, FEATURE_DIM)
+        print(f"[*] Received {feats.shape[0]} feature frames in '{filename}'")
+    else:
+        feature_file = os.path.join(tmpdir, os.path.basename(filename) or 'features')
+        with open(feature_file, 'wb') as f:
+            f.write(file_bytes)
+        print(f"[*] Received file '{filename}' ({len(file_bytes)} bytes)")
+    return transcribe(feature_file, feats)
+
+# Streaming upload API: raw little-endian float32 feature frames as the body
+# (application/octet-stream, may be chunked), decoded while they arrive.
+# With ?reply=stream the LLM reply is sent back as plain text while it is
+# generated, otherwise as JSON when it is complete.
+@app.route('/stream', methods=['POST'])
+def stream():
+    client_key = request.headers.get('X-API-Key')
+    if API_KEY and client_key != API_KEY:
+        return jsonify({"status": "error", "message": "Unauthorized"}), 401
+    if request.mimetype != 'application/octet-stream':
+        return jsonify({"status": "error", "message": "Expecting application/octet-stream"}), 415
+
+    import numpy as np
+    if not request_slots.acquire(blocking=False):
+        return busy()
+    streaming = False
+    try:
+        response, streaming = stream_features(np)
+        return response
+    finally:
+        if not streaming:
+            request_slots.release()
+
+# Returns the response and whether it is a streamed reply, which then
+# releases the request slot itself
+def stream_features(np):
+    if not decode_slots.acquire(blocking=False):
+        return busy(), False
+    frame_bytes = 4 * FEATURE_DIM
+    pool = get_recognizer_pool(SAMPLE_RATE)
+    try:
+        rec = pool.acquire()
+    except:
+        decode_slots.release()
+        raise
+    try:
+        final_text_list = []
+        pending = b''
+        num_frames = 0
+        while True:
+            chunk = request.stream.read(STREAM_CHUNK)
+            if not chunk:
+                break
+            pending += chunk
+            usable = len(pending) - len(pending) % frame_bytes
+            if usable:
+                feats = np.frombuffer(pending[:usable], dtype="<f4").reshape(-1, FEATURE_DIM)
+                pending = pending[usable:]
+                num_frames += feats.shape[0]
+                if rec.AcceptFeatures(feats):
+                    add_text(rec.ResultData(), final_text_list)
+        if pending:
+            return (jsonify({"status": "error", "message": "Bad feature size"}), 400), False
+        add_text(rec.FinalResultData(), final_text_list)
+    finally:
+        pool.release(rec)
+        decode_slots.release()
+    print(f"[*] Streamed {num_frames} feature frames")
+
+    full_text = ' '.join(final_text_list).strip()
+    if request.args.get('reply') == 'stream' and full_text:
+        print(f"[*] Recognized '{full_text}', streaming the reply")
+        return Response(SlotBody(stream_reply(full_text, device_id()), request_slots),
+                        mimetype='text/plain'), True
+
+    result = reply_to(final_text_list, device_id())
+    print("result", result)
+    return (jsonify({"status": "success", "message": "Stream received", "result": result}), 200), False
+
 # Download API
 @app.route('/download/<path:filename>', methods=['GET'])
 def download(filename):
@@ -65,5 +217,16 @@ def list_files():
     files = os.listdir('.')
     return jsonify({"files": files}), 200
 
+# ASGI front end for serving several devices at once, for example
+#   uvicorn --factory server:create_asgi_app --host 0.0.0.0 --port 5000
+# Flask views run in a thread pool with a thread for every admitted request
+# plus a few which turn away the rest, so requests decode in parallel (the
+# vosk calls release the GIL), a slow LLM can't make requests queue up
+# without a 429, and the streamed bodies and replies are passed through
+# without buffering.
+def create_asgi_app():
+    from a2wsgi import WSGIMiddleware
+    return WSGIMiddleware(app, workers=MAX_REQUESTS + SPARE_WORKERS)
+
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5000)
\ No newline at end of file
+    app.run(host='0.0.0.0', port=5000, threaded=True)
\ No newline at end of file
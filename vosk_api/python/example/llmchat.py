@@ -1,102 +1,311 @@
 #!/usr/bin/env python3
 
 import wave
-import requests
 import json
-import re
 import os
-import base64
-from vosk import Model, KaldiRecognizer, SetLogLevel
+import queue
+import asyncio
+import sqlite3
+import threading
+from collections import OrderedDict
+from vosk import Model, RecognizerPool, SetLogLevel
 
 # === parameter ===
 HISTORY_ROUND = 2                 # chat history
+HISTORY_TOKENS = 1000             # estimated tokens of history sent to the LLM per device
+MAX_SESSIONS = 100                # devices whose history is kept in memory
+SESSION_DB = os.getenv("SESSION_DB")  # optional SQLite file, history survives restarts
+DEFAULT_DEVICE = "default"
 AUDIO_FILE = "/home/weihaoxu/vosk-build/vosk_api/python/example/rec5.wav"           #audio file path
+MODEL_PATH = "/home/weihaoxu/vosk-build/vosk-model-small-en-us-0.15"
+FEATURE_FILE = "outt.txt"         # features uploaded by the device, read once per utterance
+SAMPLE_RATE = 16000               # sample rate the device computes its features at
+POOL_SIZE = int(os.getenv("DECODE_WORKERS", os.cpu_count() or 1))  # requests decoded at once
 API_KEY = "MY_SECRET_KEY" 
+LLM_URL = "http://localhost:11434/api/chat"   # where the llm model is served
+LLM_MODEL = "deepseek-r1:7b"
 # close vosk debug log
 SetLogLevel(0)
 
-# === memory of model ===
-conversation_memory = []  #[{"role": "user", "content": "xxx"}, {"role": "assistant", "content": "yyy"}, ...]
+# === memory of model, one conversation per device ===
+def estimate_tokens(message):
+    # about 4 characters per token for English, no tokenizer needed
+    return len(message["content"]) // 4 + 1
 
-# === add to memory ===
-def add_to_memory(user_text, ai_text, memory, max_rounds=2):
-    memory.append({"role": "user", "content": user_text})
-    memory.append({"role": "assistant", "content": ai_text})
-    # preserve recent max_rounds 
-    if len(memory) > max_rounds * 2:
-        memory[:] = memory[-max_rounds * 2:]
+class SessionStore:
+    """Chat history per device, least recently used devices are dropped from memory.
 
-# === Chat with LLM and keep the history ===
-def llmchat(question):
-    host = "http://localhost" ##where the llm model is download
-    port = "11434"
-    model = "deepseek-r1:7b"
-
-    url = f"{host}:{port}/api/chat"
-    headers = {"Content-Type": "application/json"}
-
-    system_prompt = (
-        "You're an intelligent voice assistant that helps perform tasks based on the user's voice commands,"
-        "For example, setting alarms, reminders, playing music, checking the weather, answering questions, etc. Meanwhile, you're a friendly and chatty helper,"
-        "If a user makes small talk with you, you can also respond naturally,"
-        "For clear tasks, please reply in an executive tone such as [already set up for you] [remind you],"
-        "For chats, please respond in a relaxed and natural tone to increase rapport,"
-        "If it is not clear what the user intends, kindly ask for clarification of the question,"
-        "Note: Responses must be in English."
-    )
-
-    messages = [{"role": "system", "content": system_prompt}] + conversation_memory
+    Every history is kept to max_rounds rounds and max_tokens estimated tokens.
+    With db_path the histories are also stored in SQLite and loaded on demand.
+    """
+
+    def __init__(self, max_sessions=MAX_SESSIONS, max_rounds=HISTORY_ROUND,
+            max_tokens=HISTORY_TOKENS, db_path=None):
+        self.max_sessions = max_sessions
+        self.max_rounds = max_rounds
+        self.max_tokens = max_tokens
+        self.lock = threading.Lock()  # requests are served concurrently
+        self.sessions = OrderedDict()  # device -> [{"role": ..., "content": ...}, ...]
+        self.db = None
+        if db_path:
+            self.db = sqlite3.connect(db_path, check_same_thread=False)
+            self.db.execute("CREATE TABLE IF NOT EXISTS sessions "
+                    "(device TEXT PRIMARY KEY, messages TEXT NOT NULL)")
+            self.db.commit()
+
+    def _get(self, device):
+        messages = self.sessions.get(device)
+        if messages is None:
+            messages = []
+            if self.db is not None:
+                row = self.db.execute("SELECT messages FROM sessions WHERE device = ?",
+                        (device,)).fetchone()
+                if row is not None:
+                    messages = json.loads(row[0])
+            self.sessions[device] = messages
+            if len(self.sessions) > self.max_sessions:
+                self.sessions.popitem(last=False)
+        self.sessions.move_to_end(device)
+        return messages
+
+    def history(self, device):
+        with self.lock:
+            return list(self._get(device))
+
+    def add(self, device, user_text, ai_text):
+        with self.lock:
+            messages = self._get(device)
+            messages.append({"role": "user", "content": user_text})
+            messages.append({"role": "assistant", "content": ai_text})
+            # drop the oldest rounds beyond the limits
+            del messages[:max(len(messages) - self.max_rounds * 2, 0)]
+            while len(messages) > 2 and sum(estimate_tokens(m) for m in messages) > self.max_tokens:
+                del messages[:2]
+            if self.db is not None:
+                self.db.execute("INSERT OR REPLACE INTO sessions (device, messages) VALUES (?, ?)",
+                        (device, json.dumps(messages)))
+                self.db.commit()
+
+sessions = SessionStore(db_path=SESSION_DB)
+
+SYSTEM_PROMPT = (
+    "You're an intelligent voice assistant that helps perform tasks based on the user's voice commands,"
+    "For example, setting alarms, reminders, playing music, checking the weather, answering questions, etc. Meanwhile, you're a friendly and chatty helper,"
+    "If a user makes small talk with you, you can also respond naturally,"
+    "For clear tasks, please reply in an executive tone such as [already set up for you] [remind you],"
+    "For chats, please respond in a relaxed and natural tone to increase rapport,"
+    "If it is not clear what the user intends, kindly ask for clarification of the question,"
+    "Note: Responses must be in English."
+)
+
+# === Drop the thinking and the code fences from the streamed reply ===
+class ReplyFilter:
+    TAGS = ("<think>", "```json", "```")
+    THINK_END = "</think>"
+
+    def __init__(self):
+        self.buf = ""
+        self.in_think = False
+        self.started = False
+
+    def feed(self, text):
+        self.buf += text
+        out = []
+        while True:
+            if self.in_think:
+                end = self.buf.find(self.THINK_END)
+                if end < 0:
+                    # keep what may be the start of the end tag
+                    self.buf = self.buf[-(len(self.THINK_END) - 1):]
+                    break
+                self.buf = self.buf[end + len(self.THINK_END):]
+                self.in_think = False
+                continue
+            found = [(self.buf.find(t), -len(t), t) for t in self.TAGS if t in self.buf]
+            if not found:
+                keep = 0
+                for t in self.TAGS:
+                    for n in range(len(t) - 1, keep, -1):
+                        if self.buf.endswith(t[:n]):
+                            keep = n
+                            break
+                out.append(self.buf[:len(self.buf) - keep])
+                self.buf = self.buf[len(self.buf) - keep:]
+                break
+            pos, _, tag = min(found)
+            if any(t != tag and t.startswith(tag) and t.startswith(self.buf[pos:]) for t in self.TAGS):
+                # "```" may still become "```json"
+                out.append(self.buf[:pos])
+                self.buf = self.buf[pos:]
+                break
+            out.append(self.buf[:pos])
+            self.buf = self.buf[pos + len(tag):]
+            self.in_think = tag == "<think>"
+        return self.emit("".join(out))
+
+    def flush(self):
+        # no more input, so a held back "```" is just a fence
+        text = "" if self.in_think else self.buf.replace("```", "")
+        self.buf = ""
+        return self.emit(text)
+
+    def emit(self, text):
+        if not self.started:
+            text = text.lstrip()
+            self.started = text != ""
+        return text
+
+# === The LLM runs on one asyncio loop with a pooled HTTP session ===
+llm_loop = None
+llm_loop_lock = threading.Lock()
+llm_session = None
+
+def get_llm_loop():
+    global llm_loop
+    with llm_loop_lock:
+        if llm_loop is None:
+            llm_loop = asyncio.new_event_loop()
+            threading.Thread(target=llm_loop.run_forever, daemon=True).start()
+        return llm_loop
+
+async def get_llm_session():
+    # only called on llm_loop, so no lock is needed
+    global llm_session
+    if llm_session is None:
+        import aiohttp
+        llm_session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=300))
+    return llm_session
+
+async def stream_llm(question, history):
+    messages = [{"role": "system", "content": SYSTEM_PROMPT}] + history
     messages.append({"role": "user", "content": question})
 
     data = {
-        "model": model,
+        "model": LLM_MODEL,
         "options": {"temperature": 0.0},
-        "stream": False,
+        "stream": True,
         "messages": messages
     }
 
-    try:
-        response = requests.post(url, json=data, headers=headers, timeout=300)
-        if response.status_code == 200:
-            answer = response.json().get("message", {}).get("content", "")
-            answer = re.sub(r'<think>.*?</think>', '', answer, flags=re.DOTALL)
-            answer = re.sub(r'```json', '', answer)
-            answer = re.sub(r'```', '', answer)
-            return answer.strip()
-        else:
-            print(f"Error:{response.status_code} - {response.text}")
-            return None
-    except Exception as e:
-        print(f"Exception{e}")
-		
-def process_audio_and_chat():
-    if not os.path.exists(AUDIO_FILE):
-        return "Audio file not found."
-    wf = wave.open(AUDIO_FILE, "rb")
-    if wf.getnchannels() != 1 or wf.getsampwidth() != 2 or wf.getcomptype() != "NONE":
-        print("wav file should be one single channel")
-        return "Invalid audio file format."
-		
-    model = Model("/home/weihaoxu/vosk-build/vosk-model-small-en-us-0.15")
-    rec = KaldiRecognizer(model, wf.getframerate())
-    rec.SetWords(True)
-    rec.SetPartialWords(True)
-    final_text_list = []
+    session = await get_llm_session()
+    async with session.post(LLM_URL, json=data) as response:
+        if response.status != 200:
+            print(f"Error:{response.status} - {await response.text()}")
+            return
+        reply_filter = ReplyFilter()
+        # one JSON object per line, each with the next piece of the reply
+        async for line in response.content:
+            if not line.strip():
+                continue
+            chunk = json.loads(line)
+            text = reply_filter.feed(chunk.get("message", {}).get("content", ""))
+            if text:
+                yield text
+            if chunk.get("done"):
+                break
+        text = reply_filter.flush()
+        if text:
+            yield text
+
+# === Chat with LLM and keep the history ===
+def stream_reply(question, device=DEFAULT_DEVICE):
+    """Yields the reply as it is generated, the history is updated at the end."""
+    pieces = queue.Queue()
+    history = sessions.history(device)
+
+    async def pump():
+        try:
+            async for text in stream_llm(question, history):
+                pieces.put(text)
+        except Exception as e:
+            print(f"Exception{e}")
+        finally:
+            pieces.put(None)
+
+    asyncio.run_coroutine_threadsafe(pump(), get_llm_loop())
+    answer = []
     while True:
-        data = wf.readframes(4000)
-        if len(data) == 0:
+        text = pieces.get()
+        if text is None:
             break
-        if rec.AcceptWaveform(data):
-            result = json.loads(rec.Result())
-            text = result.get("text", "").strip()
-            if text:
-                final_text_list.append(text)
-            
-    final_result = json.loads(rec.FinalResult())
-    final_text = final_result.get("text", "").strip()
-    if final_text:
-        final_text_list.append(final_text)
+        answer.append(text)
+        yield text
+
+    answer = "".join(answer).strip()
+    if answer:
+        sessions.add(device, question, answer)
+
+def llmchat(question, device=DEFAULT_DEVICE):
+    answer = "".join(stream_reply(question, device)).strip()
+    return answer if answer else None
+
+recognizer_pools = {}  # sample rate -> RecognizerPool shared by all requests
+pools_lock = threading.Lock()
+
+def get_recognizer_pool(sample_rate):
+    with pools_lock:
+        if sample_rate not in recognizer_pools:
+            # the model is loaded once and stays with the pool
+            recognizer_pools[sample_rate] = RecognizerPool(Model.get_shared(MODEL_PATH),
+                    sample_rate, POOL_SIZE, words=True, partial_words=True)
+        return recognizer_pools[sample_rate]
+
+def add_text(result, final_text_list):
+    text = result.text.strip()
+    if text:
+        final_text_list.append(text)
+
+def recognize(rec, feats, wf):
+    final_text_list = []
+    if feats is not None:
+        # features go straight to the decoder, no dummy audio is needed
+        if rec.AcceptFeatures(feats):
+            add_text(rec.ResultData(), final_text_list)
+    else:
+        while True:
+            data = wf.readframes(4000)
+            if len(data) == 0:
+                break
+            if rec.AcceptWaveform(data):
+                add_text(rec.ResultData(), final_text_list)
+
+    add_text(rec.FinalResultData(), final_text_list)
+    return final_text_list
+
+class AudioFileError(Exception):
+    pass
 
+def transcribe(feature_file=FEATURE_FILE, feats=None):
+    """Returns the recognized texts, either of feats or of the features in feature_file."""
+    wf = None
+    if feats is not None:
+        sample_rate = SAMPLE_RATE
+    else:
+        if not os.path.exists(AUDIO_FILE):
+            raise AudioFileError("Audio file not found.")
+        wf = wave.open(AUDIO_FILE, "rb")
+        if wf.getnchannels() != 1 or wf.getsampwidth() != 2 or wf.getcomptype() != "NONE":
+            print("wav file should be one single channel")
+            raise AudioFileError("Invalid audio file format.")
+        sample_rate = wf.getframerate()
+
+    pool = get_recognizer_pool(sample_rate)
+    rec = pool.acquire(external_features=feature_file if feats is None else None)
+    try:
+        return recognize(rec, feats, wf)
+    finally:
+        pool.release(rec)
+        if wf is not None:
+            wf.close()
+
+def process_audio_and_chat(feature_file=FEATURE_FILE, feats=None, device=DEFAULT_DEVICE):
+    try:
+        final_text_list = transcribe(feature_file, feats)
+    except AudioFileError as e:
+        return str(e)
+    return reply_to(final_text_list, device)
+
+def reply_to(final_text_list, device=DEFAULT_DEVICE):
     full_text = ' '.join(final_text_list).strip()
 
     if not full_text:
@@ -107,40 +316,11 @@ def process_audio_and_chat():
 
     # === call LLM ===
     print("\n Talking to the LLM...\n")
-    answer = llmchat(full_text)
+    answer = llmchat(full_text, device)
 
     if answer:
         print("\n The reply isï¼\n")
         print(answer)
-        add_to_memory(full_text, answer, conversation_memory, max_rounds=HISTORY_ROUND)
-        try:
-            headers = {
-            
-                'X-API-Key': 'MY_SECRET_KEY',  
-                'Content-Type': 'application/json'
-            }
-            response = requests.post(
-                "http://192.168.178.117:5000/upload",
-                headers=headers,
-                json={"filename": "reply.txt", "content": base64.b64encode(answer.encode()).decode()}
-            )
-            if response.status_code == 200:
-                print("Already uploaded")
-                get_response = requests.get(
-                    "http://192.168.178.117:5000/download/reply.txt",
-                    headers=headers
-                )
-                if get_response.status_code == 200:
-                    response_data = get_response.json()
-                    content_b64 = response_data.get("content", "")
-                    decoded_content = base64.b64decode(content_b64).decode('utf-8')
-                    print("Reply is:", decoded_content)
-                else:
-                    print(f"Failed to get result:{get_response.status_code} - {get_response.text}")
-            else:
-                print(f"Failed to upload:{response.status_code} - {response.text}")
-        except Exception as e:
-            print(f"Upload exception:{e}")
         return answer
     else:
         print("\nHaven't recieved a reply.")
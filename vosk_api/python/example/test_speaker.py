@@ -4,9 +4,8 @@ import os
 import sys
 import wave
 import json
-import numpy as np
 
-from vosk import Model, KaldiRecognizer, SpkModel
+from vosk import Model, KaldiRecognizer, SpkModel, SpeakerIndex
 
 SPK_MODEL_PATH = "model-spk"
 
@@ -28,9 +27,9 @@ spk_model = SpkModel(SPK_MODEL_PATH)
 rec = KaldiRecognizer(model, wf.getframerate())
 rec.SetSpkModel(spk_model)
 
-# We compare speakers with cosine distance.
-# We can keep one or several fingerprints for the speaker in a database
-# to distingusih among users.
+# We compare speakers with cosine similarity.
+# SpeakerIndex keeps one or several fingerprints for every speaker, with a path
+# it is stored on disk, to distinguish among users.
 spk_sig = [-1.110417,0.09703002,1.35658,0.7798632,-0.305457,-0.339204,0.6186931,
         -0.4521213,0.3982236,-0.004530723,0.7651616,0.6500852,-0.6664245,0.1361499,
         0.1358056,-0.2887807,-0.1280468,-0.8208137,-1.620276,-0.4628615,0.7870904,
@@ -50,10 +49,8 @@ spk_sig = [-1.110417,0.09703002,1.35658,0.7798632,-0.305457,-0.339204,0.6186931,
         0.09419366,-1.583935,1.306094,-0.3501927,0.1794427,-0.3768163,0.9683866,
         -0.2442541,-1.696921,-1.8056,-0.6803037,-1.842043,0.3069353,0.9070363,-0.486526]
 
-def cosine_dist(x, y):
-    nx = np.array(x)
-    ny = np.array(y)
-    return 1 - np.dot(nx, ny) / np.linalg.norm(nx) / np.linalg.norm(ny)
+index = SpeakerIndex()
+index.enroll("reference", spk_sig)
 
 while True:
     data = wf.readframes(4000)
@@ -64,15 +61,15 @@ while True:
         print("Text:", res["text"])
         if "spk" in res:
             print("X-vector:", res["spk"])
-            print("Speaker distance:", cosine_dist(spk_sig, res["spk"]),
+            print("Speaker similarity:", index.identify(res["spk"]),
                 "based on", res["spk_frames"], "frames")
 
-print("Note that second distance is not very reliable because utterance is too short. "
+print("Note that second similarity is not very reliable because utterance is too short. "
     "Utterances longer than 4 seconds give better xvector")
 
 res = json.loads(rec.FinalResult())
 print("Text:", res["text"])
 if "spk" in res:
     print("X-vector:", res["spk"])
-    print("Speaker distance:", cosine_dist(spk_sig, res["spk"]),
+    print("Speaker similarity:", index.identify(res["spk"]),
         "based on", res["spk_frames"], "frames")
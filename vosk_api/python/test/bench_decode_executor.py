@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+
+# Decodes the same set of files with DecodeExecutor for 1, 2, 4, ... workers
+# and prints the speed, to check that decoding scales across cores.
+#
+# Usage: bench_decode_executor.py <model> <file.wav> [<file.wav> ...]
+
+import os
+import sys
+import wave
+
+from timeit import default_timer as timer
+from vosk import Model, DecodeExecutor, SetLogLevel
+
+SetLogLevel(-1)
+
+model = Model(sys.argv[1])
+
+audio = []
+for fn in sys.argv[2:]:
+    with wave.open(fn, "rb") as wf:
+        if wf.getnchannels() != 1 or wf.getsampwidth() != 2 or wf.getframerate() != 16000:
+            sys.exit("%s must be 16 kHz mono 16-bit PCM" % fn)
+        audio.append(wf.readframes(wf.getnframes()))
+
+# Enough streams to keep every worker busy
+max_workers = os.cpu_count()
+streams = audio * max(1, (2 * max_workers + len(audio) - 1) // len(audio))
+tot_seconds = sum(len(a) for a in streams) / 2 / 16000.0
+
+workers = 1
+base_time = None
+print("workers,seconds,xRT,speedup")
+while True:
+    with DecodeExecutor(model, workers=workers, pin=True) as executor:
+        start_time = timer()
+        executor.map(streams)
+        elapsed = timer() - start_time
+    base_time = base_time or elapsed
+    print("%d,%.3f,%.2f,%.2f" % (workers, elapsed, tot_seconds / elapsed, base_time / elapsed))
+    if workers >= max_workers:
+        break
+    workers = min(workers * 2, max_workers)
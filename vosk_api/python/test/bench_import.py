@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+
+# Measures how long "import vosk" and the transcriber CLI module take to
+# import in a fresh interpreter, and checks that the modules which are
+# imported lazily (and libvosk itself) are not loaded at import.
+#
+# Usage: bench_import.py [<runs>]
+
+import statistics
+import subprocess
+import sys
+
+LAZY_MODULES = ["requests", "srt", "tqdm", "urllib.request", "zipfile", "websockets"]
+
+CHECK = """
+import sys
+from timeit import default_timer as timer
+start_time = timer()
+import {module}
+elapsed = timer() - start_time
+import vosk
+loaded = [m for m in {lazy!r} if m in sys.modules]
+print(elapsed, vosk._c._dll is not None, ",".join(loaded))
+"""
+
+def run(module):
+    out = subprocess.check_output([sys.executable, "-c", CHECK.format(module=module, lazy=LAZY_MODULES)],
+            text=True)
+    elapsed, dll, loaded = out.strip("\n").split(" ")
+    return float(elapsed), dll == "True", [m for m in loaded.split(",") if m]
+
+runs = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+failed = False
+
+print("module,median_ms,min_ms")
+for module in ["vosk", "vosk.transcriber.transcriber"]:
+    times = []
+    for _ in range(runs):
+        elapsed, dll, loaded = run(module)
+        times.append(elapsed * 1000)
+    print("%s,%.1f,%.1f" % (module, statistics.median(times), min(times)))
+    if dll:
+        print("%s opens libvosk at import" % module)
+        failed = True
+    if loaded:
+        print("%s imports %s" % (module, ", ".join(loaded)))
+        failed = True
+
+sys.exit(1 if failed else 0)
@@ -1,17 +1,19 @@
 import os
 import sys
-import srt
 import datetime
 import json
 import enum
+import struct
+import threading
+import queue
+import re
 
-import requests
-from urllib.request import urlretrieve
-from zipfile import ZipFile
 from re import match
 from pathlib import Path
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import Future
 from .vosk_cffi import ffi as _ffi
-from tqdm import tqdm
 
 # Remote location of the models and local folders
 MODEL_PRE_URL = "https://alphacephei.com/vosk/models/"
@@ -34,14 +36,39 @@ def open_dll():
     else:
         raise TypeError("Unsupported platform")
 
-_c = open_dll()
+class _Library:
+    """libvosk, opened on the first call instead of at import.
+
+    The functions are cached on the instance, so later calls don't pass
+    through __getattr__.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._dll = None
+
+    def __getattr__(self, name):
+        if self._dll is None:
+            with self._lock:
+                if self._dll is None:
+                    self._dll = open_dll()
+        func = getattr(self._dll, name)
+        setattr(self, name, func)
+        return func
+
+_c = _Library()
+
+# requests, srt, tqdm, urllib and zipfile are imported where they are used,
+# they are slow to import and most programs never need them
 
 def list_models():
+    import requests
     response = requests.get(MODEL_LIST_URL, timeout=10)
     for model in response.json():
         print(model["name"])
 
 def list_languages():
+    import requests
     response = requests.get(MODEL_LIST_URL, timeout=10)
     languages = {m["lang"] for m in response.json()}
     for lang in languages:
@@ -61,9 +88,29 @@ class Model:
         if _c is not None:
             _c.vosk_model_free(self._handle)
 
+    @staticmethod
+    def get_shared(model_path):
+        """Returns the model from the process-wide cache, loading it if needed.
+
+        Call release_shared() when done with it.
+        """
+        return _shared_models.get(model_path)
+
+    def release_shared(self):
+        """Releases a model returned by get_shared(), raises if it was not."""
+        _shared_models.release(self)
+
     def vosk_model_find_word(self, word):
         return _c.vosk_model_find_word(self._handle, word.encode("utf-8"))
 
+    def preload_grammar(self, grammar):
+        """Builds a grammar (a JSON string or a list of phrases) ahead of
+        time, recognizers with the same grammar reuse it."""
+        if not isinstance(grammar, str):
+            grammar = json.dumps(grammar)
+        if _c.vosk_model_preload_grammar(self._handle, grammar.encode("utf-8")) == 0:
+            raise Exception("Failed to build the grammar")
+
     def get_model_path(self, model_name, lang):
         if model_name is None:
             model_path = self.get_model_by_lang(lang)
@@ -79,6 +126,7 @@ class Model:
             model_file = [model for model in model_file_list if model == model_name]
             if model_file != []:
                 return Path(directory, model_file[0])
+        import requests
         response = requests.get(MODEL_LIST_URL, timeout=10)
         result_model = [model["name"] for model in response.json() if model["name"] == model_name]
         if result_model == []:
@@ -97,6 +145,7 @@ class Model:
                     match(r"vosk-model(-small)?-{}".format(lang), model)]
             if model_file != []:
                 return Path(directory, model_file[0])
+        import requests
         response = requests.get(MODEL_LIST_URL, timeout=10)
         result_model = [model["name"] for model in response.json() if
                 model["lang"] == lang and model["type"] == "small" and model["obsolete"] == "false"]
@@ -108,6 +157,9 @@ class Model:
             return Path(directory, result_model[0])
 
     def download_model(self, model_name):
+        from tqdm import tqdm
+        from urllib.request import urlretrieve
+        from zipfile import ZipFile
         if not (model_name.parent).exists():
             (model_name.parent).mkdir(parents=True)
         with tqdm(unit="B", unit_scale=True, unit_divisor=1024, miniters=1,
@@ -131,6 +183,103 @@ class Model:
             return displayed
         return update_to
 
+def _model_size(model_path):
+    size = 0
+    for root, _, files in os.walk(model_path):
+        for name in files:
+            size += os.path.getsize(os.path.join(root, name))
+    return size
+
+class ModelCache:
+    """Keeps loaded models so that requests and threads can share them.
+
+    Every get() must be paired with a release(), releasing a model which is
+    not held from the cache raises. Models which are not in use
+    are evicted, least recently used first, when the total size of the cached
+    models exceeds max_bytes. The size of a model is estimated by the size of
+    its files. Recognizers keep their own reference to the model, so eviction
+    never breaks a running recognizer.
+    """
+
+    def __init__(self, max_bytes=None):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # path -> [model, size, refs], least recently used first
+        self._entries = OrderedDict()
+        # path -> Event set when the model being loaded is in _entries
+        self._loading = {}
+
+    def get(self, model_path):
+        key = os.path.abspath(str(model_path))
+        while True:
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None:
+                    self._entries.move_to_end(key)
+                    entry[2] += 1
+                    self._evict()
+                    return entry[0]
+                loading = self._loading.get(key)
+                if loading is None:
+                    loading = self._loading[key] = threading.Event()
+                    break
+            # Another thread loads it, if that fails this one tries again
+            loading.wait()
+
+        # Loaded without the lock, so other models are served meanwhile
+        try:
+            entry = [Model(key), _model_size(key), 1]
+        except:
+            with self._lock:
+                del self._loading[key]
+            loading.set()
+            raise
+        with self._lock:
+            self._entries[key] = entry
+            del self._loading[key]
+            self._evict()
+        loading.set()
+        return entry[0]
+
+    def release(self, model):
+        with self._lock:
+            for entry in self._entries.values():
+                if entry[0] is model and entry[2] > 0:
+                    entry[2] -= 1
+                    break
+            else:
+                raise Exception("The model was not obtained from the cache or is released already")
+            self._evict()
+
+    def clear(self):
+        """Drops all models which are not in use."""
+        with self._lock:
+            for key in [k for k, e in self._entries.items() if e[2] == 0]:
+                del self._entries[key]
+
+    def _evict(self):
+        if self.max_bytes is None:
+            return
+        total = sum(entry[1] for entry in self._entries.values())
+        for key in list(self._entries):
+            if total <= self.max_bytes:
+                break
+            entry = self._entries[key]
+            if entry[2] == 0:
+                total -= entry[1]
+                del self._entries[key]
+
+def _cache_bytes_from_env():
+    value = os.getenv("VOSK_MODEL_CACHE_BYTES", "0")
+    try:
+        return int(value) or None
+    except ValueError:
+        import warnings
+        warnings.warn("Ignoring invalid VOSK_MODEL_CACHE_BYTES=%r, the model cache is unbounded" % value)
+        return None
+
+_shared_models = ModelCache(_cache_bytes_from_env())
+
 class SpkModel:
 
     def __init__(self, model_path):
@@ -142,12 +291,316 @@ class SpkModel:
     def __del__(self):
         _c.vosk_spk_model_free(self._handle)
 
+def _read_kaldi_plda(path):
+    """Reads a Kaldi PLDA model (ivector-compute-plda output, binary or
+    text) and returns its mean, transform and psi as numpy arrays."""
+    import numpy as np
+    with open(path, "rb") as fh:
+        data = fh.read()
+
+    if not data.startswith(b"\0B"):
+        groups = re.findall(rb"\[([^\]]*)\]", data)
+        if not data.lstrip().startswith(b"<Plda>") or len(groups) != 3:
+            raise Exception("%s is not a PLDA model" % path)
+        rows = [row.split() for row in groups[1].splitlines() if row.strip()]
+        return (np.array(groups[0].split(), dtype=np.float64),
+                np.array(rows, dtype=np.float64),
+                np.array(groups[2].split(), dtype=np.float64))
+
+    pos = 2
+    def expect(token):
+        nonlocal pos
+        if data[pos:pos + len(token)] != token:
+            raise Exception("%s is not a PLDA model" % path)
+        pos += len(token)
+    def read_int():
+        nonlocal pos
+        value, = struct.unpack_from("<i", data, pos + 1)  # size byte, then int32
+        pos += 5
+        return value
+    def read_array(kind):
+        nonlocal pos
+        dtype = {b"F": "<f4", b"D": "<f8"}[data[pos:pos + 1]]
+        expect(data[pos:pos + 1] + kind + b" ")
+        shape = (read_int(), read_int()) if kind == b"M" else (read_int(),)
+        count = int(np.prod(shape))
+        array = np.frombuffer(data, dtype=dtype, count=count, offset=pos).reshape(shape)
+        pos += array.nbytes
+        return array.astype(np.float64)
+
+    expect(b"<Plda> ")
+    return read_array(b"V"), read_array(b"M"), read_array(b"V")
+
+class SpeakerIndex:
+    """Enrolled speakers for identification by x-vector (the spk of a result).
+
+    Every speaker is one row of a contiguous float32 matrix: the sum of its
+    enrolled vectors, each normalized to length 1. identify() scores all the
+    speakers with one matrix-vector product against the normalized sums,
+    that is the normalized means. With a path the matrix is a memory-mapped
+    .npy file in that directory and every change is written through.
+
+    Scores are cosine similarities, or PLDA log-likelihood ratios when a
+    Kaldi PLDA model is given (trained on the spk vectors of the model).
+    """
+
+    VECTORS = "vectors.npy"
+    INDEX = "index.json"
+
+    def __init__(self, path=None, dim=None, plda=None):
+        import numpy as np
+        self._np = np
+        self._lock = threading.Lock()
+        self._path = None if path is None else Path(path)
+        self._names = []
+        self._counts = []
+        self._rows = {}
+        self._vectors = None
+        self._dim = dim
+
+        if self._path is not None and (self._path / self.INDEX).exists():
+            with open(self._path / self.INDEX, encoding="utf-8") as fh:
+                index = json.load(fh)
+            self._dim = index["dim"]
+            self._names = index["names"]
+            self._counts = index["counts"]
+            self._rows = {name: row for row, name in enumerate(self._names)}
+            self._vectors = np.load(self._path / self.VECTORS, mmap_mode="r+")
+            if not index.get("sums"):
+                # Older indexes kept the normalized means
+                n = len(self._names)
+                self._vectors[:n] *= np.array(self._counts, dtype=np.float32)[:, None]
+                self._save()
+        elif self._dim is not None:
+            self._allocate(16)
+
+        self._plda = None
+        if plda is not None:
+            plda_path = Path(plda)
+            if plda_path.is_dir():
+                plda_path = plda_path / "plda"
+            self._plda = _read_kaldi_plda(plda_path)
+        self._plda_vectors = None
+        self._means = None
+
+    def _allocate(self, capacity):
+        np = self._np
+        if self._path is None:
+            vectors = np.zeros((capacity, self._dim), dtype=np.float32)
+            if self._vectors is not None:
+                vectors[:len(self._names)] = self._vectors[:len(self._names)]
+            self._vectors = vectors
+            return
+
+        # The new file replaces the old one only when it is complete
+        self._path.mkdir(parents=True, exist_ok=True)
+        tmp = self._path / (self.VECTORS + ".tmp")
+        vectors = np.lib.format.open_memmap(tmp, mode="w+", dtype=np.float32, shape=(capacity, self._dim))
+        if self._vectors is not None:
+            vectors[:len(self._names)] = self._vectors[:len(self._names)]
+        vectors.flush()
+        del vectors
+        os.replace(tmp, self._path / self.VECTORS)
+        self._vectors = np.load(self._path / self.VECTORS, mmap_mode="r+")
+
+    def _save(self):
+        if self._path is None:
+            return
+        self._vectors.flush()
+        tmp = self._path / (self.INDEX + ".tmp")
+        with open(tmp, "w", encoding="utf-8") as fh:
+            json.dump({"dim": self._dim, "names": self._names, "counts": self._counts, "sums": True}, fh)
+        os.replace(tmp, self._path / self.INDEX)
+
+    def _normalize(self, spk):
+        np = self._np
+        spk = getattr(spk, "spk", spk)
+        if spk is None:
+            raise Exception("The result has no speaker vector")
+        vector = np.asarray(spk, dtype=np.float32).reshape(-1)
+        if self._dim is not None and vector.shape[0] != self._dim:
+            raise Exception("Speaker vector has dimension %d, the index has %d" % (vector.shape[0], self._dim))
+        norm = np.linalg.norm(vector)
+        if norm == 0:
+            raise Exception("Speaker vector is zero")
+        return vector / norm
+
+    def enroll(self, name, spk):
+        """Adds a vector (a list, an array or a RecognitionResult) of the
+        speaker. Returns the number of vectors enrolled for the speaker."""
+        vector = self._normalize(spk)
+        with self._lock:
+            if self._dim is None:
+                self._dim = vector.shape[0]
+            if self._vectors is None or len(self._names) == self._vectors.shape[0]:
+                self._allocate(max(16, 2 * len(self._names)))
+
+            row = self._rows.get(name)
+            if row is None:
+                row = len(self._names)
+                self._names.append(name)
+                self._counts.append(0)
+                self._rows[name] = row
+                self._vectors[row] = vector
+            else:
+                self._vectors[row] += vector
+            self._counts[row] += 1
+            self._means = None
+            self._plda_vectors = None
+            self._save()
+            return self._counts[row]
+
+    def remove(self, name):
+        """Removes the speaker, returns False if it is not enrolled."""
+        with self._lock:
+            row = self._rows.pop(name, None)
+            if row is None:
+                return False
+            # The last row moves into the hole
+            last = len(self._names) - 1
+            if row != last:
+                self._vectors[row] = self._vectors[last]
+                self._names[row] = self._names[last]
+                self._counts[row] = self._counts[last]
+                self._rows[self._names[row]] = row
+            self._names.pop()
+            self._counts.pop()
+            self._means = None
+            self._plda_vectors = None
+            self._save()
+            return True
+
+    def identify(self, spk, k=1):
+        """Returns up to k (name, score) pairs of the closest speakers, best
+        first."""
+        np = self._np
+        vector = self._normalize(spk)
+        with self._lock:
+            n = len(self._names)
+            if n == 0:
+                return []
+            if self._plda is None:
+                scores = self._normalized_means(n) @ vector
+            else:
+                scores = self._plda_scores(vector, n)
+            k = min(k, n)
+            best = np.argpartition(-scores, k - 1)[:k] if k < n else np.arange(n)
+            best = best[np.argsort(-scores[best], kind="stable")]
+            return [(self._names[i], float(scores[i])) for i in best]
+
+    def _normalized_means(self, n):
+        np = self._np
+        if self._means is None:
+            sums = self._vectors[:n]
+            norms = np.linalg.norm(sums, axis=1)
+            # Opposite vectors can sum to zero
+            self._means = sums / np.maximum(norms, 1e-12)[:, None]
+        return self._means
+
+    def _plda_transform(self, vectors, counts):
+        # Same as Plda::TransformIvector() in Kaldi. The spk vectors have
+        # the norm sqrt(dim) before PLDA, the index keeps them normalized to 1
+        np = self._np
+        mean, transform, psi = self._plda
+        dim = vectors.shape[1]
+        transformed = (vectors * np.sqrt(dim) - mean) @ transform.T
+        inv_covar = 1.0 / (psi + 1.0 / counts[:, None])
+        factor = np.sqrt(transformed.shape[1] / np.sum(transformed ** 2 * inv_covar, axis=1))
+        return transformed * factor[:, None]
+
+    def _plda_scores(self, vector, n):
+        # Plda::LogLikelihoodRatio() for all speakers at once
+        np = self._np
+        psi = self._plda[2]
+        if self._plda_vectors is None:
+            counts = np.array(self._counts, dtype=np.float64)
+            self._plda_vectors = (self._plda_transform(self._normalized_means(n).astype(np.float64), counts),
+                                  counts[:, None])
+        train, counts = self._plda_vectors
+        test = self._plda_transform(vector[None, :].astype(np.float64), np.ones(1))[0]
+
+        mean = counts * psi / (counts * psi + 1.0) * train
+        var = 1.0 + psi / (counts * psi + 1.0)
+        given_class = -0.5 * (np.sum(np.log(var), axis=1) + np.sum((test - mean) ** 2 / var, axis=1))
+        var = 1.0 + psi
+        without_class = -0.5 * (np.sum(np.log(var)) + np.sum(test ** 2 / var))
+        return given_class - without_class
+
+    @property
+    def names(self):
+        return list(self._names)
+
+    def __len__(self):
+        return len(self._names)
+
+    def __contains__(self, name):
+        return name in self._rows
+
 class EndpointerMode(enum.Enum):
     DEFAULT = 0
     SHORT = 1
     LONG = 2
     VERY_LONG = 3
 
+class RecognitionResult:
+    """Result of the recognizer as plain lists, without the JSON round-trip.
+
+    words, word_ids, start, end and conf are parallel lists. start, end and
+    conf are None for partial results when partial words are not enabled.
+    For partial results the first `stable` words did not change since the
+    previous partial result, `delta` are the words after them and `version`
+    changes only when the words do.
+    json() formats the result the way the string methods of KaldiRecognizer
+    do, with the word list only when with_words is set (words or partial
+    words enabled). It is only built when asked for.
+    """
+
+    __slots__ = ("partial", "text", "word_ids", "start", "end", "conf", "spk", "spk_frames",
+            "stable", "version", "with_words")
+
+    def __init__(self, data):
+        self.partial = bool(data.partial)
+        self.text = _ffi.string(data.text).decode("utf-8")
+        n = data.num_words
+        self.word_ids = _ffi.unpack(data.word_ids, n) if n else []
+        self.start = _ffi.unpack(data.start, n) if data.start != _ffi.NULL else None
+        self.end = _ffi.unpack(data.end, n) if data.end != _ffi.NULL else None
+        self.conf = _ffi.unpack(data.conf, n) if data.conf != _ffi.NULL else None
+        self.spk = _ffi.unpack(data.spk, data.spk_dim) if data.spk_dim else None
+        self.spk_frames = data.spk_frames
+        self.stable = data.num_stable
+        self.version = data.version
+        self.with_words = bool(data.with_words)
+
+    @property
+    def words(self):
+        return self.text.split()
+
+    @property
+    def delta(self):
+        return self.words[self.stable:]
+
+    def __len__(self):
+        return len(self.word_ids)
+
+    def __repr__(self):
+        return "RecognitionResult(%r, partial=%r)" % (self.text, self.partial)
+
+    def dict(self):
+        res = {}
+        if self.with_words and self.start is not None and self.word_ids:
+            res["partial_result" if self.partial else "result"] = [
+                    {"word": w, "start": s, "end": e, "conf": c}
+                    for w, s, e, c in zip(self.words, self.start, self.end, self.conf)]
+        res["partial" if self.partial else "text"] = self.text
+        if self.spk is not None:
+            res["spk"] = self.spk
+            res["spk_frames"] = self.spk_frames
+        return res
+
+    def json(self):
+        return json.dumps(self.dict())
+
 class KaldiRecognizer:
 
     def __init__(self, *args):
@@ -192,12 +645,60 @@ class KaldiRecognizer:
     def SetGrammar(self, grammar):
         _c.vosk_recognizer_set_grm(self._handle, grammar.encode("utf-8"))
 
+    def AddGrammarPhrase(self, class_name, phrase):
+        """Adds a phrase to a $class of the grammar, returns False if the
+        grammar has no such class or a word is not in the vocabulary."""
+        return _c.vosk_recognizer_add_grm_phrase(self._handle, class_name.encode("utf-8"),
+                phrase.encode("utf-8")) == 1
+
+    def RemoveGrammarPhrase(self, class_name, phrase):
+        return _c.vosk_recognizer_remove_grm_phrase(self._handle, class_name.encode("utf-8"),
+                phrase.encode("utf-8")) == 1
+
+    def SetExternalFeatures(self, path):
+        _c.vosk_recognizer_set_external_features(self._handle,
+                _ffi.NULL if path is None else str(path).encode("utf-8"))
+
+    def SetFeatureTap(self, prefix):
+        _c.vosk_recognizer_set_feature_tap(self._handle,
+                _ffi.NULL if prefix is None else str(prefix).encode("utf-8"))
+
     def AcceptWaveform(self, data):
-        res = _c.vosk_recognizer_accept_waveform(self._handle, data, len(data))
+        """Accepts 16-bit PCM as bytes or any buffer: memoryview, bytearray,
+        array.array or numpy array. Buffers of int16 or float32 samples (floats
+        in the 16-bit range) are passed to the recognizer without a copy.
+        """
+        if isinstance(data, bytes):
+            res = _c.vosk_recognizer_accept_waveform(self._handle, data, len(data))
+        else:
+            view = memoryview(data)
+            if view.format in ("h", "<h", "=h") and view.itemsize == 2:
+                res = _c.vosk_recognizer_accept_waveform_s(self._handle,
+                        _ffi.from_buffer("short[]", data), view.nbytes // 2)
+            elif view.format in ("f", "<f", "=f") and view.itemsize == 4:
+                res = _c.vosk_recognizer_accept_waveform_f(self._handle,
+                        _ffi.from_buffer("float[]", data), view.nbytes // 4)
+            elif view.itemsize == 1:
+                res = _c.vosk_recognizer_accept_waveform(self._handle,
+                        _ffi.from_buffer(data), view.nbytes)
+            else:
+                raise TypeError("Unsupported sample format '%s', expecting int16 or float32" % view.format)
         if res < 0:
             raise Exception("Failed to process waveform")
         return res
 
+    def AcceptFeatures(self, feats):
+        """Decodes a (frames, dim) array of features instead of audio."""
+        import numpy as np
+        feats = np.ascontiguousarray(feats, dtype=np.float32)
+        if feats.ndim != 2:
+            raise Exception("Features must be a 2-dimensional array, got shape %s" % (feats.shape,))
+        res = _c.vosk_recognizer_accept_features(self._handle, _ffi.from_buffer("float[]", feats),
+                feats.shape[0], feats.shape[1])
+        if res < 0:
+            raise Exception("Failed to process features")
+        return res
+
     def Result(self):
         return _ffi.string(_c.vosk_recognizer_result(self._handle)).decode("utf-8")
 
@@ -207,10 +708,39 @@ class KaldiRecognizer:
     def FinalResult(self):
         return _ffi.string(_c.vosk_recognizer_final_result(self._handle)).decode("utf-8")
 
+    def ResultData(self):
+        """Same as Result() but returns a RecognitionResult."""
+        return self._result_data(_c.vosk_recognizer_result_data(self._handle))
+
+    def PartialResultData(self, since=None):
+        """Same as PartialResult() but returns a RecognitionResult.
+
+        If since is the version of the last partial result the caller has
+        seen, returns None when the words did not change.
+        """
+        data = _c.vosk_recognizer_partial_result_data(self._handle)
+        if since is not None and data != _ffi.NULL and data.version == since:
+            return None
+        return self._result_data(data)
+
+    def FinalResultData(self):
+        """Same as FinalResult() but returns a RecognitionResult."""
+        return self._result_data(_c.vosk_recognizer_final_result_data(self._handle))
+
+    def _result_data(self, data):
+        if data == _ffi.NULL:
+            raise Exception("Failed to get the result")
+        return RecognitionResult(data)
+
     def Reset(self):
         return _c.vosk_recognizer_reset(self._handle)
 
+    def Restart(self):
+        if _c.vosk_recognizer_restart(self._handle) == 0:
+            raise Exception("Failed to restart the recognizer")
+
     def SrtResult(self, stream, words_per_line = 7):
+        import srt
         results = []
 
         while True:
@@ -218,25 +748,216 @@ class KaldiRecognizer:
             if len(data) == 0:
                 break
             if self.AcceptWaveform(data):
-                results.append(self.Result())
-        results.append(self.FinalResult())
+                results.append(self.ResultData())
+        results.append(self.FinalResultData())
 
         subs = []
         for res in results:
-            jres = json.loads(res)
-            if not "result" in jres:
+            if not res.word_ids:
                 continue
-            words = jres["result"]
+            words = res.words
             for j in range(0, len(words), words_per_line):
-                line = words[j : j + words_per_line]
+                last = min(j + words_per_line, len(words)) - 1
                 s = srt.Subtitle(index=len(subs),
-                        content=" ".join([l["word"] for l in line]),
-                        start=datetime.timedelta(seconds=line[0]["start"]),
-                        end=datetime.timedelta(seconds=line[-1]["end"]))
+                        content=" ".join(words[j : last + 1]),
+                        start=datetime.timedelta(seconds=res.start[j]),
+                        end=datetime.timedelta(seconds=res.end[last]))
                 subs.append(s)
 
         return srt.compose(subs)
 
+class RecognizerPool:
+    """Keeps ready recognizers of one model so requests don't have to build their own.
+
+    Options are given as keywords: words, partial_words, max_alternatives, nlsml,
+    grammar and external_features. The ones given to the constructor are the defaults, acquire()
+    can override them for one request. external_features=None means the
+    default of the model. A recognizer always comes with exactly
+    these options, whatever the previous request used, and only the options
+    which differ are set again (a grammar rebuilds the decoding graph).
+    """
+
+    # Option -> (setter, value of a new recognizer)
+    OPTIONS = {
+        "words": ("SetWords", False),
+        "partial_words": ("SetPartialWords", False),
+        "max_alternatives": ("SetMaxAlternatives", 0),
+        "nlsml": ("SetNLSML", False),
+        "grammar": ("SetGrammar", None),
+        "external_features": ("SetExternalFeatures", None),
+    }
+    # Restart() puts back the model default, which is what None stands for,
+    # so they are set again by the next request which gives them
+    STREAM_OPTIONS = {"external_features"}
+
+    def __init__(self, model, sample_rate, size, **options):
+        self._check_options(options)
+        self._model = model
+        self._sample_rate = sample_rate
+        self._defaults = options
+        self._recognizers = queue.LifoQueue()
+        for _ in range(size):
+            self._recognizers.put(self._new_recognizer())
+
+    def _new_recognizer(self):
+        rec = KaldiRecognizer(self._model, self._sample_rate)
+        rec._pool_options = {}
+        self._apply(rec, self._defaults)
+        return rec
+
+    def _check_options(self, options):
+        for name in options:
+            if name not in self.OPTIONS:
+                raise TypeError("Unknown recognizer option %s" % name)
+
+    def _apply(self, rec, options):
+        for name in set(options) | set(rec._pool_options):
+            setter, initial = self.OPTIONS[name]
+            value = options.get(name, initial)
+            if rec._pool_options.get(name, initial) == value:
+                continue
+            if name == "grammar" and value is None:
+                value = "[]"  # back to the full model graph
+            getattr(rec, setter)(value)
+            rec._pool_options[name] = options.get(name, initial)
+
+    def acquire(self, timeout=None, **options):
+        """Returns a recognizer, waiting for a free one up to timeout seconds.
+
+        Raises queue.Empty if none became free in time.
+        """
+        self._check_options(options)
+        rec = self._recognizers.get(timeout=timeout)
+        try:
+            self._apply(rec, dict(self._defaults, **options))
+        except:
+            # Restarted, which also puts back the external features of the model
+            self.release(rec)
+            raise
+        return rec
+
+    def release(self, rec):
+        """Returns a recognizer to the pool. One which fails to restart is
+        dropped and replaced by a new one."""
+        try:
+            rec.Restart()
+        except Exception:
+            rec = self._new_recognizer()
+        else:
+            for name in self.STREAM_OPTIONS:
+                rec._pool_options.pop(name, None)
+        self._recognizers.put(rec)
+
+    @contextmanager
+    def recognizer(self, timeout=None, **options):
+        rec = self.acquire(timeout, **options)
+        try:
+            yield rec
+        finally:
+            self.release(rec)
+
+class DecodeExecutor:
+    """Decodes audio streams on a fixed set of worker threads.
+
+    Every worker thread owns its recognizer, so a recognizer is never used by
+    two threads. The C functions are called through cffi, which releases the
+    GIL for the duration of every call, so the workers decode in parallel.
+    With pin=True each worker is bound to one CPU (Linux only).
+
+    submit() takes a file-like object with 16-bit PCM audio, a wave reader or
+    bytes and returns a Future with the list of RecognitionResult of its utterances.
+    Recognizer options are given as keywords, as for RecognizerPool.
+    """
+
+    def __init__(self, model, workers=None, sample_rate=16000, chunk_size=8000, pin=False, **options):
+        self._chunk_size = chunk_size
+        self._tasks = queue.SimpleQueue()
+        self._shutdown = False
+        self._lock = threading.Lock()
+
+        cpus = sorted(os.sched_getaffinity(0)) if pin and hasattr(os, "sched_setaffinity") else None
+        # Built here so that errors reach the caller, a pool of one for every
+        # worker which only that worker's thread uses
+        pools = [RecognizerPool(model, sample_rate, 1, **options) for _ in range(workers or os.cpu_count() or 1)]
+        started = queue.SimpleQueue()
+        self._threads = []
+        for i, recognizers in enumerate(pools):
+            cpu = cpus[i % len(cpus)] if cpus else None
+            thread = threading.Thread(target=self._worker, args=(cpu, recognizers, started), daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        errors = [e for e in (started.get() for _ in self._threads) if e is not None]
+        if errors:
+            self.shutdown()
+            raise errors[0]
+
+    def submit(self, stream):
+        with self._lock:
+            if self._shutdown:
+                raise RuntimeError("Cannot submit after shutdown")
+            future = Future()
+            self._tasks.put((future, stream))
+        return future
+
+    def map(self, streams):
+        """Decodes all streams and returns their results in order."""
+        futures = [self.submit(stream) for stream in streams]
+        return [future.result() for future in futures]
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            if not self._shutdown:
+                self._shutdown = True
+                for _ in self._threads:
+                    self._tasks.put(None)
+        if wait:
+            for thread in self._threads:
+                thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+
+    def _worker(self, cpu, recognizers, started):
+        try:
+            if cpu is not None:
+                os.sched_setaffinity(0, {cpu})
+        except BaseException as e:
+            started.put(e)
+            return
+        started.put(None)
+        while True:
+            task = self._tasks.get()
+            if task is None:
+                break
+            future, stream = task
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                with recognizers.recognizer() as rec:
+                    result = self._decode(rec, stream)
+            except BaseException as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+
+    def _decode(self, rec, stream):
+        if isinstance(stream, (bytes, bytearray, memoryview)):
+            audio = memoryview(stream)
+            chunks = (audio[i:i + self._chunk_size] for i in range(0, len(audio), self._chunk_size))
+        elif hasattr(stream, "readframes"):
+            chunks = iter(lambda: stream.readframes(self._chunk_size // 2), b"")
+        else:
+            chunks = iter(lambda: stream.read(self._chunk_size), b"")
+        results = []
+        for data in chunks:
+            if rec.AcceptWaveform(data):
+                results.append(rec.ResultData())
+        results.append(rec.FinalResultData())
+        return results
+
 def SetLogLevel(level):
     return _c.vosk_set_log_level(level)
 
@@ -248,7 +969,39 @@ def GpuInit():
 def GpuThreadInit():
     _c.vosk_gpu_thread_init()
 
+FEATURE_BLOCK_MAGIC = b"VKFB"
+
+def write_feature_block(feats, path):
+    """Writes a (frames, dim) array of features in the binary block format.
+
+    The recognizer memory-maps these files instead of parsing text, see
+    KaldiRecognizer.SetExternalFeatures(). The block is written to a
+    temporary file which then replaces path, a mapping of the old file stays
+    valid.
+    """
+    import numpy as np
+    feats = np.ascontiguousarray(feats, dtype="<f4")
+    if feats.ndim != 2:
+        raise Exception("Features must be a 2-dimensional array, got shape %s" % (feats.shape,))
+    tmp = "%s.%d.%d.tmp" % (path, os.getpid(), threading.get_ident())
+    try:
+        with open(tmp, "wb") as f:
+            f.write(FEATURE_BLOCK_MAGIC)
+            f.write(struct.pack("<ii", feats.shape[0], feats.shape[1]))
+            f.write(feats.tobytes())
+        os.replace(tmp, path)
+    except:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
 class BatchModel:
+    """Model for decoding many streams together.
+
+    With CUDA the streams are decoded on the GPU, otherwise an engine thread
+    computes the ready chunks of all streams in one batched nnet3 computation.
+    Wait() returns when all audio given so far is processed.
+    """
 
     def __init__(self, model_path, *args):
         self._handle = _c.vosk_batch_model_new(model_path.encode('utf-8'))
@@ -0,0 +1,247 @@
+import mmap
+import queue
+import shutil
+import subprocess
+import threading
+import wave
+
+from pathlib import Path
+
+# Read without a subprocess
+WAVE_SUFFIXES = {".wav", ".wave"}
+RAW_SUFFIXES = {".pcm", ".raw"}
+# ffmpeg has to seek in these, they can't be piped to it
+SEEK_SUFFIXES = {".mp4", ".m4a", ".m4v", ".mov", ".3gp"}
+
+class Resampler:
+    """Streaming resampler working on numpy arrays.
+
+    When downsampling the signal is low-passed first with a windowed sinc
+    filter, then the output samples are interpolated linearly. The output
+    is aligned with the input, the delay of the filter is skipped.
+    """
+
+    TAPS = 64
+
+    def __init__(self, in_rate, out_rate):
+        import numpy as np
+        self._np = np
+        self._step = in_rate / out_rate
+        self._pos = 0.0
+        self._tail = np.zeros(0, dtype=np.float32)
+        self._taps = None
+        if out_rate < in_rate:
+            cutoff = 0.45 * out_rate / in_rate
+            n = np.arange(self.TAPS + 1) - self.TAPS // 2
+            taps = 2 * cutoff * np.sinc(2 * cutoff * n) * np.hamming(self.TAPS + 1)
+            self._taps = (taps / taps.sum()).astype(np.float32)
+            self._history = np.zeros(self.TAPS, dtype=np.float32)
+            # The filter delays the signal by TAPS // 2 samples, the output
+            # starts after them so that it lines up with the input
+            self._pos = float(self.TAPS // 2)
+
+    def process(self, samples, final=False):
+        np = self._np
+        if self._taps is not None:
+            if final:
+                # Push the delayed end of the signal out of the filter
+                samples = np.concatenate((samples, np.zeros(self.TAPS // 2, dtype=np.float32)))
+            padded = np.concatenate((self._history, samples))
+            self._history = padded[len(padded) - self.TAPS:]
+            samples = np.convolve(padded, self._taps, mode="valid")
+
+        buf = np.concatenate((self._tail, samples))
+        n = len(buf)
+        # Interpolating at a position needs the next sample unless it is the end
+        last = n - 1 if final else n - 2
+        count = int((last - self._pos) // self._step) + 1 if last >= self._pos else 0
+        positions = self._pos + self._step * np.arange(count)
+        index = positions.astype(np.int64)
+        frac = (positions - index).astype(np.float32)
+        out = buf[index] * (1 - frac) + buf[np.minimum(index + 1, n - 1)] * frac
+
+        next_pos = self._pos + self._step * count
+        drop = min(int(next_pos), n)
+        self._tail = buf[drop:]
+        self._pos = next_pos - drop
+        return out
+
+class WaveReader:
+    """Reads a PCM WAV file as 16-bit mono samples at sample_rate.
+
+    The file is memory-mapped. Other widths, channel counts and rates are
+    converted with numpy, a file which is already 16-bit mono at the right
+    rate is passed through as it is.
+    """
+
+    def __init__(self, path, sample_rate):
+        self._file = open(path, "rb")
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            self._wave = wave.open(self._map)
+            self._width = self._wave.getsampwidth()
+            self._channels = self._wave.getnchannels()
+            rate = self._wave.getframerate()
+            self._resampler = None
+            self._finished = False
+            self._convert = self._width != 2 or self._channels != 1 or rate != sample_rate
+            if self._convert:
+                import numpy as np
+                self._np = np
+                if rate != sample_rate:
+                    self._resampler = Resampler(rate, sample_rate)
+        except:
+            self._file.close()
+            raise
+
+    def read(self, size):
+        data = self._wave.readframes(max(size // 2, 1))
+        if not self._convert or self._finished:
+            return data
+        # The resampler keeps a few samples back, they come with the last
+        # read. Empty output means the end, so small reads go on until the
+        # resampler gives something
+        while True:
+            self._finished = len(data) == 0
+            out = self._to_pcm16(data, self._finished)
+            if len(out) > 0 or self._finished:
+                return out.tobytes()
+            data = self._wave.readframes(max(size // 2, 1))
+
+    def _to_pcm16(self, data, final):
+        np = self._np
+        if self._width == 1:
+            samples = (np.frombuffer(data, dtype=np.uint8).astype(np.float32) - 128) * 256
+        elif self._width == 2:
+            samples = np.frombuffer(data, dtype="<i2").astype(np.float32)
+        elif self._width == 3:
+            b = np.frombuffer(data, dtype=np.uint8).reshape(-1, 3).astype(np.int32)
+            samples = ((b[:, 0] << 8 | b[:, 1] << 16 | b[:, 2] << 24) >> 16).astype(np.float32)
+        else:
+            samples = np.frombuffer(data, dtype="<i4").astype(np.float32) / 65536
+        if self._channels > 1:
+            samples = samples.reshape(-1, self._channels).mean(axis=1)
+        if self._resampler is not None:
+            samples = self._resampler.process(samples, final)
+        return np.clip(np.rint(samples), -32768, 32767).astype("<i2")
+
+    def close(self):
+        self._wave.close()
+        self._map.close()
+        self._file.close()
+
+class FfmpegStream:
+    """Output of an ffmpeg process, the input file is written to its stdin
+    from a thread when the process reads from a pipe."""
+
+    def __init__(self, proc, path=None):
+        self._proc = proc
+        self._feeder = None
+        if path is not None:
+            self._feeder = threading.Thread(target=self._feed, args=(path,), daemon=True)
+            self._feeder.start()
+
+    def _feed(self, path):
+        try:
+            with open(path, "rb") as fh:
+                shutil.copyfileobj(fh, self._proc.stdin, 1 << 16)
+        except (BrokenPipeError, OSError):
+            pass
+        finally:
+            try:
+                self._proc.stdin.close()
+            except OSError:
+                pass
+
+    def read(self, size):
+        return self._proc.stdout.read(size)
+
+    def close(self):
+        self._proc.stdout.close()
+        self._proc.wait()
+        if self._feeder is not None:
+            self._feeder.join()
+
+class FfmpegPool:
+    """Keeps ffmpeg processes started ahead of time.
+
+    A waiting process reads its input from stdin, so it can take any file.
+    When one is taken a replacement is started in the background, so the
+    spawn time overlaps with the decoding of the current file. Formats
+    which ffmpeg has to seek in get a process of their own.
+    """
+
+    def __init__(self, sample_rate, size):
+        self._output = ["-ar", str(int(sample_rate)), "-ac", "1", "-f", "s16le", "-"]
+        self._size = size
+        self._idle = queue.Queue()
+        self._spawners = []
+        self._started = False
+        self._lock = threading.Lock()
+
+    def _spawn(self):
+        return subprocess.Popen(["ffmpeg", "-loglevel", "quiet", "-i", "pipe:0"] + self._output,
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    def _spawn_idle(self):
+        try:
+            self._idle.put(self._spawn())
+        except OSError:
+            pass
+
+    def open(self, path):
+        if Path(path).suffix.lower() in SEEK_SUFFIXES:
+            proc = subprocess.Popen(["ffmpeg", "-nostdin", "-loglevel", "quiet", "-i", str(path)] + self._output,
+                    stdout=subprocess.PIPE)
+            return FfmpegStream(proc)
+
+        with self._lock:
+            if not self._started:
+                self._started = True
+                for _ in range(self._size - 1):
+                    self._start_spawner()
+        try:
+            proc = self._idle.get_nowait()
+        except queue.Empty:
+            # The pending spawns fill the pool, another one would grow it
+            proc = self._spawn()
+        else:
+            with self._lock:
+                self._start_spawner()
+        return FfmpegStream(proc, path)
+
+    def _start_spawner(self):
+        self._spawners = [t for t in self._spawners if t.is_alive()]
+        thread = threading.Thread(target=self._spawn_idle, daemon=True)
+        thread.start()
+        self._spawners.append(thread)
+
+    def close(self):
+        with self._lock:
+            for thread in self._spawners:
+                thread.join()
+            self._spawners = []
+        while True:
+            try:
+                proc = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            proc.stdin.close()
+            proc.stdout.close()
+            proc.wait()
+
+def open_audio(path, sample_rate, ffmpeg):
+    """Returns a reader of 16-bit mono PCM at sample_rate for an audio file.
+
+    WAV and raw PCM files are read in-process, everything else (and WAV
+    files the wave module can't read) is decoded by the ffmpeg pool.
+    """
+    suffix = Path(path).suffix.lower()
+    if suffix in RAW_SUFFIXES:
+        return open(path, "rb")
+    if suffix in WAVE_SUFFIXES:
+        try:
+            return WaveReader(path, sample_rate)
+        except (wave.Error, EOFError, ImportError, ValueError):
+            pass
+    return ffmpeg.open(path)
@@ -41,6 +41,15 @@ parser.add_argument(
 parser.add_argument(
         "--tasks", "-ts", default=10, type=int,
         help="number of parallel recognition tasks")
+parser.add_argument(
+        "--workers", "-w", type=int,
+        help="number of worker processes, they share the model loaded before they start")
+parser.add_argument(
+        "--threads-per-worker", type=int,
+        help="number of files each worker process decodes at once (default: CPU count / workers)")
+parser.add_argument(
+        "--manifest", type=str,
+        help="SQLite file which records the state of every file, done files are skipped when the job is run again")
 parser.add_argument(
         "--log-level", default="INFO",
         help="logging level")
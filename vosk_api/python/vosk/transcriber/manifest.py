@@ -0,0 +1,91 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+from pathlib import Path
+
+class Manifest:
+    """Records the state of every file of a batch job in an SQLite file.
+
+    A file is done when its output was written. When the job runs again,
+    done files are skipped if their output still exists and the input did
+    not change: same size and modification time, or else the same hash.
+    """
+
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(str(path), check_same_thread=False)
+        self._db.execute("""CREATE TABLE IF NOT EXISTS files (
+                input TEXT PRIMARY KEY,
+                output TEXT,
+                size INTEGER,
+                mtime REAL,
+                hash TEXT,
+                status TEXT,
+                xrt REAL,
+                elapsed REAL,
+                updated REAL)""")
+        self._db.commit()
+
+    @staticmethod
+    def _key(input_file):
+        return str(Path(input_file).resolve())
+
+    @staticmethod
+    def _hash(input_file):
+        digest = hashlib.sha256()
+        with open(input_file, "rb") as fh:
+            for block in iter(lambda: fh.read(1 << 20), b""):
+                digest.update(block)
+        return digest.hexdigest()
+
+    def _is_done(self, row, input_file, output_file, stat):
+        output, size, mtime, hash_, status = row
+        if status != "done" or output != str(output_file):
+            return False
+        if output_file != "" and not Path(output_file).exists():
+            return False
+        if size == stat.st_size and mtime == stat.st_mtime:
+            return True
+        return size == stat.st_size and hash_ == self._hash(input_file)
+
+    def plan(self, task_list):
+        """Returns the tasks which are not done yet, largest input first, so
+        that the long files don't end up last on a single worker."""
+        todo = []
+        with self._lock:
+            for input_file, output_file in task_list:
+                try:
+                    stat = os.stat(input_file)
+                except OSError:
+                    continue
+                row = self._db.execute("SELECT output, size, mtime, hash, status FROM files WHERE input = ?",
+                        (self._key(input_file),)).fetchone()
+                if row is not None and self._is_done(row, input_file, output_file, stat):
+                    continue
+                self._db.execute("""INSERT INTO files (input, output, size, mtime, status, updated)
+                        VALUES (?, ?, ?, ?, 'pending', ?)
+                        ON CONFLICT(input) DO UPDATE SET output = excluded.output, size = excluded.size,
+                        mtime = excluded.mtime, hash = NULL, status = 'pending', xrt = NULL,
+                        elapsed = NULL, updated = excluded.updated""",
+                        (self._key(input_file), str(output_file), stat.st_size, stat.st_mtime, time.time()))
+                todo.append((stat.st_size, input_file, output_file))
+            self._db.commit()
+        todo.sort(key=lambda task: task[0], reverse=True)
+        return [(input_file, output_file) for _, input_file, output_file in todo]
+
+    def record(self, input_file, elapsed, xrt=None):
+        """Marks a file done, or failed if there is no xRT."""
+        status = "failed" if xrt is None else "done"
+        # Hashed while it is in the page cache from the decoding
+        hash_ = self._hash(input_file) if xrt is not None else None
+        with self._lock:
+            self._db.execute("UPDATE files SET hash = ?, status = ?, xrt = ?, elapsed = ?, updated = ? WHERE input = ?",
+                    (hash_, status, xrt, elapsed, time.time(), self._key(input_file)))
+            self._db.commit()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
@@ -1,19 +1,70 @@
 import json
 import logging
 import asyncio
-import websockets
-import srt
 import datetime
-import shlex
+import os
 import subprocess
+import threading
+import multiprocessing
 
-from vosk import KaldiRecognizer, Model
-from queue import Queue
+from vosk import Model, RecognizerPool
+from vosk.transcriber.audio import FfmpegPool, open_audio
+from vosk.transcriber.manifest import Manifest
+from queue import Queue, Empty
 from timeit import default_timer as timer
 from multiprocessing.dummy import Pool
 
 CHUNK_SIZE = 4000
+# Reads grow up to this size while no endpoint is found
+MAX_CHUNK_SIZE = 32000
 SAMPLE_RATE = 16000.0
+# Chunks sent to the server ahead of its replies
+SEND_WINDOW = 8
+
+class ConnectionPool:
+    """Websocket connections to the server opened ahead of time.
+
+    The server closes a connection at the end of a stream, so each one
+    carries a single file. When one is taken another is opened in the
+    background, as long as there are files left for it.
+    """
+
+    def __init__(self, uri, size, count):
+        self._uri = uri
+        self._idle = asyncio.Queue()
+        self._opening = set()
+        self._left = count
+        for _ in range(min(size, count)):
+            self._open()
+
+    def _open(self):
+        self._left -= 1
+        task = asyncio.create_task(self._connect())
+        self._opening.add(task)
+        task.add_done_callback(self._opening.discard)
+
+    async def _connect(self):
+        import websockets
+        try:
+            await self._idle.put(await websockets.connect(self._uri))
+        except Exception as e:
+            await self._idle.put(e)
+
+    async def acquire(self):
+        websocket = await self._idle.get()
+        if self._left > 0:
+            self._open()
+        if isinstance(websocket, Exception):
+            raise websocket
+        return websocket
+
+    async def close(self):
+        for task in list(self._opening):
+            task.cancel()
+        while not self._idle.empty():
+            websocket = self._idle.get_nowait()
+            if not isinstance(websocket, Exception):
+                await websocket.close()
 
 class Transcriber:
 
@@ -21,59 +72,85 @@ class Transcriber:
         self.model = Model(model_path=args.model, model_name=args.model_name, lang=args.lang)
         self.args = args
         self.queue = Queue()
+        self.manifest = Manifest(args.manifest) if args.manifest else None
 
     def recognize_stream(self, rec, stream):
         tot_samples = 0
         result = []
+        version = None
+        chunk_size = CHUNK_SIZE
 
         while True:
-            data = stream.stdout.read(CHUNK_SIZE)
+            data = stream.read(chunk_size)
 
             if len(data) == 0:
                 break
 
             tot_samples += len(data)
             if rec.AcceptWaveform(data):
-                jres = json.loads(rec.Result())
+                jres = rec.ResultData().dict()
                 logging.info(jres)
                 result.append(jres)
-            else:
-                jres = json.loads(rec.PartialResult())
-                if jres["partial"] != "":
-                    logging.info(jres)
-
-        jres = json.loads(rec.FinalResult())
+                chunk_size = CHUNK_SIZE
+                continue
+
+            chunk_size = min(chunk_size * 2, MAX_CHUNK_SIZE)
+            if logging.getLogger().isEnabledFor(logging.INFO):
+                res = rec.PartialResultData(since=version)
+                if res is not None:
+                    version = res.version
+                    if res.text != "":
+                        logging.info(res.dict())
+
+        jres = rec.FinalResultData().dict()
         result.append(jres)
 
         return result, tot_samples
 
-    async def recognize_stream_server(self, proc):
-        async with websockets.connect(self.args.server) as websocket:
-            tot_samples = 0
-            result = []
-
-            await websocket.send('{ "config" : { "sample_rate" : %f } }' % (SAMPLE_RATE))
+    async def recognize_stream_server(self, proc, websocket):
+        tot_samples = 0
+        result = []
+        # The server replies once to every message, the sender keeps up to
+        # SEND_WINDOW chunks on the way instead of waiting for each reply
+        window = asyncio.Semaphore(SEND_WINDOW)
+        num_sent = None
+
+        async def send():
+            nonlocal tot_samples, num_sent
+            count = 0
             while True:
                 data = await proc.stdout.read(CHUNK_SIZE)
-                tot_samples += len(data)
+                await window.acquire()
                 if len(data) == 0:
                     break
+                tot_samples += len(data)
                 await websocket.send(data)
+                count += 1
+            num_sent = count + 1
+            await websocket.send('{"eof" : 1}')
+
+        await websocket.send('{ "config" : { "sample_rate" : %f } }' % (SAMPLE_RATE))
+        sender = asyncio.create_task(send())
+        try:
+            num_received = 0
+            while num_sent is None or num_received < num_sent:
                 jres = json.loads(await websocket.recv())
+                num_received += 1
+                window.release()
                 logging.info(jres)
                 if not "partial" in jres:
                     result.append(jres)
-            await websocket.send('{"eof" : 1}')
-            jres = json.loads(await websocket.recv())
-            logging.info(jres)
-            result.append(jres)
-
-            return result, tot_samples
+        except:
+            sender.cancel()
+            raise
+        await sender
 
+        return result, tot_samples
 
     def format_result(self, result, words_per_line=7):
         processed_result = ""
         if self.args.output_type == "srt":
+            import srt
             subs = []
 
             for _, res in enumerate(result):
@@ -111,12 +188,6 @@ class Transcriber:
             processed_result = json.dumps(monologues)
         return processed_result
 
-    def resample_ffmpeg(self, infile):
-        cmd = shlex.split("ffmpeg -nostdin -loglevel quiet "
-                "-i \'{}\' -ar {} -ac 1 -f s16le -".format(str(infile), SAMPLE_RATE))
-        stream = subprocess.Popen(cmd, stdout=subprocess.PIPE)
-        return stream
-
     async def resample_ffmpeg_async(self, infile):
         cmd = "ffmpeg -nostdin -loglevel quiet "\
         "-i \'{}\' -ar {} -ac 1 -f s16le -".format(str(infile), SAMPLE_RATE)
@@ -132,70 +203,179 @@ class Transcriber:
             logging.info("Recognizing {}".format(input_file))
             start_time = timer()
             proc = await self.resample_ffmpeg_async(input_file)
-            result, tot_samples = await self.recognize_stream_server(proc)
+            try:
+                websocket = await self.connections.acquire()
+                async with websocket:
+                    result, tot_samples = await self.recognize_stream_server(proc, websocket)
+            except Exception as e:
+                logging.error("Failed to recognize {}: {}".format(input_file, e))
+                if proc.returncode is None:
+                    proc.kill()
+                result, tot_samples = [], 0
             await proc.wait()
 
-            # Bad input, continue
-            if tot_samples == 0:
-                 self.queue.task_done()
-                 continue
-
-            processed_result = self.format_result(result)
-            if output_file != "":
-                logging.info("File {} processing complete".format(output_file))
-                with open(output_file, "w", encoding="utf-8") as fh:
-                    fh.write(processed_result)
-            else:
-                print(processed_result)
-
-            elapsed = timer() - start_time
-            logging.info("Execution time: {:.3f} sec; "\
-                    "xRT {:.3f}".format(elapsed, float(elapsed) * (2 * SAMPLE_RATE) / tot_samples))
+            # Bad input, nothing to write
+            res = None
+            if tot_samples != 0:
+                res = self.format_result(result), tot_samples
+            self.finish((input_file, output_file), res, timer() - start_time)
             self.queue.task_done()
 
-    def pool_worker(self, inputdata):
+    def transcribe(self, inputdata):
+        """Decodes one file, returns the formatted result and the size of
+        the audio in bytes, or None if there is nothing to write."""
         logging.info("Recognizing {}".format(inputdata[0]))
-        start_time = timer()
 
         try:
-            stream = self.resample_ffmpeg(inputdata[0])
+            stream = open_audio(inputdata[0], SAMPLE_RATE, self.ffmpeg)
         except FileNotFoundError as e:
             print(e, "Missing FFMPEG, please install and try again")
-            return
+            return None
         except Exception as e:
             logging.info(e)
-            return
+            return None
 
-        rec = KaldiRecognizer(self.model, SAMPLE_RATE)
-        rec.SetWords(True)
-        result, tot_samples = self.recognize_stream(rec, stream)
+        try:
+            with self.recognizers.recognizer() as rec:
+                result, tot_samples = self.recognize_stream(rec, stream)
+        finally:
+            stream.close()
         if tot_samples == 0:
-            return
+            return None
 
-        processed_result = self.format_result(result)
-        if inputdata[1] != "":
-            logging.info("File {} processing complete".format(inputdata[1]))
-            with open(inputdata[1], "w", encoding="utf-8") as fh:
+        return self.format_result(result), tot_samples
+
+    def write_result(self, output_file, processed_result, tot_samples, elapsed):
+        if output_file != "":
+            logging.info("File {} processing complete".format(output_file))
+            with open(output_file, "w", encoding="utf-8") as fh:
                 fh.write(processed_result)
         else:
             print(processed_result)
 
-        elapsed = timer() - start_time
         logging.info("Execution time: {:.3f} sec; "\
                 "xRT {:.3f}".format(elapsed, float(elapsed) * (2 * SAMPLE_RATE) / tot_samples))
 
+    def finish(self, inputdata, res, elapsed):
+        xrt = None
+        if res is not None:
+            self.write_result(inputdata[1], *res, elapsed)
+            xrt = float(elapsed) * (2 * SAMPLE_RATE) / res[1]
+        if self.manifest is not None:
+            self.manifest.record(inputdata[0], elapsed, xrt)
+
+    def pool_worker(self, inputdata):
+        start_time = timer()
+        res = self.transcribe(inputdata)
+        self.finish(inputdata, res, timer() - start_time)
+
+    def process_worker(self, tasks, results, threads):
+        # Runs in a forked worker process, the model pages are shared with
+        # the parent and the other workers
+        self.recognizers = RecognizerPool(self.model, SAMPLE_RATE, threads, words=True)
+        self.ffmpeg = FfmpegPool(SAMPLE_RATE, threads)
+
+        def run():
+            while True:
+                task = tasks.get()
+                if task is None:
+                    break
+                index, inputdata = task
+                start_time = timer()
+                try:
+                    res = self.transcribe(inputdata)
+                except Exception as e:
+                    logging.error("Failed to recognize {}: {}".format(inputdata[0], e))
+                    res = None
+                results.put((index, res, timer() - start_time))
+
+        pool = [threading.Thread(target=run) for _ in range(threads)]
+        for thread in pool:
+            thread.start()
+        for thread in pool:
+            thread.join()
+        self.ffmpeg.close()
+
     async def process_task_list_server(self, task_list):
         for x in task_list:
             self.queue.put(x)
-        workers = [asyncio.create_task(self.server_worker()) for i in range(self.args.tasks)]
-        await asyncio.gather(*workers)
-
-    def process_task_list_pool(self, task_list):
-        with Pool() as pool:
-            pool.map(self.pool_worker, task_list)
+        self.connections = ConnectionPool(self.args.server, self.args.tasks, len(task_list))
+        try:
+            workers = [asyncio.create_task(self.server_worker()) for i in range(self.args.tasks)]
+            await asyncio.gather(*workers)
+        finally:
+            await self.connections.close()
+
+    def threads_per_worker(self, workers):
+        return self.args.threads_per_worker or max(1, (os.cpu_count() or 1) // workers)
+
+    def process_task_list_pool(self, task_list, workers=None):
+        if workers is None:
+            workers = self.threads_per_worker(1)
+        # One ready recognizer per worker thread, reused for all the files
+        self.recognizers = RecognizerPool(self.model, SAMPLE_RATE, workers, words=True)
+        # WAV files are read in-process, the rest goes to ffmpeg processes
+        # which are started before they are needed
+        self.ffmpeg = FfmpegPool(SAMPLE_RATE, workers)
+        try:
+            with Pool(workers) as pool:
+                pool.map(self.pool_worker, task_list)
+        finally:
+            self.ffmpeg.close()
+
+    def process_task_list_processes(self, task_list):
+        workers = self.args.workers
+        threads = self.threads_per_worker(workers)
+        # Forked after the model is loaded, so it is loaded once and shared
+        # copy-on-write by all the workers
+        ctx = multiprocessing.get_context("fork")
+        tasks = ctx.Queue()
+        results = ctx.Queue()
+        procs = [ctx.Process(target=self.process_worker, args=(tasks, results, threads), daemon=True)
+                for _ in range(workers)]
+        for proc in procs:
+            proc.start()
+
+        for task in enumerate(task_list):
+            tasks.put(task)
+        for _ in range(workers * threads):
+            tasks.put(None)
+
+        # Workers finish in any order, the results are written in the order
+        # of the task list
+        pending = {}
+        next_index = 0
+        while next_index < len(task_list):
+            try:
+                index, res, elapsed = results.get(timeout=1)
+            except Empty:
+                if not any(proc.is_alive() for proc in procs):
+                    raise Exception("Worker processes exited before all the files were processed")
+                continue
+            pending[index] = (res, elapsed)
+            while next_index in pending:
+                res, elapsed = pending.pop(next_index)
+                self.finish(task_list[next_index], res, elapsed)
+                next_index += 1
+
+        for proc in procs:
+            proc.join()
 
     def process_task_list(self, task_list):
-        if self.args.server is None:
-            self.process_task_list_pool(task_list)
-        else:
+        if self.manifest is not None:
+            total = len(task_list)
+            task_list = self.manifest.plan(task_list)
+            logging.info("{} of {} files are done already".format(total - len(task_list), total))
+
+        if self.args.server is not None:
             asyncio.run(self.process_task_list_server(task_list))
+        elif self.args.workers is not None and "fork" in multiprocessing.get_all_start_methods():
+            self.process_task_list_processes(task_list)
+        elif self.args.workers is not None:
+            # Same number of files at once, all in this process
+            threads = self.args.workers * self.threads_per_worker(self.args.workers)
+            logging.warning("Worker processes need fork, which this platform lacks, decoding with {} threads"
+                    .format(threads))
+            self.process_task_list_pool(task_list, threads)
+        else:
+            self.process_task_list_pool(task_list)
@@ -0,0 +1,72 @@
+// Compares the selection of the speaker frames in GetSpkVector with the
+// std::find loop it replaced: checks that both pick the same frames and
+// prints the time per utterance for growing lengths. The new time should
+// grow linearly with the length, the old one quadratically.
+//
+// Build: make bench_spk_frames (needs only spk_frames.h, not Kaldi)
+
+#include <algorithm>
+#include <chrono>
+#include <cstdio>
+#include <cstdlib>
+#include <random>
+
+#include "spk_frames.h"
+
+static void SelectSpkFramesOld(const std::vector<int32_t> &nonsilence_frames,
+                               int32_t num_frames, int32_t first_frame,
+                               std::vector<int32_t> *frames)
+{
+    frames->clear();
+    for (int32_t i = 0; i < num_frames; ++i) {
+        if (std::find(nonsilence_frames.begin(),
+                      nonsilence_frames.end(), i / 3) == nonsilence_frames.end()) {
+            continue;
+        }
+        frames->push_back(first_frame + i);
+    }
+}
+
+template <typename F>
+static double TimeMs(F f, int runs)
+{
+    auto start = std::chrono::steady_clock::now();
+    for (int i = 0; i < runs; i++) {
+        f();
+    }
+    std::chrono::duration<double, std::milli> elapsed = std::chrono::steady_clock::now() - start;
+    return elapsed.count() / runs;
+}
+
+int main()
+{
+    std::mt19937 rng(0);
+    std::vector<int32_t> frames_old, frames_new;
+
+    printf("seconds,frames,old_ms,new_ms\n");
+    for (int seconds = 5; seconds <= 160; seconds *= 2) {
+        // 100 feature frames per second, about 70% speech in runs
+        int32_t num_frames = seconds * 100, num_decoder_frames = (num_frames + 2) / 3;
+        std::vector<int32_t> nonsilence_frames;
+        bool speech = true;
+        for (int32_t f = 0; f < num_decoder_frames; f++) {
+            if (rng() % 20 == 0) {
+                speech = rng() % 10 < 7;
+            }
+            if (speech) {
+                nonsilence_frames.push_back(f);
+            }
+        }
+
+        int runs = std::max(1, 3200 / seconds);
+        double old_ms = TimeMs([&] { SelectSpkFramesOld(nonsilence_frames, num_frames, 30, &frames_old); }, runs);
+        double new_ms = TimeMs([&] { SelectSpkFrames(nonsilence_frames, num_frames, 3, 30, &frames_new); }, runs);
+
+        if (frames_old != frames_new) {
+            fprintf(stderr, "Different frames selected for %d seconds\n", seconds);
+            return 1;
+        }
+        printf("%d,%d,%.3f,%.4f\n", seconds, num_frames, old_ms, new_ms);
+    }
+    return 0;
+}
@@ -0,0 +1,150 @@
+// Copyright 2019-2020 Alpha Cephei Inc.
+//
+// Licensed under the Apache License, Version 2.0 (the "License");
+// you may not use this file except in compliance with the License.
+// You may obtain a copy of the License at
+//
+//       http://www.apache.org/licenses/LICENSE-2.0
+//
+// Unless required by applicable law or agreed to in writing, software
+// distributed under the License is distributed on an "AS IS" BASIS,
+// WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+// See the License for the specific language governing permissions and
+// limitations under the License.
+
+#include "cpu_batch_model.h"
+#include "cpu_batch_recognizer.h"
+
+#include <algorithm>
+
+using namespace kaldi::nnet3;
+
+CpuBatchModel::CpuBatchModel(const char *model_path) {
+
+    model_ = new Model(model_path);
+
+    if (!model_->hclg_fst_) {
+        model_->Unref();
+        KALDI_ERR << "Batch recognition needs a model with graph/HCLG.fst";
+    }
+
+    const Nnet &nnet = model_->nnet_->GetNnet();
+    ComputeSimpleNnetContext(nnet, &nnet_left_context_, &nnet_right_context_);
+
+    // Same chunk size as the CUDA pipeline, the chunks are computed with
+    // their context, so longer chunks waste less on the context frames
+    compute_opts_.acoustic_scale = model_->decodable_opts_.acoustic_scale;
+    compute_opts_.frame_subsampling_factor = model_->decodable_opts_.frame_subsampling_factor;
+    compute_opts_.frames_per_chunk = std::max(51, (nnet_right_context_ + 3 - nnet_right_context_ % 3));
+    compute_opts_.minibatch_size = 32;
+    compute_opts_.edge_minibatch_size = 32;
+
+    computer_ = new NnetBatchComputer(compute_opts_, nnet, model_->nnet_->Priors());
+
+    engine_ = std::thread(&CpuBatchModel::RunEngine, this);
+}
+
+CpuBatchModel::~CpuBatchModel() {
+    {
+        std::lock_guard<std::mutex> lock(work_mutex_);
+        stop_ = true;
+    }
+    work_cond_.notify_all();
+    engine_.join();
+
+    delete computer_;
+    model_->Unref();
+}
+
+void CpuBatchModel::AddRecognizer(CpuBatchRecognizer *recognizer)
+{
+    std::lock_guard<std::mutex> lock(mutex_);
+    recognizers_.push_back(recognizer);
+}
+
+void CpuBatchModel::RemoveRecognizer(CpuBatchRecognizer *recognizer)
+{
+    // Waits for the round in progress, the engine may be using the recognizer
+    std::lock_guard<std::mutex> lock(mutex_);
+    recognizers_.erase(std::remove(recognizers_.begin(), recognizers_.end(), recognizer),
+                       recognizers_.end());
+}
+
+void CpuBatchModel::Notify()
+{
+    {
+        std::lock_guard<std::mutex> lock(work_mutex_);
+        has_work_ = true;
+    }
+    work_cond_.notify_one();
+}
+
+void CpuBatchModel::WaitForCompletion()
+{
+    std::unique_lock<std::mutex> lock(work_mutex_);
+    idle_cond_.wait(lock, [this] { return !has_work_ && !busy_; });
+}
+
+void CpuBatchModel::RunEngine()
+{
+    std::unique_lock<std::mutex> lock(work_mutex_);
+    while (true) {
+        work_cond_.wait(lock, [this] { return has_work_ || stop_; });
+        if (stop_) {
+            break;
+        }
+        has_work_ = false;
+        busy_ = true;
+        lock.unlock();
+
+        while (ProcessRound()) {
+        }
+
+        lock.lock();
+        busy_ = false;
+        if (!has_work_) {
+            idle_cond_.notify_all();
+        }
+    }
+}
+
+// Takes the ready chunks of all streams, computes them in batches and
+// decodes the outputs. Returns false if no stream had anything to do.
+bool CpuBatchModel::ProcessRound()
+{
+    std::lock_guard<std::mutex> lock(mutex_);
+
+    // A failure only ends the streams it belongs to, the errors are logged
+    // by Kaldi already
+    bool queued = false;
+    for (size_t i = 0; i < recognizers_.size(); i++) {
+        try {
+            queued |= recognizers_[i]->QueueChunks(computer_);
+        } catch (...) {
+            recognizers_[i]->Fail();
+            queued = true;
+        }
+    }
+
+    // A minibatch which fails is taken out of the queue all the same, its
+    // tasks get no output and DecodeChunks() fails their streams
+    while (true) {
+        try {
+            if (!computer_->Compute(true)) {
+                break;
+            }
+        } catch (...) {
+        }
+    }
+
+    bool decoded = false;
+    for (size_t i = 0; i < recognizers_.size(); i++) {
+        try {
+            decoded |= recognizers_[i]->DecodeChunks();
+        } catch (...) {
+            recognizers_[i]->Fail();
+            decoded = true;
+        }
+    }
+    return queued || decoded;
+}
@@ -0,0 +1,74 @@
+// Copyright 2019 Alpha Cephei Inc.
+//
+// Licensed under the Apache License, Version 2.0 (the "License");
+// you may not use this file except in compliance with the License.
+// You may obtain a copy of the License at
+//
+//       http://www.apache.org/licenses/LICENSE-2.0
+//
+// Unless required by applicable law or agreed to in writing, software
+// distributed under the License is distributed on an "AS IS" BASIS,
+// WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+// See the License for the specific language governing permissions and
+// limitations under the License.
+
+#ifndef VOSK_CPU_BATCH_MODEL_H
+#define VOSK_CPU_BATCH_MODEL_H
+
+#include "base/kaldi-common.h"
+#include "util/common-utils.h"
+#include "nnet3/nnet-batch-compute.h"
+
+#include <condition_variable>
+#include <mutex>
+#include <thread>
+
+#include "model.h"
+
+using namespace kaldi;
+
+class CpuBatchRecognizer;
+
+// Batch model without CUDA. One engine thread serves all recognizers of
+// the model: in every round it takes the chunks which are ready in all
+// streams, computes them with a single nnet3 computation (the chunks are
+// stacked, so every layer is one GEMM over the batch) and then passes
+// the outputs to the decoders of the streams.
+class CpuBatchModel {
+    public:
+        CpuBatchModel(const char *model_path);
+        ~CpuBatchModel();
+
+        void WaitForCompletion();
+
+    private:
+        friend class CpuBatchRecognizer;
+
+        void AddRecognizer(CpuBatchRecognizer *recognizer);
+        void RemoveRecognizer(CpuBatchRecognizer *recognizer);
+        void Notify();
+        void RunEngine();
+        bool ProcessRound();
+
+        Model *model_ = nullptr;
+
+        nnet3::NnetBatchComputerOptions compute_opts_;
+        nnet3::NnetBatchComputer *computer_ = nullptr;
+        int32 nnet_left_context_;
+        int32 nnet_right_context_;
+
+        // Guards recognizers_, held by the engine for a whole round
+        std::mutex mutex_;
+        std::vector<CpuBatchRecognizer *> recognizers_;
+
+        // Wakes up the engine and tells WaitForCompletion() when it is idle
+        std::mutex work_mutex_;
+        std::condition_variable work_cond_;
+        std::condition_variable idle_cond_;
+        bool has_work_ = false;
+        bool busy_ = false;
+        bool stop_ = false;
+        std::thread engine_;
+};
+
+#endif /* VOSK_CPU_BATCH_MODEL_H */
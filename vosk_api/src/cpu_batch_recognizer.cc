@@ -0,0 +1,357 @@
+// Copyright 2019-2020 Alpha Cephei Inc.
+//
+// Licensed under the Apache License, Version 2.0 (the "License");
+// you may not use this file except in compliance with the License.
+// You may obtain a copy of the License at
+//
+//       http://www.apache.org/licenses/LICENSE-2.0
+//
+// Unless required by applicable law or agreed to in writing, software
+// distributed under the License is distributed on an "AS IS" BASIS,
+// WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+// See the License for the specific language governing permissions and
+// limitations under the License.
+
+#include "cpu_batch_recognizer.h"
+
+#include "fstext/fstext-utils.h"
+#include "lat/sausages.h"
+#include "lat/word-align-lattice.h"
+#include "online2/online-endpoint.h"
+#include "json.h"
+
+using namespace kaldi::nnet3;
+
+CpuBatchRecognizer::CpuBatchRecognizer(CpuBatchModel *model, float sample_frequency) :
+        model_(model), sample_frequency_(sample_frequency), nlsml_(false),
+        input_finished_(false), next_chunk_frame_(0), segment_start_frame_(0),
+        features_finished_(false), stream_finished_(false) {
+
+    Model *m = model_->model_;
+    feature_pipeline_ = new OnlineNnet2FeaturePipeline(m->feature_info_);
+    decoder_ = new LatticeIncrementalOnlineDecoder(*m->hclg_fst_, *m->trans_model_,
+                                                   m->nnet3_decoding_config_);
+    decodable_ = new DecodableMatrixMappedOffset(*m->trans_model_);
+    decoder_->InitDecoding();
+
+    model_->AddRecognizer(this);
+}
+
+CpuBatchRecognizer::~CpuBatchRecognizer() {
+    model_->RemoveRecognizer(this);
+
+    DropTasks();
+    delete decodable_;
+    delete decoder_;
+    delete feature_pipeline_;
+}
+
+void CpuBatchRecognizer::SetNLSML(bool nlsml)
+{
+    nlsml_ = nlsml;
+}
+
+void CpuBatchRecognizer::AcceptWaveform(const char *data, int len)
+{
+    {
+        std::lock_guard<std::mutex> lock(input_mutex_);
+        if (failed_) {
+            return;
+        }
+        int32 end = input_.Dim();
+        input_.Resize(end + len / 2, kCopyData);
+        for (int i = 0; i < len / 2; i++)
+            input_(end + i) = *(((short *)data) + i);
+    }
+    model_->Notify();
+}
+
+void CpuBatchRecognizer::FinishStream()
+{
+    {
+        std::lock_guard<std::mutex> lock(input_mutex_);
+        input_finished_ = true;
+    }
+    model_->Notify();
+}
+
+// Feeds the queued audio to the feature pipeline and queues every chunk
+// which has all its frames, including the right context, in the computer.
+bool CpuBatchRecognizer::QueueChunks(NnetBatchComputer *computer)
+{
+    if (stream_finished_) {
+        return false;
+    }
+
+    Vector<BaseFloat> wave;
+    bool finished;
+    {
+        std::lock_guard<std::mutex> lock(input_mutex_);
+        wave.Swap(&input_);
+        finished = input_finished_;
+    }
+    if (wave.Dim() > 0) {
+        feature_pipeline_->AcceptWaveform(sample_frequency_, wave);
+    }
+    if (finished && !features_finished_) {
+        feature_pipeline_->InputFinished();
+        features_finished_ = true;
+    }
+
+    const NnetBatchComputerOptions &opts = model_->compute_opts_;
+    int32 left = model_->nnet_left_context_,
+          right = model_->nnet_right_context_,
+          f = opts.frame_subsampling_factor,
+          chunk = opts.frames_per_chunk / f;
+
+    OnlineFeatureInterface *input = feature_pipeline_->InputFeature();
+    OnlineIvectorFeature *ivector = feature_pipeline_->IvectorFeature();
+    int32 num_frames = input->NumFramesReady(),
+          num_output_frames = (num_frames + f - 1) / f;
+
+    bool queued = false;
+    while (true) {
+        int32 begin = next_chunk_frame_, end = begin + chunk;
+        if (features_finished_ ? begin >= num_output_frames :
+                                 end * f + right > num_frames) {
+            break;
+        }
+
+        // All chunks have the same shape, frames beyond the edges of the
+        // stream are repeated, so they are all computed together
+        NnetInferenceTask *task = new NnetInferenceTask();
+        task->first_input_t = -left;
+        task->output_t_stride = f;
+        task->num_output_frames = chunk;
+        task->num_initial_unused_output_frames = 0;
+        task->num_used_output_frames = std::min(chunk, num_output_frames - begin);
+        task->first_used_output_frame_index = begin;
+        task->is_edge = false;
+        task->is_irregular = false;
+        task->priority = 0.0;
+        task->output_to_cpu = true;
+
+        std::vector<int32> frames;
+        for (int32 t = begin * f - left; t < end * f + right; t++) {
+            frames.push_back(std::max(0, std::min(t, num_frames - 1)));
+        }
+        Matrix<BaseFloat> feats(frames.size(), input->Dim(), kUndefined);
+        input->GetFrames(frames, &feats);
+        task->input.Swap(&feats);
+
+        if (ivector) {
+            Vector<BaseFloat> ivec(ivector->Dim(), kUndefined);
+            ivector->GetFrame(std::min(end * f, num_frames) - 1, &ivec);
+            task->ivector.Resize(ivec.Dim(), kUndefined);
+            task->ivector.CopyFromVec(ivec);
+        }
+
+        computer->AcceptTask(task);
+        tasks_.push_back(task);
+        next_chunk_frame_ = end;
+        queued = true;
+    }
+    return queued;
+}
+
+void CpuBatchRecognizer::DropTasks()
+{
+    for (size_t i = 0; i < tasks_.size(); i++) {
+        delete tasks_[i];
+    }
+    tasks_.clear();
+}
+
+// Ends the stream after an error, called by the engine thread once the
+// computer has no tasks of the stream any more. The caller gets an error
+// result instead of waiting for results which never come.
+void CpuBatchRecognizer::Fail()
+{
+    if (failed_) {
+        return;
+    }
+    stream_finished_ = true;
+    {
+        std::lock_guard<std::mutex> lock(input_mutex_);
+        failed_ = true;
+        input_.Resize(0);
+    }
+
+    json::JSON obj;
+    obj["error"] = "Recognition failed";
+    obj["text"] = "";
+    std::lock_guard<std::mutex> lock(results_mutex_);
+    results_.push(obj.dump());
+}
+
+// Decodes the computed chunks, a segment ends at an endpoint or at the
+// end of the stream.
+bool CpuBatchRecognizer::DecodeChunks()
+{
+    if (stream_finished_) {
+        // Chunks queued before a failure
+        DropTasks();
+        return false;
+    }
+
+    Model *m = model_->model_;
+    BaseFloat frame_shift = feature_pipeline_->FrameShiftInSeconds() *
+                            model_->compute_opts_.frame_subsampling_factor;
+    bool decoded = !tasks_.empty();
+
+    for (size_t i = 0; i < tasks_.size(); i++) {
+        NnetInferenceTask *task = tasks_[i];
+        if (task->output_cpu.NumRows() < task->num_used_output_frames) {
+            // The minibatch of the chunk failed
+            DropTasks();
+            Fail();
+            return true;
+        }
+        Matrix<BaseFloat> loglikes(task->output_cpu.RowRange(0, task->num_used_output_frames));
+        tasks_[i] = nullptr;
+        delete task;
+
+        // All the frames we passed before are decoded already
+        decodable_->AcceptLoglikes(&loglikes,
+                                   decodable_->NumFramesReady() - decodable_->FirstAvailableFrame());
+        decoder_->AdvanceDecoding(decodable_);
+
+        if (EndpointDetected(m->endpoint_config_, *m->trans_model_, frame_shift, *decoder_)) {
+            decoder_->FinalizeDecoding();
+            CompactLattice clat = decoder_->GetLattice(decoder_->NumFramesDecoded(), true);
+            PushLattice(clat, segment_start_frame_ * frame_shift);
+            StartSegment();
+        }
+    }
+    tasks_.clear();
+
+    if (features_finished_ &&
+        next_chunk_frame_ * model_->compute_opts_.frame_subsampling_factor >=
+        feature_pipeline_->InputFeature()->NumFramesReady()) {
+        decodable_->InputIsFinished();
+        decoder_->AdvanceDecoding(decodable_);
+        if (decoder_->NumFramesDecoded() > 0) {
+            decoder_->FinalizeDecoding();
+            CompactLattice clat = decoder_->GetLattice(decoder_->NumFramesDecoded(), true);
+            PushLattice(clat, segment_start_frame_ * frame_shift);
+        }
+        stream_finished_ = true;
+        decoded = true;
+    }
+    return decoded;
+}
+
+void CpuBatchRecognizer::StartSegment()
+{
+    segment_start_frame_ += decoder_->NumFramesDecoded();
+    delete decodable_;
+    decodable_ = new DecodableMatrixMappedOffset(*model_->model_->trans_model_);
+    decoder_->InitDecoding();
+}
+
+void CpuBatchRecognizer::PushLattice(CompactLattice &clat, BaseFloat offset)
+{
+    Model *m = model_->model_;
+    BaseFloat frame_shift = feature_pipeline_->FrameShiftInSeconds() *
+                            model_->compute_opts_.frame_subsampling_factor;
+
+    if (clat.Start() == fst::kNoStateId) {
+        KALDI_WARN << "Empty lattice for the segment";
+        return;
+    }
+
+    fst::ScaleLattice(fst::GraphLatticeScale(0.9), &clat);
+
+    CompactLattice aligned_lat;
+    if (m->winfo_) {
+        WordAlignLattice(clat, *m->trans_model_, *m->winfo_, 0, &aligned_lat);
+    } else {
+        aligned_lat = clat;
+    }
+
+    MinimumBayesRisk mbr(aligned_lat);
+    const vector<BaseFloat> &conf = mbr.GetOneBestConfidences();
+    const vector<int32> &words = mbr.GetOneBest();
+    const vector<pair<BaseFloat, BaseFloat> > &times =
+          mbr.GetOneBestTimes();
+
+    int size = words.size();
+    string result;
+
+    if (nlsml_) {
+
+        std::stringstream ss;
+        std::stringstream text;
+        ss << "<?xml version=\"1.0\"?>\n";
+        ss << "<result grammar=\"default\">\n";
+        BaseFloat confidence = 0.0;
+        for (int i = 0; i < size; i++) {
+            if (i) {
+                text << " ";
+            }
+            confidence += conf[i];
+            text << m->word_syms_->Find(words[i]);
+        }
+        confidence /= size;
+
+        ss << "<interpretation grammar=\"default\" confidence=\"" << confidence << "\">\n";
+        ss << "<input mode=\"speech\">" << text.str() << "</input>\n";
+        ss << "<instance>" << text.str() << "</instance>\n";
+        ss << "</interpretation>\n";
+        ss << "</result>\n";
+
+        result = ss.str();
+
+    } else {
+        json::JSON obj;
+        stringstream text;
+
+        // Create JSON object
+        for (int i = 0; i < size; i++) {
+            json::JSON word;
+
+            word["word"] = m->word_syms_->Find(words[i]);
+            word["start"] = times[i].first * frame_shift + offset;
+            word["end"] = times[i].second * frame_shift + offset;
+            word["conf"] = conf[i];
+            obj["result"].append(word);
+
+            if (i) {
+                text << " ";
+            }
+            text << m->word_syms_->Find(words[i]);
+        }
+        obj["text"] = text.str();
+
+        result = obj.dump();
+    }
+
+    std::lock_guard<std::mutex> lock(results_mutex_);
+    results_.push(result);
+}
+
+const char* CpuBatchRecognizer::FrontResult()
+{
+    std::lock_guard<std::mutex> lock(results_mutex_);
+    if (results_.empty()) {
+        return "";
+    }
+    return results_.front().c_str();
+}
+
+void CpuBatchRecognizer::Pop()
+{
+    std::lock_guard<std::mutex> lock(results_mutex_);
+    if (results_.empty()) {
+        return;
+    }
+    results_.pop();
+}
+
+int CpuBatchRecognizer::GetNumPendingChunks()
+{
+    std::lock_guard<std::mutex> lock(input_mutex_);
+    int samples_per_chunk = model_->compute_opts_.frames_per_chunk *
+                            sample_frequency_ / 100;
+    return (input_.Dim() + samples_per_chunk - 1) / samples_per_chunk;
+}
@@ -0,0 +1,81 @@
+// Copyright 2019 Alpha Cephei Inc.
+//
+// Licensed under the Apache License, Version 2.0 (the "License");
+// you may not use this file except in compliance with the License.
+// You may obtain a copy of the License at
+//
+//       http://www.apache.org/licenses/LICENSE-2.0
+//
+// Unless required by applicable law or agreed to in writing, software
+// distributed under the License is distributed on an "AS IS" BASIS,
+// WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+// See the License for the specific language governing permissions and
+// limitations under the License.
+
+#ifndef VOSK_CPU_BATCH_RECOGNIZER_H
+#define VOSK_CPU_BATCH_RECOGNIZER_H
+
+#include "base/kaldi-common.h"
+#include "util/common-utils.h"
+#include "decoder/decodable-matrix.h"
+#include "decoder/lattice-incremental-online-decoder.h"
+#include "online2/online-nnet2-feature-pipeline.h"
+
+#include <queue>
+
+#include "cpu_batch_model.h"
+
+using namespace kaldi;
+
+// One stream of a CpuBatchModel, the same interface as BatchRecognizer.
+// AcceptWaveform() only queues the audio, the engine thread of the model
+// extracts features, sends the chunks to the batched computation and
+// decodes the outputs.
+class CpuBatchRecognizer {
+    public:
+        CpuBatchRecognizer(CpuBatchModel *model, float sample_frequency);
+        ~CpuBatchRecognizer();
+
+        void AcceptWaveform(const char *data, int len);
+        int GetNumPendingChunks();
+        const char *FrontResult();
+        void Pop();
+        void FinishStream();
+        void SetNLSML(bool nlsml);
+
+    private:
+        friend class CpuBatchModel;
+
+        // Called by the engine thread
+        bool QueueChunks(nnet3::NnetBatchComputer *computer);
+        bool DecodeChunks();
+        void StartSegment();
+        void PushLattice(CompactLattice &clat, BaseFloat offset);
+        void DropTasks();
+        void Fail();
+
+        CpuBatchModel *model_;
+        float sample_frequency_;
+        bool nlsml_;
+
+        // Audio from the caller which the engine did not take yet
+        std::mutex input_mutex_;
+        Vector<BaseFloat> input_;
+        bool input_finished_;
+        bool failed_ = false;  // the engine ended the stream after an error
+
+        // State of the engine thread
+        OnlineNnet2FeaturePipeline *feature_pipeline_ = nullptr;
+        LatticeIncrementalOnlineDecoder *decoder_ = nullptr;
+        DecodableMatrixMappedOffset *decodable_ = nullptr;
+        std::vector<nnet3::NnetInferenceTask *> tasks_;
+        int32 next_chunk_frame_;     // first output frame of the next chunk
+        int32 segment_start_frame_;  // output frames before the current segment
+        bool features_finished_;
+        bool stream_finished_;
+
+        std::mutex results_mutex_;
+        std::queue<std::string> results_;
+};
+
+#endif /* VOSK_CPU_BATCH_RECOGNIZER_H */
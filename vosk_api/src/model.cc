@@ -17,6 +17,8 @@
 // For details of possible model layout see doc/models.md section model-structure
 
 #include "model.h"
+#include "language_model.h"
+#include "json.h"
 
 #include <sys/stat.h>
 #include <fst/fst.h>
@@ -193,6 +195,10 @@ void Model::ConfigureV2()
     nnet3_decoding_config_.Register(&po);
     endpoint_config_.Register(&po);
     decodable_opts_.Register(&po);
+    po.Register("external-features", &external_features_rxfilename_,
+                "File with features computed outside of Vosk which are used instead of the features of the audio");
+    po.Register("grammar-cache-size", &grammar_cache_size_,
+                "Number of grammar FSTs kept for reuse by recognizers with the same grammar");
     po.ReadConfigFile(model_path_str_ + "/conf/model.conf");
 
 
@@ -391,3 +397,135 @@ Model::~Model() {
     delete g_fst_;
     delete graph_lm_fst_;
 }
+
+// Reads a JSON list of phrases as word id sentences, $name tokens become
+// class labels and words missing in the vocabulary are dropped. Returns
+// false if it is not a list.
+bool Model::ParseGrammar(const char *grammar, vector<vector<int32> > *sentences)
+{
+    json::JSON obj;
+    obj = json::JSON::Load(grammar);
+
+    if (obj.length() <= 0) {
+        KALDI_WARN << "Expecting array of strings, got: '" << grammar << "'";
+        return false;
+    }
+
+    KALDI_LOG << obj;
+
+    for (int i = 0; i < obj.length(); i++) {
+        bool ok;
+        string line = obj[i].ToString(ok);
+        if (!ok) {
+            KALDI_ERR << "Expecting array of strings, got: '" << obj << "'";
+        }
+
+        std::vector<int32> sentence;
+        stringstream ss(line);
+        string token;
+        while (getline(ss, token, ' ')) {
+            int32 id = word_syms_->Find(token);
+            if (id == kNoSymbol && token.size() > 1 && token[0] == '$') {
+                id = GrammarClassLabel(token.substr(1), true);
+            }
+            if (id == kNoSymbol) {
+                KALDI_WARN << "Ignoring word missing in vocabulary: '" << token << "'";
+            } else {
+                sentence.push_back(id);
+            }
+        }
+        sentences->push_back(sentence);
+    }
+    return true;
+}
+
+std::shared_ptr<const fst::StdVectorFst> Model::GetGrammarFst(const char *grammar)
+{
+    vector<vector<int32> > sentences;
+    if (!ParseGrammar(grammar, &sentences)) {
+        return nullptr;
+    }
+
+    // The estimated LM doesn't depend on the order of the phrases
+    std::sort(sentences.begin(), sentences.end());
+    string key;
+    for (size_t i = 0; i < sentences.size(); i++) {
+        for (size_t j = 0; j < sentences[i].size(); j++) {
+            key += std::to_string(sentences[i][j]) + " ";
+        }
+        key += "\n";
+    }
+
+    {
+        std::lock_guard<std::mutex> lock(grammar_cache_mutex_);
+        auto it = grammar_cache_index_.find(key);
+        if (it != grammar_cache_index_.end()) {
+            grammar_cache_.splice(grammar_cache_.begin(), grammar_cache_, it->second);
+            return it->second->second;
+        }
+    }
+
+    // Built without the lock, other grammars can be served meanwhile
+    LanguageModelOptions opts;
+
+    opts.ngram_order = 2;
+    opts.discount = 0.5;
+
+    LanguageModelEstimator estimator(opts);
+    for (size_t i = 0; i < sentences.size(); i++) {
+        estimator.AddCounts(sentences[i]);
+    }
+    fst::StdVectorFst *g_fst = new fst::StdVectorFst();
+    estimator.Estimate(g_fst);
+    std::shared_ptr<const fst::StdVectorFst> result(g_fst);
+
+    std::lock_guard<std::mutex> lock(grammar_cache_mutex_);
+    auto it = grammar_cache_index_.find(key);
+    if (it != grammar_cache_index_.end()) {
+        // Another recognizer built the same grammar first
+        grammar_cache_.splice(grammar_cache_.begin(), grammar_cache_, it->second);
+        return it->second->second;
+    }
+    if (grammar_cache_size_ > 0) {
+        grammar_cache_.push_front(make_pair(key, result));
+        grammar_cache_index_[key] = grammar_cache_.begin();
+        while (grammar_cache_.size() > static_cast<size_t>(grammar_cache_size_)) {
+            grammar_cache_index_.erase(grammar_cache_.back().first);
+            grammar_cache_.pop_back();
+        }
+    }
+    return result;
+}
+
+bool Model::PreloadGrammar(const char *grammar)
+{
+    if (!hcl_fst_) {
+        KALDI_WARN << "Runtime graphs are not supported by this model";
+        return false;
+    }
+    return GetGrammarFst(grammar) != nullptr;
+}
+
+int32 Model::GrammarClassLabel(const string &name, bool create)
+{
+    std::lock_guard<std::mutex> lock(grammar_cache_mutex_);
+    auto it = grammar_classes_.find(name);
+    if (it != grammar_classes_.end()) {
+        return it->second;
+    }
+    if (!create) {
+        return -1;
+    }
+    if (grammar_class_base_ < 0) {
+        grammar_class_base_ = word_syms_->AvailableKey();
+    }
+    int32 label = grammar_class_base_ + grammar_classes_.size();
+    grammar_classes_[name] = label;
+    return label;
+}
+
+int32 Model::GrammarClassBase()
+{
+    std::lock_guard<std::mutex> lock(grammar_cache_mutex_);
+    return grammar_class_base_;
+}
@@ -32,11 +32,17 @@
 #include "rnnlm/rnnlm-utils.h"
 #include "rnnlm/rnnlm-lattice-rescoring.h"
 #include <atomic>
+#include <list>
+#include <memory>
+#include <mutex>
+#include <unordered_map>
 
 using namespace kaldi;
 using namespace std;
 
 class Recognizer;
+class CpuBatchModel;
+class CpuBatchRecognizer;
 
 class Model {
 
@@ -46,13 +52,29 @@ public:
     void Unref();
     int FindWord(const char *word);
 
+    // Grammar FST of a JSON list of phrases. The FSTs are cached by the
+    // word ids of the phrases, so recognizers with the same grammar share
+    // one FST which is built once. Returns nullptr if the grammar is invalid
+    std::shared_ptr<const fst::StdVectorFst> GetGrammarFst(const char *grammar);
+    bool PreloadGrammar(const char *grammar);
+
+    // Phrases of a grammar can refer to classes with $name, a class gets a
+    // label above the vocabulary the first time it appears. Returns -1 for
+    // an unknown class if create is false
+    int32 GrammarClassLabel(const string &name, bool create);
+    // Lowest class label, -1 if no grammar used classes
+    int32 GrammarClassBase();
+
 protected:
     ~Model();
     void ConfigureV1();
     void ConfigureV2();
     void ReadDataFiles();
+    bool ParseGrammar(const char *grammar, vector<vector<int32> > *sentences);
 
     friend class Recognizer;
+    friend class CpuBatchModel;
+    friend class CpuBatchRecognizer;
 
     string model_path_str_;
     string nnet3_rxfilename_;
@@ -74,6 +96,7 @@ protected:
     string rnnlm_feat_embedding_rxfilename_;
     string rnnlm_config_rxfilename_;
     string rnnlm_lm_rxfilename_;
+    string external_features_rxfilename_;
 
     kaldi::OnlineEndpointConfig endpoint_config_;
     kaldi::LatticeIncrementalDecoderConfig nnet3_decoding_config_;
@@ -100,6 +123,16 @@ protected:
     kaldi::nnet3::Nnet rnnlm;
     bool rnnlm_enabled_ = false;
 
+    // Grammar FSTs, most recently used first. Recognizers hold their own
+    // reference, so eviction never frees an FST in use
+    typedef std::list<pair<string, std::shared_ptr<const fst::StdVectorFst> > > GrammarCache;
+    int32 grammar_cache_size_ = 32;
+    std::mutex grammar_cache_mutex_;
+    GrammarCache grammar_cache_;
+    std::unordered_map<string, GrammarCache::iterator> grammar_cache_index_;
+    int32 grammar_class_base_ = -1;
+    std::unordered_map<string, int32> grammar_classes_;
+
     std::atomic<int> ref_cnt_;
 };
 
@@ -16,7 +16,7 @@
 #include "json.h"
 #include "fstext/fstext-utils.h"
 #include "lat/sausages.h"
-#include "language_model.h"
+#include "spk_frames.h"
 
 using namespace fst;
 using namespace kaldi::nnet3;
@@ -44,6 +44,7 @@ Recognizer::Recognizer(Model *model, float sample_frequency) : model_(model), sp
 
     InitState();
     InitRescoring();
+    InitFeatureHooks();
 }
 
 Recognizer::Recognizer(Model *model, float sample_frequency, char const *grammar) : model_(model), spk_model_(0), sample_frequency_(sample_frequency)
@@ -67,6 +68,7 @@ Recognizer::Recognizer(Model *model, float sample_frequency, char const *grammar
 
     InitState();
     InitRescoring();
+    InitFeatureHooks();
 }
 
 Recognizer::Recognizer(Model *model, float sample_frequency, SpkModel *spk_model) : model_(model), spk_model_(spk_model), sample_frequency_(sample_frequency) {
@@ -95,15 +97,18 @@ Recognizer::Recognizer(Model *model, float sample_frequency, SpkModel *spk_model
 
     InitState();
     InitRescoring();
+    InitFeatureHooks();
 }
 
 Recognizer::~Recognizer() {
     delete decoder_;
     delete feature_pipeline_;
     delete silence_weighting_;
-    delete g_fst_;
     delete decode_fst_;
+    delete class_g_fst_;
     delete spk_feature_;
+    delete external_features_;
+    delete feature_tap_;
 
     delete lm_to_subtract_;
     delete carpa_to_add_;
@@ -120,6 +125,7 @@ Recognizer::~Recognizer() {
 void Recognizer::InitState()
 {
     endpoint_config_ = model_->endpoint_config_;
+    external_features_rxfilename_ = model_->external_features_rxfilename_;
 
     frame_offset_ = 0;
     samples_processed_ = 0;
@@ -149,8 +155,31 @@ void Recognizer::InitRescoring()
     }
 }
 
+void Recognizer::InitFeatureHooks()
+{
+    if (!feature_pipeline_) {
+        return;
+    }
+    feature_pipeline_->SetFeatureTap(feature_tap_);
+    if (external_features_rxfilename_.empty()) {
+        return;
+    }
+
+    // The file is rewritten by the client for every request, so we read it
+    // once for each new feature pipeline, that is, once per utterance
+    if (!external_features_) {
+        external_features_ = new ExternalFeatureSource();
+    }
+    external_features_->Read(external_features_rxfilename_);
+    feature_pipeline_->SetExternalFeatures(external_features_);
+}
+
 void Recognizer::CleanUp()
 {
+    if (!model_->hclg_fst_ && !decode_fst_) {
+        KALDI_ERR << "No decoding graph, the grammar update failed, set the grammar again";
+    }
+
     delete silence_weighting_;
     silence_weighting_ = new kaldi::OnlineSilenceWeighting(*model_->trans_model_, model_->feature_info_.silence_weighting_config, 3);
 
@@ -177,6 +206,7 @@ void Recognizer::CleanUp()
             *model_->decodable_info_,
             model_->hclg_fst_ ? *model_->hclg_fst_ : *decode_fst_,
             feature_pipeline_);
+        InitFeatureHooks();
 
         if (spk_model_) {
             delete spk_feature_;
@@ -185,6 +215,11 @@ void Recognizer::CleanUp()
     } else {
         decoder_->InitDecoding(frame_offset_);
     }
+
+    // The tokens of the traced path are gone with the old utterance
+    partial_path_.clear();
+    partial_path_index_.clear();
+    partial_path_words_.clear();
 }
 
 void Recognizer::UpdateSilenceWeights()
@@ -260,6 +295,43 @@ void Recognizer::SetEndpointerDelays(float t_start_max, float t_end, float t_max
     endpoint_config_.rule5.min_utterance_length = rule5;
 }
 
+void Recognizer::SetExternalFeatures(const char *rxfilename)
+{
+    if (state_ == RECOGNIZER_RUNNING) {
+        KALDI_ERR << "Can't change external features of already running recognizer";
+        return;
+    }
+
+    external_features_rxfilename_ = rxfilename ? rxfilename : "";
+    if (external_features_rxfilename_.empty()) {
+        if (feature_pipeline_) {
+            feature_pipeline_->SetExternalFeatures(nullptr);
+        }
+        delete external_features_;
+        external_features_ = nullptr;
+        return;
+    }
+    InitFeatureHooks();
+}
+
+void Recognizer::SetFeatureTap(const char *prefix)
+{
+    if (state_ == RECOGNIZER_RUNNING) {
+        KALDI_ERR << "Can't change feature tap of already running recognizer";
+        return;
+    }
+
+    if (feature_pipeline_) {
+        feature_pipeline_->SetFeatureTap(nullptr);
+    }
+    // Waits for the previous tap to finish writing
+    delete feature_tap_;
+    feature_tap_ = nullptr;
+    if (prefix && *prefix) {
+        feature_tap_ = new OnlineFeatureFileTap(prefix);
+    }
+    InitFeatureHooks();
+}
 
 void Recognizer::SetSpkModel(SpkModel *spk_model)
 {
@@ -287,11 +359,18 @@ void Recognizer::SetGrm(char const *grammar)
     delete decode_fst_;
 
     if (!strcmp(grammar, "[]")) {
+        ClearGrammarClasses();
+        g_fst_.reset();
         decode_fst_ = LookaheadComposeFst(*model_->hcl_fst_, *model_->g_fst_, model_->disambig_);
     } else {
         UpdateGrammarFst(grammar);
     }
 
+    ResetDecoder();
+}
+
+void Recognizer::ResetDecoder()
+{
     samples_round_start_ += samples_processed_;
     samples_processed_ = 0;
     frame_offset_ = 0;
@@ -307,6 +386,7 @@ void Recognizer::SetGrm(char const *grammar)
             *model_->decodable_info_,
             *decode_fst_,
             feature_pipeline_);
+    InitFeatureHooks();
 
     if (spk_model_) {
         delete spk_feature_;
@@ -319,46 +399,280 @@ void Recognizer::SetGrm(char const *grammar)
 
 void Recognizer::UpdateGrammarFst(char const *grammar)
 {
-    json::JSON obj;
-    obj = json::JSON::Load(grammar);
+    ClearGrammarClasses();
+    g_fst_ = model_->GetGrammarFst(grammar);
+    if (g_fst_) {
+        if (ExpandGrammarClasses()) {
+            decode_fst_ = LookaheadComposeFst(*model_->hcl_fst_, *class_g_fst_, model_->disambig_);
+        } else {
+            decode_fst_ = LookaheadComposeFst(*model_->hcl_fst_, *g_fst_, model_->disambig_);
+        }
+    } else if (model_->g_fst_) {
+        // Invalid grammar, decode with the language model of the model
+        decode_fst_ = LookaheadComposeFst(*model_->hcl_fst_, *model_->g_fst_, model_->disambig_);
+    } else {
+        KALDI_ERR << "Can't create decoding graph";
+    }
+}
 
-    if (obj.length() <= 0) {
-        KALDI_WARN << "Expecting array of strings, got: '" << grammar << "'";
-        return;
+// The $name classes of a grammar start empty. The grammar is copied and
+// every class arc is replaced by an epsilon arc to an entry state of the
+// class, one per class and state after the arc. A phrase is a chain of
+// states from every entry to the exit state, the state after the class
+// arc, so adding or removing one only touches its own chain and the arcs
+// of the entry states.
+bool Recognizer::ExpandGrammarClasses()
+{
+    int32 base = model_->GrammarClassBase();
+    if (base < 0) {
+        return false;
+    }
+
+    bool has_classes = false;
+    for (fst::StateIterator<fst::StdVectorFst> siter(*g_fst_); !siter.Done() && !has_classes; siter.Next()) {
+        for (fst::ArcIterator<fst::StdVectorFst> aiter(*g_fst_, siter.Value()); !aiter.Done(); aiter.Next()) {
+            if (aiter.Value().ilabel >= base) {
+                has_classes = true;
+                break;
+            }
+        }
+    }
+    if (!has_classes) {
+        return false;
     }
 
-    KALDI_LOG << obj;
+    class_g_fst_ = new fst::StdVectorFst(*g_fst_);
+    std::map<pair<int32, int32>, int32> entries;
+    int32 num_states = class_g_fst_->NumStates();
+    for (int32 s = 0; s < num_states; s++) {
+        vector<fst::StdArc> arcs;
+        bool changed = false;
+        for (fst::ArcIterator<fst::StdVectorFst> aiter(*class_g_fst_, s); !aiter.Done(); aiter.Next()) {
+            fst::StdArc arc = aiter.Value();
+            if (arc.ilabel >= base) {
+                auto it = entries.find(std::make_pair(arc.ilabel, arc.nextstate));
+                int32 entry;
+                if (it != entries.end()) {
+                    entry = it->second;
+                } else {
+                    // Adding states invalidates the arc iterator, so the
+                    // arcs are only written back after the loop
+                    entry = num_states + entries.size();
+                    entries[std::make_pair(arc.ilabel, arc.nextstate)] = entry;
+                    grammar_classes_[arc.ilabel].entries.push_back(std::make_pair(entry, arc.nextstate));
+                }
+                arc.ilabel = arc.olabel = 0;
+                arc.nextstate = entry;
+                changed = true;
+            }
+            arcs.push_back(arc);
+        }
+        if (changed) {
+            class_g_fst_->DeleteArcs(s);
+            for (size_t i = 0; i < arcs.size(); i++) {
+                class_g_fst_->AddArc(s, arcs[i]);
+            }
+        }
+    }
+    class_g_fst_->AddStates(entries.size());
+    fst::ArcSort(class_g_fst_, fst::ILabelCompare<fst::StdArc>());
+    return true;
+}
 
-    LanguageModelOptions opts;
+void Recognizer::ClearGrammarClasses()
+{
+    delete class_g_fst_;
+    class_g_fst_ = nullptr;
+    grammar_classes_.clear();
+    free_class_states_.clear();
+}
 
-    opts.ngram_order = 2;
-    opts.discount = 0.5;
+GrammarClass *Recognizer::FindGrammarClass(const char *class_name, const char *phrase,
+                                           vector<int32> *words)
+{
+    if (state_ == RECOGNIZER_RUNNING) {
+        KALDI_ERR << "Can't change grammar of already running recognizer";
+        return nullptr;
+    }
 
-    LanguageModelEstimator estimator(opts);
-    for (int i = 0; i < obj.length(); i++) {
-        bool ok;
-        string line = obj[i].ToString(ok);
-        if (!ok) {
-            KALDI_ERR << "Expecting array of strings, got: '" << obj << "'";
+    if (class_name[0] == '$') {
+        class_name++;
+    }
+    int32 label = class_g_fst_ ? model_->GrammarClassLabel(class_name, false) : -1;
+    auto it = grammar_classes_.find(label);
+    if (it == grammar_classes_.end()) {
+        KALDI_WARN << "Grammar has no class $" << class_name;
+        return nullptr;
+    }
+
+    stringstream ss(phrase);
+    string token;
+    words->clear();
+    while (getline(ss, token, ' ')) {
+        if (token.empty()) {
+            continue;
+        }
+        int32 id = model_->word_syms_->Find(token);
+        if (id == kNoSymbol) {
+            KALDI_WARN << "Word missing in vocabulary: '" << token << "'";
+            return nullptr;
+        }
+        words->push_back(id);
+    }
+    if (words->empty()) {
+        KALDI_WARN << "Empty phrase for class $" << class_name;
+        return nullptr;
+    }
+    return &it->second;
+}
+
+int32 Recognizer::NewClassState()
+{
+    if (free_class_states_.empty()) {
+        return class_g_fst_->AddState();
+    }
+    int32 s = free_class_states_.back();
+    free_class_states_.pop_back();
+    return s;
+}
+
+// The composition holds a shallow copy of class_g_fst_, so it is deleted
+// before the grammar is patched, otherwise the first change would copy
+// the whole grammar
+void Recognizer::ReleaseGrammarDecoder()
+{
+    if (decoder_) {
+        frame_offset_ += decoder_->NumFramesDecoded();
+    }
+    delete decoder_;
+    decoder_ = nullptr;
+    delete decode_fst_;
+    decode_fst_ = nullptr;
+
+    // The tokens of the traced path were owned by the decoder
+    partial_path_.clear();
+    partial_path_index_.clear();
+    partial_path_words_.clear();
+}
+
+// Only the composition and the decoder are built again, the feature
+// pipeline and silence weighting stay. CleanUp() continues the decoder
+// from frame_offset_ like after an endpoint. After a final result there
+// is no pipeline, then CleanUp() builds the decoder with the next one.
+void Recognizer::RebuildGrammarDecoder()
+{
+    try {
+        decode_fst_ = LookaheadComposeFst(*model_->hcl_fst_, *class_g_fst_, model_->disambig_);
+        if (feature_pipeline_) {
+            decoder_ = new kaldi::SingleUtteranceNnet3IncrementalDecoder(model_->nnet3_decoding_config_,
+                    *model_->trans_model_,
+                    *model_->decodable_info_,
+                    *decode_fst_,
+                    feature_pipeline_);
         }
+    } catch (...) {
+        // Without a decoder the next utterance goes through CleanUp(),
+        // which fails cleanly if there is no graph either
+        delete decode_fst_;
+        decode_fst_ = nullptr;
+        if (state_ == RECOGNIZER_INITIALIZED) {
+            state_ = RECOGNIZER_ENDPOINT;
+        }
+        throw;
+    }
+    if (!decoder_ && state_ == RECOGNIZER_INITIALIZED) {
+        state_ = RECOGNIZER_ENDPOINT;
+    }
+}
+
+bool Recognizer::AddGrammarPhrase(const char *class_name, const char *phrase)
+{
+    vector<int32> words;
+    GrammarClass *cls = FindGrammarClass(class_name, phrase, &words);
+    if (!cls) {
+        return false;
+    }
+    if (cls->phrases.count(words)) {
+        return true;
+    }
 
-        std::vector<int32> sentence;
-        stringstream ss(line);
-        string token;
-        while (getline(ss, token, ' ')) {
-            int32 id = model_->word_syms_->Find(token);
-            if (id == kNoSymbol) {
-                KALDI_WARN << "Ignoring word missing in vocabulary: '" << token << "'";
+    ReleaseGrammarDecoder();
+    vector<pair<int32, int32> > &first_arcs = cls->phrases[words];
+    for (size_t i = 0; i < cls->entries.size(); i++) {
+        int32 entry = cls->entries[i].first;
+        int32 exit = cls->entries[i].second;
+        int32 prev = entry;
+        for (size_t j = 0; j < words.size(); j++) {
+            int32 next = j + 1 == words.size() ? exit : NewClassState();
+            fst::StdArc arc(words[j], words[j], fst::TropicalWeight::One(), next);
+            if (j == 0) {
+                // Keep the arcs of the entry sorted for the composition
+                vector<fst::StdArc> arcs;
+                for (fst::ArcIterator<fst::StdVectorFst> aiter(*class_g_fst_, entry); !aiter.Done(); aiter.Next()) {
+                    arcs.push_back(aiter.Value());
+                }
+                auto pos = std::upper_bound(arcs.begin(), arcs.end(), arc,
+                        [](const fst::StdArc &a, const fst::StdArc &b) { return a.ilabel < b.ilabel; });
+                arcs.insert(pos, arc);
+                class_g_fst_->DeleteArcs(entry);
+                for (size_t k = 0; k < arcs.size(); k++) {
+                    class_g_fst_->AddArc(entry, arcs[k]);
+                }
+                first_arcs.push_back(std::make_pair(words[j], next));
             } else {
-                sentence.push_back(id);
+                class_g_fst_->AddArc(prev, arc);
+            }
+            prev = next;
+        }
+    }
+
+    RebuildGrammarDecoder();
+    return true;
+}
+
+bool Recognizer::RemoveGrammarPhrase(const char *class_name, const char *phrase)
+{
+    vector<int32> words;
+    GrammarClass *cls = FindGrammarClass(class_name, phrase, &words);
+    if (!cls) {
+        return false;
+    }
+    auto it = cls->phrases.find(words);
+    if (it == cls->phrases.end()) {
+        return false;
+    }
+
+    ReleaseGrammarDecoder();
+    for (size_t i = 0; i < cls->entries.size(); i++) {
+        int32 entry = cls->entries[i].first;
+        int32 exit = cls->entries[i].second;
+        int32 label = it->second[i].first;
+        int32 first = it->second[i].second;
+
+        vector<fst::StdArc> arcs;
+        for (fst::ArcIterator<fst::StdVectorFst> aiter(*class_g_fst_, entry); !aiter.Done(); aiter.Next()) {
+            const fst::StdArc &arc = aiter.Value();
+            if (arc.ilabel != label || arc.nextstate != first) {
+                arcs.push_back(arc);
             }
         }
-        estimator.AddCounts(sentence);
+        class_g_fst_->DeleteArcs(entry);
+        for (size_t k = 0; k < arcs.size(); k++) {
+            class_g_fst_->AddArc(entry, arcs[k]);
+        }
+
+        // The states of the chain have a single arc each
+        for (int32 s = first; s != exit; ) {
+            int32 next = fst::ArcIterator<fst::StdVectorFst>(*class_g_fst_, s).Value().nextstate;
+            class_g_fst_->DeleteArcs(s);
+            free_class_states_.push_back(s);
+            s = next;
+        }
     }
-    g_fst_ = new StdVectorFst();
-    estimator.Estimate(g_fst_);
+    cls->phrases.erase(it);
 
-    decode_fst_ = LookaheadComposeFst(*model_->hcl_fst_, *g_fst_, model_->disambig_);
+    RebuildGrammarDecoder();
+    return true;
 }
 
 
@@ -382,14 +696,19 @@ bool Recognizer::AcceptWaveform(const short *sdata, int len)
 
 bool Recognizer::AcceptWaveform(const float *fdata, int len)
 {
+#if KALDI_DOUBLEPRECISION == 0
+    // Nothing to convert, the caller's samples are used in place
+    SubVector<BaseFloat> wave(const_cast<float *>(fdata), len);
+#else
     Vector<BaseFloat> wave;
     wave.Resize(len, kUndefined);
     for (int i = 0; i < len; i++)
         wave(i) = fdata[i];
+#endif
     return AcceptWaveform(wave);
 }
 
-bool Recognizer::AcceptWaveform(Vector<BaseFloat> &wdata)
+bool Recognizer::AcceptWaveform(const VectorBase<BaseFloat> &wdata)
 {
     // Cleanup if we finalized previous utterance or the whole feature pipeline
     if (!(state_ == RECOGNIZER_RUNNING || state_ == RECOGNIZER_INITIALIZED)) {
@@ -399,7 +718,7 @@ bool Recognizer::AcceptWaveform(Vector<BaseFloat> &wdata)
 
     int step = static_cast<int>(sample_frequency_ * 0.2);
     for (int i = 0; i < wdata.Dim(); i+= step) {
-        SubVector<BaseFloat> r = wdata.Range(i, std::min(step, wdata.Dim() - i));
+        const SubVector<BaseFloat> r = wdata.Range(i, std::min(step, wdata.Dim() - i));
         feature_pipeline_->AcceptWaveform(sample_frequency_, r);
         UpdateSilenceWeights();
         decoder_->AdvanceDecoding();
@@ -417,6 +736,47 @@ bool Recognizer::AcceptWaveform(Vector<BaseFloat> &wdata)
     return false;
 }
 
+bool Recognizer::AcceptFeatures(const float *fdata, int num_frames, int dim)
+{
+    // Speaker features need the audio, the spk vector would be missing or stale
+    if (spk_model_) {
+        KALDI_ERR << "Features can't be used with a speaker model";
+    }
+
+    // Cleanup if we finalized previous utterance or the whole feature pipeline
+    if (!(state_ == RECOGNIZER_RUNNING || state_ == RECOGNIZER_INITIALIZED)) {
+        CleanUp();
+    }
+    state_ = RECOGNIZER_RUNNING;
+
+#if KALDI_DOUBLEPRECISION == 0
+    // Nothing to convert, the caller's frames are used in place
+    SubMatrix<BaseFloat> feats(const_cast<float *>(fdata), num_frames, dim, dim);
+#else
+    Matrix<BaseFloat> feats(num_frames, dim, kUndefined);
+    for (int i = 0; i < num_frames; i++)
+        for (int j = 0; j < dim; j++)
+            feats(i, j) = fdata[i * dim + j];
+#endif
+
+    // Same 0.2 second steps as for the waveform
+    BaseFloat frame_shift = feature_pipeline_->FrameShiftInSeconds();
+    int step = std::max(1, static_cast<int>(0.2 / frame_shift + 0.5));
+    for (int i = 0; i < num_frames; i+= step) {
+        feature_pipeline_->AcceptFeatures(feats.RowRange(i, std::min(step, num_frames - i)));
+        UpdateSilenceWeights();
+        decoder_->AdvanceDecoding();
+    }
+    // Keep the word times right, as if the matching audio was processed
+    samples_processed_ += static_cast<int64>(num_frames * frame_shift * sample_frequency_ + 0.5);
+
+    if (decoder_->EndpointDetected(endpoint_config_)) {
+        return true;
+    }
+
+    return false;
+}
+
 // Computes an xvector from a chunk of speech features.
 static void RunNnetComputation(const MatrixBase<BaseFloat> &features,
     const nnet3::Nnet &nnet, nnet3::CachingOptimizingCompiler *compiler,
@@ -448,6 +808,37 @@ static void RunNnetComputation(const MatrixBase<BaseFloat> &features,
 
 #define MIN_SPK_FEATS 50
 
+// Rounds a number of frames up to m * 2^k with 8 <= m < 16, so all the
+// utterance lengths map to a few compiled computations and the padding
+// is less than 1/8 of the frames
+static int32 SpkBucketSize(int32 num_frames)
+{
+    int32 step = 1;
+    while (num_frames > 16 * step) {
+        step *= 2;
+    }
+    return (num_frames + step - 1) / step * step;
+}
+
+// Pads the features to the bucket size by mirroring the frames at both
+// ends, which keeps the pooled statistics close to the original ones
+static void PadSpkFeatures(const Matrix<BaseFloat> &features, Matrix<BaseFloat> *padded)
+{
+    int32 num_frames = features.NumRows(),
+          num_padded = SpkBucketSize(num_frames),
+          left = (num_padded - num_frames) / 2,
+          right = num_padded - num_frames - left;
+
+    padded->Resize(num_padded, features.NumCols(), kUndefined);
+    padded->RowRange(left, num_frames).CopyFromMat(features);
+    for (int32 i = 0; i < left; i++) {
+        padded->Row(left - 1 - i).CopyFromVec(features.Row(i + 1));
+    }
+    for (int32 i = 0; i < right; i++) {
+        padded->Row(left + num_frames + i).CopyFromVec(features.Row(num_frames - 2 - i));
+    }
+}
+
 bool Recognizer::GetSpkVector(Vector<BaseFloat> &out_xvector, int *num_spk_frames)
 {
     vector<int32> nonsilence_frames;
@@ -459,23 +850,10 @@ bool Recognizer::GetSpkVector(Vector<BaseFloat> &out_xvector, int *num_spk_frame
     }
 
     int num_frames = spk_feature_->NumFramesReady() - frame_offset_ * 3;
-    Matrix<BaseFloat> mfcc(num_frames, spk_feature_->Dim());
-
-    // Not very efficient, would be nice to have faster search
-    int num_nonsilence_frames = 0;
-    Vector<BaseFloat> feat(spk_feature_->Dim());
-
-    for (int i = 0; i < num_frames; ++i) {
-       if (std::find(nonsilence_frames.begin(),
-                     nonsilence_frames.end(), i / 3) == nonsilence_frames.end()) {
-           continue;
-       }
-
-       spk_feature_->GetFrame(i + frame_offset_ * 3, &feat);
-       mfcc.CopyRowFromVec(feat, num_nonsilence_frames);
-       num_nonsilence_frames++;
-    }
+    vector<int32> frames;
+    SelectSpkFrames(nonsilence_frames, num_frames, 3, frame_offset_ * 3, &frames);
 
+    int num_nonsilence_frames = frames.size();
     *num_spk_frames = num_nonsilence_frames;
 
     // Don't extract vector if not enough data
@@ -483,7 +861,8 @@ bool Recognizer::GetSpkVector(Vector<BaseFloat> &out_xvector, int *num_spk_frame
         return false;
     }
 
-    mfcc.Resize(num_nonsilence_frames, spk_feature_->Dim(), kCopyData);
+    Matrix<BaseFloat> mfcc(num_nonsilence_frames, spk_feature_->Dim(), kUndefined);
+    spk_feature_->GetFrames(frames, &mfcc);
 
     SlidingWindowCmnOptions cmvn_opts;
     cmvn_opts.center = true;
@@ -491,12 +870,11 @@ bool Recognizer::GetSpkVector(Vector<BaseFloat> &out_xvector, int *num_spk_frame
     Matrix<BaseFloat> features(mfcc.NumRows(), mfcc.NumCols(), kUndefined);
     SlidingWindowCmn(cmvn_opts, mfcc, &features);
 
-    nnet3::NnetSimpleComputationOptions opts;
-    nnet3::CachingOptimizingCompilerOptions compiler_config;
-    nnet3::CachingOptimizingCompiler compiler(spk_model_->speaker_nnet, opts.optimize_config, compiler_config);
+    Matrix<BaseFloat> padded;
+    PadSpkFeatures(features, &padded);
 
     Vector<BaseFloat> xvector;
-    RunNnetComputation(features, spk_model_->speaker_nnet, &compiler, &xvector);
+    RunNnetComputation(padded, spk_model_->speaker_nnet, spk_model_->compiler, &xvector);
 
     // Whiten the vector with global mean and transform and normalize mean
     xvector.AddVec(-1.0, spk_model_->mean);
@@ -522,7 +900,7 @@ static void CopyLatticeForMbr(CompactLattice &lat, CompactLattice *lat_out)
     TopSortCompactLatticeIfNeeded(lat_out);
 }
 
-const char *Recognizer::MbrResult(CompactLattice &rlat)
+void Recognizer::MbrBest(CompactLattice &rlat)
 {
 
     CompactLattice aligned_lat;
@@ -538,21 +916,32 @@ const char *Recognizer::MbrResult(CompactLattice &rlat)
     const vector<pair<BaseFloat, BaseFloat> > &times =
           mbr.GetOneBestTimes();
 
-    int size = words.size();
-
-    json::JSON obj;
-    stringstream text;
+    result_.Clear();
+    AddWords(words, &times, &conf);
 
-    // Create JSON object
-    for (int i = 0; i < size; i++) {
-        json::JSON word;
+    if (spk_model_) {
+        Vector<BaseFloat> xvector;
+        int num_spk_frames;
+        if (GetSpkVector(xvector, &num_spk_frames)) {
+            result_.spk.assign(xvector.Data(), xvector.Data() + xvector.Dim());
+            result_.spk_frames = num_spk_frames;
+        }
+    }
+}
 
-        if (words_) {
-            word["word"] = model_->word_syms_->Find(words[i]);
-            word["start"] = samples_round_start_ / sample_frequency_ + (frame_offset_ + times[i].first) * 0.03;
-            word["end"] = samples_round_start_ / sample_frequency_ + (frame_offset_ + times[i].second) * 0.03;
-            word["conf"] = conf[i];
-            obj["result"].append(word);
+void Recognizer::AddWords(const vector<int32> &words,
+                          const vector<pair<BaseFloat, BaseFloat> > *times,
+                          const vector<BaseFloat> *conf)
+{
+    stringstream text;
+    double round_start = samples_round_start_ / sample_frequency_;
+
+    for (size_t i = 0; i < words.size(); i++) {
+        result_.word_ids.push_back(words[i]);
+        if (times) {
+            result_.start.push_back(round_start + (frame_offset_ + (*times)[i].first) * 0.03);
+            result_.end.push_back(round_start + (frame_offset_ + (*times)[i].second) * 0.03);
+            result_.conf.push_back((*conf)[i]);
         }
 
         if (i) {
@@ -560,17 +949,40 @@ const char *Recognizer::MbrResult(CompactLattice &rlat)
         }
         text << model_->word_syms_->Find(words[i]);
     }
-    obj["text"] = text.str();
+    result_.text = text.str();
+}
 
-    if (spk_model_) {
-        Vector<BaseFloat> xvector;
-        int num_spk_frames;
-        if (GetSpkVector(xvector, &num_spk_frames)) {
-            for (int i = 0; i < xvector.Dim(); i++) {
-                obj["spk"].append(xvector(i));
-            }
-            obj["spk_frames"] = num_spk_frames;
+// Formats result_ as JSON, only the string API needs it
+const char *Recognizer::StoreResult()
+{
+    result_.with_words = result_.partial ? partial_words_ : words_;
+    if (!result_json_) {
+        return StoreReturn("");
+    }
+
+    json::JSON obj;
+    const char *words_key = result_.partial ? "partial_result" : "result";
+
+    if (result_.with_words && !result_.start.empty()) {
+        size_t pos = 0;
+        for (size_t i = 0; i < result_.word_ids.size(); i++) {
+            json::JSON word;
+            size_t next = result_.text.find(' ', pos);
+            word["word"] = result_.text.substr(pos, next - pos);
+            word["start"] = result_.start[i];
+            word["end"] = result_.end[i];
+            word["conf"] = result_.conf[i];
+            obj[words_key].append(word);
+            pos = next + 1;
+        }
+    }
+    obj[result_.partial ? "partial" : "text"] = result_.text;
+
+    if (!result_.spk.empty()) {
+        for (size_t i = 0; i < result_.spk.size(); i++) {
+            obj["spk"].append(result_.spk[i]);
         }
+        obj["spk_frames"] = result_.spk_frames;
     }
 
     return StoreReturn(obj.dump());
@@ -824,8 +1236,11 @@ const char* Recognizer::GetResult()
     // Apply rescoring weight
     fst::ScaleLattice(fst::GraphLatticeScale(0.9), &rlat);
 
-    if (max_alternatives_ == 0) {
-        return MbrResult(rlat);
+    // The structured result always holds the one-best, alternatives
+    // are only available as JSON
+    if (max_alternatives_ == 0 || !result_json_) {
+        MbrBest(rlat);
+        return StoreResult();
     } else if (nlsml_) {
         return NlsmlResult(rlat);
     } else {
@@ -835,19 +1250,23 @@ const char* Recognizer::GetResult()
 }
 
 
-const char* Recognizer::PartialResult()
+const char* Recognizer::GetPartialResult()
 {
     if (state_ != RECOGNIZER_RUNNING) {
-        return StoreEmptyReturn();
+        StoreEmptyReturn();
+        result_.partial = true;
+        UpdatePartialVersion();
+        return last_result_.c_str();
     }
 
-    json::JSON res;
+    result_.Clear();
+    result_.partial = true;
 
     if (partial_words_) {
 
         if (decoder_->NumFramesInLattice() == 0) {
-            res["partial"] = "";
-            return StoreReturn(res.dump());
+            UpdatePartialVersion();
+            return StoreResult();
         }
 
         CompactLattice clat;
@@ -865,53 +1284,86 @@ const char* Recognizer::PartialResult()
         const vector<int32> &words = mbr.GetOneBest();
         const vector<pair<BaseFloat, BaseFloat> > &times = mbr.GetOneBestTimes();
 
-        int size = words.size();
+        AddWords(words, &times, &conf);
 
-        stringstream text;
+    } else {
 
-        // Create JSON object
-        for (int i = 0; i < size; i++) {
-            json::JSON word;
+        if (decoder_->NumFramesDecoded() == 0) {
+            UpdatePartialVersion();
+            return StoreResult();
+        }
+        AddWords(TraceBackPartial(), nullptr, nullptr);
+    }
 
-            word["word"] = model_->word_syms_->Find(words[i]);
-            word["start"] = samples_round_start_ / sample_frequency_ + (frame_offset_ + times[i].first) * 0.03;
-            word["end"] = samples_round_start_ / sample_frequency_ + (frame_offset_ + times[i].second) * 0.03;
-            word["conf"] = conf[i];
-            res["partial_result"].append(word);
+    UpdatePartialVersion();
+    return StoreResult();
+}
 
-            if (i) {
-                text << " ";
-            }
-            text << model_->word_syms_->Find(words[i]);
+// Traces back the best path of the current utterance. The path of the
+// previous call is kept, once the traceback reaches a token of it the rest
+// of the path is the same, so only the part which changed since the last
+// partial result is traced.
+const vector<int32> &Recognizer::TraceBackPartial()
+{
+    const LatticeIncrementalOnlineDecoder &decoder = decoder_->Decoder();
+    LatticeIncrementalOnlineDecoder::BestPathIterator iter = decoder.BestPathEnd(false);
+
+    vector<PartialPathNode> suffix;
+    size_t keep = 0;
+    while (!iter.Done()) {
+        std::unordered_map<const void *, size_t>::const_iterator it = partial_path_index_.find(iter.tok);
+        // Tokens of a frame are never created after the frame is decoded,
+        // so the same token on the same frame means the same path from here
+        if (it != partial_path_index_.end() && partial_path_[it->second].frame == iter.frame) {
+            keep = it->second + 1;
+            break;
         }
-        res["partial"] = text.str();
+        PartialPathNode node;
+        node.tok = iter.tok;
+        node.frame = iter.frame;
+        LatticeArc arc;
+        iter = decoder.TraceBackBestPath(iter, &arc);
+        node.word = arc.olabel;
+        suffix.push_back(node);
+    }
 
-    } else {
+    for (size_t i = keep; i < partial_path_.size(); i++) {
+        partial_path_index_.erase(partial_path_[i].tok);
+    }
+    partial_path_.resize(keep);
+    partial_path_words_.resize(keep ? partial_path_[keep - 1].num_words : 0);
 
-        if (decoder_->NumFramesDecoded() == 0) {
-            res["partial"] = "";
-            return StoreReturn(res.dump());
+    for (size_t i = suffix.size(); i-- > 0; ) {
+        PartialPathNode &node = suffix[i];
+        if (node.word != 0) {
+            partial_path_words_.push_back(node.word);
         }
-        Lattice lat;
-        decoder_->GetBestPath(false, &lat);
-        vector<kaldi::int32> alignment, words;
-        LatticeWeight weight;
-        GetLinearSymbolSequence(lat, &alignment, &words, &weight);
-
-        ostringstream text;
-        for (size_t i = 0; i < words.size(); i++) {
-            if (i) {
-                text << " ";
-            }
-            text << model_->word_syms_->Find(words[i]);
-        }
-        res["partial"] = text.str();
+        node.num_words = partial_path_words_.size();
+        partial_path_index_[node.tok] = partial_path_.size();
+        partial_path_.push_back(node);
     }
+    return partial_path_words_;
+}
 
-    return StoreReturn(res.dump());
+// Compares the partial result with the previous one, the version changes
+// only when the words do
+void Recognizer::UpdatePartialVersion()
+{
+    const vector<int32> &words = result_.word_ids;
+    size_t stable = 0;
+    while (stable < words.size() && stable < partial_ids_.size() &&
+           words[stable] == partial_ids_[stable]) {
+        stable++;
+    }
+    if (stable != words.size() || stable != partial_ids_.size()) {
+        partial_version_++;
+        partial_ids_ = words;
+    }
+    result_.num_stable = stable;
+    result_.version = partial_version_;
 }
 
-const char* Recognizer::Result()
+const char* Recognizer::GetEndpointResult()
 {
     if (state_ != RECOGNIZER_RUNNING) {
         return StoreEmptyReturn();
@@ -921,7 +1373,7 @@ const char* Recognizer::Result()
     return GetResult();
 }
 
-const char* Recognizer::FinalResult()
+const char* Recognizer::GetFinalResult()
 {
     if (state_ != RECOGNIZER_RUNNING) {
         return StoreEmptyReturn();
@@ -949,6 +1401,45 @@ const char* Recognizer::FinalResult()
     return last_result_.c_str();
 }
 
+const char* Recognizer::Result()
+{
+    result_json_ = true;
+    return GetEndpointResult();
+}
+
+const char* Recognizer::FinalResult()
+{
+    result_json_ = true;
+    return GetFinalResult();
+}
+
+const char* Recognizer::PartialResult()
+{
+    result_json_ = true;
+    return GetPartialResult();
+}
+
+const VoskResult *Recognizer::ResultData()
+{
+    result_json_ = false;
+    GetEndpointResult();
+    return result_.View();
+}
+
+const VoskResult *Recognizer::FinalResultData()
+{
+    result_json_ = false;
+    GetFinalResult();
+    return result_.View();
+}
+
+const VoskResult *Recognizer::PartialResultData()
+{
+    result_json_ = false;
+    GetPartialResult();
+    return result_.View();
+}
+
 void Recognizer::Reset()
 {
     if (state_ == RECOGNIZER_RUNNING) {
@@ -958,8 +1449,35 @@ void Recognizer::Reset()
     state_ = RECOGNIZER_ENDPOINT;
 }
 
+void Recognizer::Restart()
+{
+    // Word times of the next stream start from zero. Reset before anything
+    // which can throw, so a failed restart leaves no state of the old stream
+    samples_round_start_ = 0;
+    samples_processed_ = 0;
+    frame_offset_ = 0;
+    StoreEmptyReturn();
+    state_ = RECOGNIZER_INITIALIZED;
+
+    // External features set for the stream go back to the default of the
+    // model, the stream's file may be gone already
+    external_features_rxfilename_ = model_->external_features_rxfilename_;
+    if (feature_pipeline_) {
+        feature_pipeline_->SetExternalFeatures(nullptr);
+    }
+    delete external_features_;
+    external_features_ = nullptr;
+
+    // Drop the decoder so that CleanUp() builds a fresh pipeline and
+    // decoder right away, the next stream then starts without delay
+    delete decoder_;
+    decoder_ = nullptr;
+    CleanUp();
+}
+
 const char *Recognizer::StoreEmptyReturn()
 {
+    result_.Clear();
     if (!max_alternatives_) {
         return StoreReturn("{\"text\": \"\"}");
     } else if (nlsml_) {
@@ -975,6 +1493,39 @@ const char *Recognizer::StoreEmptyReturn()
     }
 }
 
+void RecognizerResult::Clear()
+{
+    partial = false;
+    text.clear();
+    word_ids.clear();
+    start.clear();
+    end.clear();
+    conf.clear();
+    spk.clear();
+    spk_frames = 0;
+    num_stable = 0;
+    version = 0;
+    with_words = false;
+}
+
+const VoskResult *RecognizerResult::View()
+{
+    view.partial = partial;
+    view.text = text.c_str();
+    view.num_words = word_ids.size();
+    view.word_ids = word_ids.data();
+    view.start = start.empty() ? nullptr : start.data();
+    view.end = end.empty() ? nullptr : end.data();
+    view.conf = conf.empty() ? nullptr : conf.data();
+    view.spk_dim = spk.size();
+    view.spk = spk.empty() ? nullptr : spk.data();
+    view.spk_frames = spk_frames;
+    view.num_stable = num_stable;
+    view.version = version;
+    view.with_words = with_words;
+    return &view;
+}
+
 // Store result in recognizer and return as const string
 const char *Recognizer::StoreReturn(const string &res)
 {
@@ -28,8 +28,11 @@
 #include "nnet3/nnet-am-decodable-simple.h"
 #include "nnet3/nnet-utils.h"
 
+#include <map>
+
 #include "model.h"
 #include "spk_model.h"
+#include "vosk_api.h"
 
 using namespace kaldi;
 
@@ -40,6 +43,47 @@ enum RecognizerState {
     RECOGNIZER_FINALIZED
 };
 
+// One-best result of the recognizer kept as plain arrays, the JSON
+// string is only built from it when the string API is used
+struct RecognizerResult {
+    bool partial = false;
+    string text;
+    vector<int32> word_ids;
+    vector<double> start;
+    vector<double> end;
+    vector<float> conf;
+    vector<float> spk;
+    int spk_frames = 0;
+    // Partial results only: words which did not change since the previous
+    // partial result and a counter which changes with the words
+    int num_stable = 0;
+    int64 version = 0;
+    // The JSON string has the word list
+    bool with_words = false;
+
+    void Clear();
+    const VoskResult *View();
+
+    private:
+        VoskResult view;
+};
+
+// Token on the best path traced back for a partial result
+struct PartialPathNode {
+    const void *tok;
+    int32 frame;
+    int32 word;      // output label of the arc into the token
+    int32 num_words; // words on the path up to the token
+};
+
+// A $name class of the grammar: the class arcs lead to entry states, the
+// phrases are word chains from an entry to the state after the class arc
+struct GrammarClass {
+    vector<pair<int32, int32> > entries;  // entry and exit states
+    // Phrase word ids to the first arc of its chain from every entry
+    std::map<vector<int32>, vector<pair<int32, int32> > > phrases;
+};
+
 class Recognizer {
     public:
         Recognizer(Model *model, float sample_frequency);
@@ -49,43 +93,81 @@ class Recognizer {
         void SetMaxAlternatives(int max_alternatives);
         void SetSpkModel(SpkModel *spk_model);
         void SetGrm(char const *grammar);
+        bool AddGrammarPhrase(const char *class_name, const char *phrase);
+        bool RemoveGrammarPhrase(const char *class_name, const char *phrase);
         void SetWords(bool words);
         void SetPartialWords(bool partial_words);
         void SetNLSML(bool nlsml);
         void SetEndpointerMode(int mode);
         void SetEndpointerDelays(float t_start_max, float t_end, float t_max);
+        void SetExternalFeatures(const char *rxfilename);
+        void SetFeatureTap(const char *prefix);
         bool AcceptWaveform(const char *data, int len);
         bool AcceptWaveform(const short *sdata, int len);
         bool AcceptWaveform(const float *fdata, int len);
+        bool AcceptFeatures(const float *fdata, int num_frames, int dim);
         const char* Result();
         const char* FinalResult();
         const char* PartialResult();
+        const VoskResult *ResultData();
+        const VoskResult *FinalResultData();
+        const VoskResult *PartialResultData();
         void Reset();
+        void Restart();
 
     private:
         void InitState();
         void InitRescoring();
+        void InitFeatureHooks();
         void CleanUp();
         void UpdateSilenceWeights();
         void UpdateGrammarFst(char const *grammar);
-        bool AcceptWaveform(Vector<BaseFloat> &wdata);
+        void ResetDecoder();
+        bool ExpandGrammarClasses();
+        void ClearGrammarClasses();
+        GrammarClass *FindGrammarClass(const char *class_name, const char *phrase,
+                                       vector<int32> *words);
+        int32 NewClassState();
+        void ReleaseGrammarDecoder();
+        void RebuildGrammarDecoder();
+        bool AcceptWaveform(const VectorBase<BaseFloat> &wdata);
         bool GetSpkVector(Vector<BaseFloat> &out_xvector, int *frames);
         const char *GetResult();
+        const char *GetEndpointResult();
+        const char *GetFinalResult();
+        const char *GetPartialResult();
         const char *StoreEmptyReturn();
         const char *StoreReturn(const string &res);
-        const char *MbrResult(CompactLattice &clat);
+        const char *StoreResult();
+        void MbrBest(CompactLattice &clat);
+        const vector<int32> &TraceBackPartial();
+        void UpdatePartialVersion();
+        void AddWords(const vector<int32> &words,
+                      const vector<pair<BaseFloat, BaseFloat> > *times,
+                      const vector<BaseFloat> *conf);
         const char *NbestResult(CompactLattice &clat);
         const char *NlsmlResult(CompactLattice &clat);
 
         Model *model_ = nullptr;
         SingleUtteranceNnet3IncrementalDecoder *decoder_ = nullptr;
         fst::LookaheadFst<fst::StdArc, int32> *decode_fst_ = nullptr;
-        fst::StdVectorFst *g_fst_ = nullptr; // dynamically constructed grammar
+        std::shared_ptr<const fst::StdVectorFst> g_fst_; // grammar from the model cache
+        // Private copy of the grammar when it has classes
+        fst::StdVectorFst *class_g_fst_ = nullptr;
+        std::unordered_map<int32, GrammarClass> grammar_classes_;
+        vector<int32> free_class_states_;
         OnlineNnet2FeaturePipeline *feature_pipeline_ = nullptr;
         OnlineSilenceWeighting *silence_weighting_ = nullptr;
         // Endpointer
         kaldi::OnlineEndpointConfig endpoint_config_;
 
+        // Features computed outside of Vosk
+        ExternalFeatureSource *external_features_ = nullptr;
+        string external_features_rxfilename_;
+
+        // Debug copies of the waveform and features, off by default
+        OnlineFeatureFileTap *feature_tap_ = nullptr;
+
         // Speaker identification
         SpkModel *spk_model_ = nullptr;
         OnlineBaseFeature *spk_feature_ = nullptr;
@@ -114,6 +196,15 @@ class Recognizer {
 
         RecognizerState state_;
         string last_result_;
+        RecognizerResult result_;
+        bool result_json_ = true;
+
+        // Incremental partial results
+        vector<PartialPathNode> partial_path_;
+        std::unordered_map<const void *, size_t> partial_path_index_;
+        vector<int32> partial_path_words_;
+        vector<int32> partial_ids_;
+        int64 partial_version_ = 0;
 };
 
 #endif /* VOSK_KALDI_RECOGNIZER_H */
@@ -0,0 +1,51 @@
+// Copyright 2020 Alpha Cephei Inc.
+//
+// Licensed under the Apache License, Version 2.0 (the "License");
+// you may not use this file except in compliance with the License.
+// You may obtain a copy of the License at
+//
+//       http://www.apache.org/licenses/LICENSE-2.0
+//
+// Unless required by applicable law or agreed to in writing, software
+// distributed under the License is distributed on an "AS IS" BASIS,
+// WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+// See the License for the specific language governing permissions and
+// limitations under the License.
+
+#ifndef VOSK_SPK_FRAMES_H
+#define VOSK_SPK_FRAMES_H
+
+#include <cstdint>
+#include <vector>
+
+// Selects the feature frames [0, num_frames) whose decoder frame (frame /
+// subsampling) is in nonsilence_frames and stores them plus first_frame in
+// frames. Linear in the number of frames, the decoder frames are marked in
+// a bitmap first. Kept free of Kaldi so that bench_spk_frames.cc can
+// build it alone.
+inline void SelectSpkFrames(const std::vector<int32_t> &nonsilence_frames,
+                            int32_t num_frames, int32_t subsampling,
+                            int32_t first_frame, std::vector<int32_t> *frames)
+{
+    frames->clear();
+    if (num_frames <= 0) {
+        return;
+    }
+
+    int32_t num_decoder_frames = (num_frames + subsampling - 1) / subsampling;
+    std::vector<bool> nonsilence(num_decoder_frames, false);
+    for (size_t i = 0; i < nonsilence_frames.size(); i++) {
+        int32_t frame = nonsilence_frames[i];
+        if (frame >= 0 && frame < num_decoder_frames) {
+            nonsilence[frame] = true;
+        }
+    }
+
+    for (int32_t i = 0; i < num_frames; i++) {
+        if (nonsilence[i / subsampling]) {
+            frames->push_back(first_frame + i);
+        }
+    }
+}
+
+#endif /* VOSK_SPK_FRAMES_H */
@@ -28,9 +28,18 @@ SpkModel::SpkModel(const char *speaker_path) {
     ReadKaldiObject(speaker_path_str + "/mean.vec", &mean);
     ReadKaldiObject(speaker_path_str + "/transform.mat", &transform);
 
+    nnet3::NnetSimpleComputationOptions opts;
+    nnet3::CachingOptimizingCompilerOptions compiler_config;
+    compiler_config.cache_capacity = 128;
+    compiler = new nnet3::CachingOptimizingCompiler(speaker_nnet, opts.optimize_config, compiler_config);
+
     ref_cnt_ = 1;
 }
 
+SpkModel::~SpkModel() {
+    delete compiler;
+}
+
 void SpkModel::Ref()
 {
     std::atomic_fetch_add_explicit(&ref_cnt_, 1, std::memory_order_relaxed);
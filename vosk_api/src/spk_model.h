@@ -18,6 +18,7 @@
 #include "base/kaldi-common.h"
 #include "online2/online-feature-pipeline.h"
 #include "nnet3/nnet-utils.h"
+#include "nnet3/nnet-optimize.h"
 #include <atomic>
 
 using namespace kaldi;
@@ -33,7 +34,7 @@ public:
 
 protected:
     friend class Recognizer;
-    ~SpkModel() {};
+    ~SpkModel();
 
     kaldi::nnet3::Nnet speaker_nnet;
     kaldi::Vector<BaseFloat> mean;
@@ -41,6 +42,10 @@ protected:
 
     MfccOptions spkvector_mfcc_opts;
 
+    // Shared by all recognizers, Compile() is thread-safe. Inputs are
+    // padded to a few lengths, so the computations are compiled once
+    kaldi::nnet3::CachingOptimizingCompiler *compiler = nullptr;
+
     std::atomic<int> ref_cnt_;
 };
 
@@ -22,6 +22,11 @@
 #if HAVE_CUDA
 #include "cudamatrix/cu-device.h"
 #include "batch_recognizer.h"
+#else
+// Without CUDA the batch API is served by the CPU engine
+#include "cpu_batch_recognizer.h"
+typedef CpuBatchModel BatchModel;
+typedef CpuBatchRecognizer BatchRecognizer;
 #endif
 
 #include <string.h>
@@ -50,6 +55,15 @@ int vosk_model_find_word(VoskModel *model, const char *word)
     return (int) ((Model *)model)->FindWord(word);
 }
 
+int vosk_model_preload_grammar(VoskModel *model, const char *grammar)
+{
+    try {
+        return ((Model *)model)->PreloadGrammar(grammar) ? 1 : 0;
+    } catch (...) {
+        return 0;
+    }
+}
+
 VoskSpkModel *vosk_spk_model_new(const char *model_path)
 {
     try {
@@ -130,6 +144,24 @@ void vosk_recognizer_set_grm(VoskRecognizer *recognizer, char const *grammar)
     ((Recognizer *)recognizer)->SetGrm(grammar);
 }
 
+int vosk_recognizer_add_grm_phrase(VoskRecognizer *recognizer, const char *class_name, const char *phrase)
+{
+    try {
+        return ((Recognizer *)recognizer)->AddGrammarPhrase(class_name, phrase) ? 1 : 0;
+    } catch (...) {
+        return 0;
+    }
+}
+
+int vosk_recognizer_remove_grm_phrase(VoskRecognizer *recognizer, const char *class_name, const char *phrase)
+{
+    try {
+        return ((Recognizer *)recognizer)->RemoveGrammarPhrase(class_name, phrase) ? 1 : 0;
+    } catch (...) {
+        return 0;
+    }
+}
+
 void vosk_recognizer_set_endpointer_mode(VoskRecognizer *recognizer, VoskEndpointerMode mode)
 {
     if (recognizer == nullptr) {
@@ -146,6 +178,30 @@ void vosk_recognizer_set_endpointer_delays(VoskRecognizer *recognizer, float t_s
     ((Recognizer *)recognizer)->SetEndpointerDelays(t_start_max, t_end, t_max);
 }
 
+void vosk_recognizer_set_external_features(VoskRecognizer *recognizer, const char *path)
+{
+    if (recognizer == nullptr) {
+       return;
+    }
+    try {
+        ((Recognizer *)recognizer)->SetExternalFeatures(path);
+    } catch (...) {
+        // Error is already logged by Kaldi
+    }
+}
+
+void vosk_recognizer_set_feature_tap(VoskRecognizer *recognizer, const char *prefix)
+{
+    if (recognizer == nullptr) {
+       return;
+    }
+    try {
+        ((Recognizer *)recognizer)->SetFeatureTap(prefix);
+    } catch (...) {
+        // Error is already logged by Kaldi
+    }
+}
+
 int vosk_recognizer_accept_waveform(VoskRecognizer *recognizer, const char *data, int length)
 {
     try {
@@ -173,6 +229,15 @@ int vosk_recognizer_accept_waveform_f(VoskRecognizer *recognizer, const float *d
     }
 }
 
+int vosk_recognizer_accept_features(VoskRecognizer *recognizer, const float *data, int num_frames, int dim)
+{
+    try {
+        return ((Recognizer *)(recognizer))->AcceptFeatures(data, num_frames, dim);
+    } catch (...) {
+        return -1;
+    }
+}
+
 const char *vosk_recognizer_result(VoskRecognizer *recognizer)
 {
     return ((Recognizer *)recognizer)->Result();
@@ -188,11 +253,48 @@ const char *vosk_recognizer_final_result(VoskRecognizer *recognizer)
     return ((Recognizer *)recognizer)->FinalResult();
 }
 
+const VoskResult *vosk_recognizer_result_data(VoskRecognizer *recognizer)
+{
+    try {
+        return ((Recognizer *)recognizer)->ResultData();
+    } catch (...) {
+        return NULL;
+    }
+}
+
+const VoskResult *vosk_recognizer_partial_result_data(VoskRecognizer *recognizer)
+{
+    try {
+        return ((Recognizer *)recognizer)->PartialResultData();
+    } catch (...) {
+        return NULL;
+    }
+}
+
+const VoskResult *vosk_recognizer_final_result_data(VoskRecognizer *recognizer)
+{
+    try {
+        return ((Recognizer *)recognizer)->FinalResultData();
+    } catch (...) {
+        return NULL;
+    }
+}
+
 void vosk_recognizer_reset(VoskRecognizer *recognizer)
 {
     ((Recognizer *)recognizer)->Reset();
 }
 
+int vosk_recognizer_restart(VoskRecognizer *recognizer)
+{
+    try {
+        ((Recognizer *)recognizer)->Restart();
+        return 1;
+    } catch (...) {
+        return 0;
+    }
+}
+
 void vosk_recognizer_free(VoskRecognizer *recognizer)
 {
     delete (Recognizer *)(recognizer);
@@ -222,88 +324,66 @@ void vosk_gpu_thread_init()
 
 VoskBatchModel *vosk_batch_model_new(const char *model_path)
 {
-#if HAVE_CUDA
-    return (VoskBatchModel *)(new BatchModel(model_path));
-#else
-    return NULL;
-#endif
+    try {
+        return (VoskBatchModel *)(new BatchModel(model_path));
+    } catch (...) {
+        return nullptr;
+    }
 }
 
 void vosk_batch_model_free(VoskBatchModel *model)
 {
-#if HAVE_CUDA
     delete ((BatchModel *)model);
-#endif
 }
 
 void vosk_batch_model_wait(VoskBatchModel *model)
 {
-#if HAVE_CUDA
     ((BatchModel *)model)->WaitForCompletion();
-#endif
 }
 
 VoskBatchRecognizer *vosk_batch_recognizer_new(VoskBatchModel *model, float sample_rate)
 {
-#if HAVE_CUDA
-    return (VoskBatchRecognizer *)(new BatchRecognizer((BatchModel *)model, sample_rate));
-#else
-    return NULL;
-#endif
+    try {
+        return (VoskBatchRecognizer *)(new BatchRecognizer((BatchModel *)model, sample_rate));
+    } catch (...) {
+        return nullptr;
+    }
 }
 
 void vosk_batch_recognizer_free(VoskBatchRecognizer *recognizer)
 {
-#if HAVE_CUDA
     delete ((BatchRecognizer *)recognizer);
-#endif
 }
 
 void vosk_batch_recognizer_accept_waveform(VoskBatchRecognizer *recognizer, const char *data, int length)
 {
-#if HAVE_CUDA
     ((BatchRecognizer *)recognizer)->AcceptWaveform(data, length);
-#endif
 }
 
 void vosk_batch_recognizer_set_nlsml(VoskBatchRecognizer *recognizer, int nlsml)
 {
-#if HAVE_CUDA
     ((BatchRecognizer *)recognizer)->SetNLSML((bool)nlsml);
-#endif
 }
 
 void vosk_batch_recognizer_finish_stream(VoskBatchRecognizer *recognizer)
 {
-#if HAVE_CUDA
     ((BatchRecognizer *)recognizer)->FinishStream();
-#endif
 }
 
 const char *vosk_batch_recognizer_front_result(VoskBatchRecognizer *recognizer)
 {
-#if HAVE_CUDA
     return ((BatchRecognizer *)recognizer)->FrontResult();
-#else
-    return NULL;
-#endif
 }
 
 void vosk_batch_recognizer_pop(VoskBatchRecognizer *recognizer)
 {
-#if HAVE_CUDA
     ((BatchRecognizer *)recognizer)->Pop();
-#endif
 }
 
 
 int vosk_batch_recognizer_get_pending_chunks(VoskBatchRecognizer *recognizer)
 {
-#if HAVE_CUDA
     return ((BatchRecognizer *)recognizer)->GetNumPendingChunks();
-#else
-    return 0;
-#endif
 }
 
 VoskTextProcessor *vosk_text_processor_new(const char *tagger, const char *verbalizer)
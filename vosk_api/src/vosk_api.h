@@ -39,6 +39,35 @@ typedef struct VoskSpkModel VoskSpkModel;
  *  speaker information and so on */
 typedef struct VoskRecognizer VoskRecognizer;
 
+/** Recognition result as plain arrays, an alternative to the JSON string.
+ *  Word i is the i-th space separated word of text, start, end and conf
+ *  are NULL when word times are not available (partial result without
+ *  partial words). The data is owned by the recognizer and stays valid
+ *  until the next result call.
+ *
+ *  For partial results the first num_stable words are the same as in the
+ *  previous partial result and version changes only when the words change,
+ *  so the caller can skip a partial result with a version it has seen.
+ *
+ *  with_words is set when the JSON string of the result has the word list,
+ *  that is when words (partial words for partial results) are enabled; the
+ *  times can be there without it. */
+typedef struct VoskResult {
+    int partial;
+    const char *text;
+    int num_words;
+    const int *word_ids;
+    const double *start;
+    const double *end;
+    const float *conf;
+    int spk_dim;
+    const float *spk;
+    int spk_frames;
+    int num_stable;
+    long long version;
+    int with_words;
+} VoskResult;
+
 /** Inverse text normalization */
 typedef struct VoskTextProcessor VoskTextProcessor;
 
@@ -76,6 +105,19 @@ void vosk_model_free(VoskModel *model);
 int vosk_model_find_word(VoskModel *model, const char *word);
 
 
+/** Builds the grammar FST of a grammar and keeps it in the model cache
+ *
+ *  Recognizers created with the same grammar (vosk_recognizer_new_grm()
+ *  or vosk_recognizer_set_grm()) then don't have to build it. Phrases are
+ *  compared by words, their order doesn't matter. The cache keeps the
+ *  grammar-cache-size (see conf/model.conf, default 32) most recently used grammars.
+ *
+ *  @param grammar The string with the list of phrases as JSON array
+ *  @returns 1 if the grammar is ready, 0 if it is invalid or the model
+ *           doesn't support runtime grammars */
+int vosk_model_preload_grammar(VoskModel *model, const char *grammar);
+
+
 /** Loads speaker model data from the file and returns the model object
  *
  * @param model_path: the path of the model on the filesystem
@@ -157,6 +199,28 @@ void vosk_recognizer_set_spk_model(VoskRecognizer *recognizer, VoskSpkModel *spk
 void vosk_recognizer_set_grm(VoskRecognizer *recognizer, char const *grammar);
 
 
+/** Adds a phrase to a class of the grammar of the recognizer
+ *
+ *  A grammar phrase can refer to a class with a $name token, for example
+ *  ["call $contact", "play $song"]. Classes start empty and are filled
+ *  with this function, which only patches the recognizer's copy of the
+ *  grammar instead of building a new one. Must be called between
+ *  utterances; only the decoder is rebuilt, the feature pipeline is kept
+ *  and the next utterance continues like after an endpoint.
+ *
+ *  @param class_name  Name of the class, with or without the $
+ *  @param phrase      Words of the phrase separated by spaces
+ *  @returns 1 on success, 0 if the grammar has no such class or a word is
+ *           missing in the vocabulary */
+int vosk_recognizer_add_grm_phrase(VoskRecognizer *recognizer, const char *class_name, const char *phrase);
+
+
+/** Removes a phrase added with vosk_recognizer_add_grm_phrase()
+ *
+ *  @returns 1 on success, 0 if the class has no such phrase */
+int vosk_recognizer_remove_grm_phrase(VoskRecognizer *recognizer, const char *class_name, const char *phrase);
+
+
 /** Configures recognizer to output n-best results
  *
  * <pre>
@@ -242,6 +306,31 @@ void vosk_recognizer_set_endpointer_mode(VoskRecognizer *recognizer,  VoskEndpoi
  **/
 void vosk_recognizer_set_endpointer_delays(VoskRecognizer *recognizer, float t_start_max, float t_end, float t_max);
 
+/** Feeds the recognizer with features computed outside of Vosk
+ *
+ *  The features are read once per utterance and used instead of the features
+ *  the recognizer would compute from the audio. The audio is still needed to
+ *  advance the recognizer, see also vosk_recognizer_accept_waveform().
+ *
+ *  @param path  feature block (the magic "VKFB", int32 number of frames, int32 dimension
+ *               and float32 frames, little-endian), which is memory-mapped, or a Kaldi
+ *               matrix, or a text file with one feature frame per line. A mapped block must
+ *               be replaced with rename() rather than rewritten in place. The dimension must
+ *               match the model features. NULL or empty string computes features from audio again.
+ */
+void vosk_recognizer_set_external_features(VoskRecognizer *recognizer, const char *path);
+
+/** Writes a copy of the audio and the features of the recognizer to files, for debugging
+ *
+ *  The files are written from a background thread, so decoding doesn't wait for
+ *  the disk. The tap is off by default.
+ *
+ *  @param prefix  the audio goes to <prefix>.wav.f32 as raw float32 samples, the features
+ *                 go to <prefix>.feats as a feature block, see vosk_recognizer_set_external_features().
+ *                 NULL or empty string turns the tap off and finishes writing the files.
+ */
+void vosk_recognizer_set_feature_tap(VoskRecognizer *recognizer, const char *prefix);
+
 /** Accept voice data
  *
  *  accept and process new chunk of voice data
@@ -264,6 +353,22 @@ int vosk_recognizer_accept_waveform_s(VoskRecognizer *recognizer, const short *d
 int vosk_recognizer_accept_waveform_f(VoskRecognizer *recognizer, const float *data, int length);
 
 
+/** Accept feature frames computed outside of Vosk instead of voice data
+ *
+ *  The frames go straight to the decoder, no audio is needed and no features are
+ *  computed. Don't mix with vosk_recognizer_accept_waveform() within an utterance.
+ *  Not supported for models with pitch features, nor for recognizers with a speaker
+ *  model (speaker vectors are computed from the audio), that is an error.
+ *
+ *  @param data - feature frames as float32, row-major
+ *  @param num_frames - number of frames
+ *  @param dim - frame dimension, must match the model features
+ *  @returns 1 if silence is occured and you can retrieve a new utterance with result method
+ *           0 if decoding continues
+ *           -1 if exception occured */
+int vosk_recognizer_accept_features(VoskRecognizer *recognizer, const float *data, int num_frames, int dim);
+
+
 /** Returns speech recognition result
  *
  * @returns the result in JSON format which contains decoded line, decoded
@@ -306,12 +411,48 @@ const char *vosk_recognizer_partial_result(VoskRecognizer *recognizer);
 const char *vosk_recognizer_final_result(VoskRecognizer *recognizer);
 
 
+/** Same as vosk_recognizer_result() but returns the result as arrays
+ *  without formatting JSON.
+ *
+ *  Only the one-best result is returned, alternatives are available
+ *  as JSON only.
+ *
+ *  @returns the result or NULL if exception occured */
+const VoskResult *vosk_recognizer_result_data(VoskRecognizer *recognizer);
+
+
+/** Same as vosk_recognizer_partial_result() but returns arrays
+ *
+ *  @returns the result or NULL if exception occured */
+const VoskResult *vosk_recognizer_partial_result_data(VoskRecognizer *recognizer);
+
+
+/** Same as vosk_recognizer_final_result() but returns arrays
+ *
+ *  @returns the result or NULL if exception occured */
+const VoskResult *vosk_recognizer_final_result_data(VoskRecognizer *recognizer);
+
+
 /** Resets the recognizer
  *
  *  Resets current results so the recognition can continue from scratch */
 void vosk_recognizer_reset(VoskRecognizer *recognizer);
 
 
+/** Prepares the recognizer for a new audio stream
+ *
+ *  Unlike vosk_recognizer_reset(), which continues the same stream, this drops
+ *  the audio of the current stream and word times start from zero again. Options
+ *  like words, grammar and speaker model are kept, so the recognizer can be reused
+ *  for another request instead of creating a new one. External features belong to
+ *  the stream and go back to the default of the model (--external-features in
+ *  model.conf), set them again for the next stream.
+ *
+ *  @returns 1 on success, 0 if the recognizer could not be prepared and should
+ *           not be used any more */
+int vosk_recognizer_restart(VoskRecognizer *recognizer);
+
+
 /** Releases recognizer object
  *
  *  Underlying model is also unreferenced and if needed released */
@@ -341,6 +482,10 @@ void vosk_gpu_init();
 void vosk_gpu_thread_init();
 
 /** Creates the batch recognizer object
+ *
+ *  With CUDA the streams are decoded on the GPU. Without CUDA a CPU engine
+ *  thread computes the ready chunks of all streams in one batched nnet3
+ *  computation and decodes them, the model needs graph/HCLG.fst.
  *
  *  @returns model object or NULL if problem occured */
 VoskBatchModel *vosk_batch_model_new(const char *model_path);
@@ -369,7 +514,10 @@ void vosk_batch_recognizer_set_nlsml(VoskBatchRecognizer *recognizer, int nlsml)
 /** Closes the stream */
 void vosk_batch_recognizer_finish_stream(VoskBatchRecognizer *recognizer);
 
-/** Return results */
+/** Return results
+ *
+ *  If the stream failed, the last result has an "error" field and the stream
+ *  takes no more audio */
 const char *vosk_batch_recognizer_front_result(VoskBatchRecognizer *recognizer);
 
 /** Release and free first retrieved result */